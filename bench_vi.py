@@ -0,0 +1,268 @@
+"""
+Benchmarks of the VI hot paths on synthetic orthomosaics
+Generates RGB(A) uint8 and 5 band MULTI float32 GeoTIFFs of the requested sizes and block layout (reproducible,
+seeded per block row, written strip by strip so 30k x 30k images don't need the RAM), then times
+    read       : reading all windows of the bands into the reused buffer (image_reader.ImageReader)
+    compute    : every VI on its own and all selected VIs in one program (VIProgram.evaluate)
+    write      : writing the windows of all VIs with every output format (vi_writers)
+    tiled      : get_dat_for_vi in tiled mode, end to end
+    whole      : get_dat_for_vi without a tile size, end to end: the whole-image path (the image read at once, the
+                 VIs evaluated and written one at a time) and its memory profile (only up to --max-whole-size)
+Every case runs in a fresh process so its peak RSS is its own. The results are saved as JSON, with the commit and
+library versions, so runs of different commits can be compared (--compare).
+
+    python bench_vi.py --sizes 1024 4096 --types RGB MULTI --out bench_results.json
+    python bench_vi.py --sizes 1024 4096 --compare bench_results.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import numpy as np
+
+DEFAULT_SIZES = [1024, 4096, 10240, 30720]
+BAND_COUNT    = {'RGB': 4, 'MULTI': 5}
+
+
+def make_synthetic_image(path, img_type, size, block_size = 512, striped = False, seed = 0):
+    """    Writes a synthetic orthomosaic: vegetation-like rows over soil, with noise and a transparent border
+
+           Args:
+            path (str)          : GeoTIFF to be written
+            img_type (str)      : RGB (4 bands uint8, the 4th is alpha) or MULTI (5 bands float32 reflectance)
+            size (int)          : Width and height in pixels
+            block_size (int)    : Edge of the internal tiles (default is 512)
+            striped (bool)      : Write a striped (one row per block) instead of a tiled file (default is False)
+            seed (int)          : Seed of the generator (default is 0)
+
+           Returns:
+            path (str)
+    """
+    from osgeo import gdal, osr
+
+    count = BAND_COUNT[img_type]
+    gdal_type = gdal.GDT_Byte if img_type == 'RGB' else gdal.GDT_Float32
+    options = ['BIGTIFF=IF_SAFER']
+    if not striped:
+        options += ['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}']
+    ds = gdal.GetDriverByName('GTiff').Create(path, size, size, count, gdal_type, options)
+    ds.SetGeoTransform((500000.0, 0.01, 0.0, 3800000.0, 0.0, -0.01)) # 1 cm pixels
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32614)
+    ds.SetProjection(srs.ExportToWkt())
+
+    border = size // 50
+    x = np.arange(size)
+    canopy_cols = (np.sin(x / 25.0) > 0.2)                     # crop rows
+    for yoff in range(0, size, block_size):
+        ys = min(block_size, size - yoff)
+        rng = np.random.default_rng((seed, yoff))              # reproducible whatever the size of the strips
+        canopy = np.broadcast_to(canopy_cols, (ys, size)) & (rng.random((ys, size)) > 0.1)
+        noise = rng.normal(0, 1, (count, ys, size)).astype(np.float32)
+        if img_type == 'RGB':
+            soil = np.array([140, 110, 80], np.float32)[:, None, None]
+            leaf = np.array([60, 130, 50], np.float32)[:, None, None]
+            bands = np.where(canopy, leaf, soil) + 12 * noise[:3]
+            alpha = np.full((1, ys, size), 255, np.float32)
+            rows = np.arange(yoff, yoff + ys)[:, None]
+            alpha[0][(rows < border) | (rows >= size - border) | (x[None, :] < border) | (x[None, :] >= size - border)] = 0
+            bands = np.clip(np.concatenate([bands, alpha]), 0, 255).astype(np.uint8)
+        else:
+            soil = np.array([0.08, 0.10, 0.13, 0.18, 0.22], np.float32)[:, None, None]
+            leaf = np.array([0.03, 0.08, 0.04, 0.25, 0.45], np.float32)[:, None, None]
+            bands = np.clip(np.where(canopy, leaf, soil) + 0.01 * noise, 0, 1).astype(np.float32)
+        for k in range(count):
+            ds.GetRasterBand(k + 1).WriteArray(bands[k], 0, yoff)
+    ds = None
+    return path
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 # kB on Linux
+
+def _run_case(case):
+    """    Runs one benchmark case (in a fresh process) and returns its timings
+    """
+    from osgeo import gdal
+    from gen_dat_files import RGB_BANDS, MULTI_BANDS, get_block_windows, get_dat_for_vi, get_dat_for_vi_tiled
+    from image_reader import ImageReader
+    from vi_expressions import compile_vis
+    from vi_writers import get_writer
+
+    img_type = case['img_type']
+    band_names = RGB_BANDS if img_type == 'RGB' else MULTI_BANDS
+    ds = gdal.Open(case['image'])
+    reader = ImageReader(ds, band_names)
+    size = ds.RasterXSize * ds.RasterYSize
+    windows = get_block_windows(ds, case['tile_size'])
+    out_dir = tempfile.mkdtemp(dir = case['work_dir'])
+    result = dict(case)
+    start = time.perf_counter()
+
+    try:
+        if case['phase'] == 'read':
+            for window in windows:
+                reader.read(window)
+
+        elif case['phase'] == 'compute':
+            program = compile_vis(img_type, case['vis'])
+            result['operations'] = program.num_operations()
+            elapsed = 0.0
+            for window in windows:
+                bands = reader.read(window)
+                t = time.perf_counter()
+                program.evaluate(bands)
+                elapsed += time.perf_counter() - t
+            start = time.perf_counter() - elapsed # only the compute time is reported
+
+        elif case['phase'] == 'write':
+            program = compile_vis(img_type, case['vis'])
+            writer = get_writer(case['out_format'], out_dir, 'bench', img_type, program.vis, ds.RasterXSize,
+                                ds.RasterYSize, ds.GetGeoTransform(), ds.GetProjection())
+            elapsed = 0.0
+            for window in windows:
+                bands = reader.read(window)
+                vi_rasters = program.evaluate(bands)
+                t = time.perf_counter()
+                writer.write(window, vi_rasters, bands.get('alpha'))
+                elapsed += time.perf_counter() - t
+            t = time.perf_counter()
+            writer.close()
+            elapsed += time.perf_counter() - t
+            start = time.perf_counter() - elapsed # only the write time is reported
+            result['bytes_written'] = sum(os.path.getsize(os.path.join(root, f))
+                                          for root, _, names in os.walk(out_dir) for f in names)
+
+        elif case['phase'] == 'tiled':
+            get_dat_for_vi_tiled([case['image']], out_dir, img_type, case['vis'], case['tile_size'], case['out_format'])
+
+        elif case['phase'] == 'whole':
+            get_dat_for_vi([case['image']], out_dir, img_type, case['vis'], out_format = case['out_format'])
+
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_dir, ignore_errors = True)
+
+    result['seconds'] = seconds
+    result['mpix_per_s'] = size / seconds / 1e6 if seconds > 0 else 0.0
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+def build_cases(image, img_type, size, args):
+    from vi_expressions import get_vi_names
+
+    vis = args.vis or get_vi_names(img_type)
+    base = {'image': image, 'img_type': img_type, 'size': size, 'block_size': args.block_size, 'striped': args.striped,
+            'tile_size': args.tile_size, 'work_dir': args.work_dir, 'vis': vis, 'out_format': 'ENVI', 'vi': 'all'}
+    cases = [dict(base, phase = 'read', vis = [], vi = '-')]
+    for vi in vis:
+        cases.append(dict(base, phase = 'compute', vis = [vi], vi = vi))
+    cases.append(dict(base, phase = 'compute'))
+    for out_format in args.formats:
+        cases.append(dict(base, phase = 'write', out_format = out_format))
+    cases.append(dict(base, phase = 'tiled'))
+    if size <= args.max_whole_size:
+        cases.append(dict(base, phase = 'whole'))
+    return cases
+
+def environment():
+    """    Returns what identifies a benchmark run: commit, versions and machine
+    """
+    from osgeo import gdal
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit'    : commit,
+        'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python'    : platform.python_version(),
+        'numpy'     : np.__version__,
+        'gdal'      : gdal.__version__,
+        'machine'   : platform.machine(),
+        'node'      : platform.node(),
+        'cpu_count' : os.cpu_count(),
+    }
+
+def case_id(r):
+    return (r['img_type'], r['size'], r['block_size'], r['striped'], r['phase'], r['vi'], r['out_format'])
+
+def compare(results, previous):
+    """    Returns a table of the speed of every case relative to a previous run (> 1 is faster)
+    """
+    old = {case_id(r): r for r in previous['results']}
+    lines = [f'{"type":<6} {"size":>6} {"phase":<8} {"vi":<6} {"format":<5} {"seconds":>9} {"before":>9} {"speedup":>8}']
+    for r in results:
+        o = old.get(case_id(r))
+        before = f'{o["seconds"]:>9.3f}' if o else f'{"-":>9}'
+        speedup = f'{o["seconds"] / r["seconds"]:>8.2f}' if o and r['seconds'] > 0 else f'{"-":>8}'
+        lines.append(f'{r["img_type"]:<6} {r["size"]:>6} {r["phase"]:<8} {r["vi"]:<6} {r["out_format"]:<5} '
+                     f'{r["seconds"]:>9.3f} {before} {speedup}')
+    return '\n'.join(lines)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the VI read / compute / write paths on synthetic images')
+    parser.add_argument('--sizes', nargs = '+', type = int, default = DEFAULT_SIZES, help = 'Image edges in pixels')
+    parser.add_argument('--types', nargs = '+', default = ['RGB', 'MULTI'], choices = ['RGB', 'MULTI'])
+    parser.add_argument('--vis', nargs = '+', help = 'VIs to benchmark (default all of the image type)')
+    parser.add_argument('--block-size', type = int, default = 512, help = 'Internal tile edge of the synthetic images')
+    parser.add_argument('--striped', action = 'store_true', help = 'Striped instead of tiled synthetic images')
+    parser.add_argument('--tile-size', type = int, default = 2048, help = 'Window edge of the tiled processing')
+    parser.add_argument('--formats', nargs = '+', default = ['ENVI', 'COG'], help = 'Output formats of the write phase')
+    parser.add_argument('--max-whole-size', type = int, default = 10240, help = 'Largest size of the whole image case')
+    parser.add_argument('--work-dir', help = 'Folder for the synthetic images and outputs (default a temporary one)')
+    parser.add_argument('--keep', action = 'store_true', help = 'Keep the synthetic images for the next run')
+    parser.add_argument('--out', default = 'bench_results.json', help = 'JSON file receiving the results')
+    parser.add_argument('--compare', help = 'JSON results of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    own_work_dir = args.work_dir is None
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix = 'bench_vi_')
+    args.work_dir = work_dir
+    os.makedirs(work_dir, exist_ok = True)
+    results = []
+    try:
+        for img_type in args.types:
+            for size in args.sizes:
+                layout = 'strip' if args.striped else f'b{args.block_size}'
+                image = os.path.join(work_dir, f'synthetic_{img_type}_{size}_{layout}.tif')
+                if not os.path.exists(image):
+                    t = time.perf_counter()
+                    make_synthetic_image(image, img_type, size, args.block_size, args.striped)
+                    print(f'generated {os.path.basename(image)} in {time.perf_counter() - t:.1f} s', flush = True)
+                for case in build_cases(image, img_type, size, args):
+                    # a fresh process per case: its peak RSS is not polluted by the previous cases
+                    with ProcessPoolExecutor(max_workers = 1, mp_context = mp.get_context('spawn')) as pool:
+                        r = pool.submit(_run_case, case).result()
+                    del r['work_dir']
+                    results.append(r)
+                    print(f'{img_type:<6} {size:>6} {r["phase"]:<8} {r["vi"]:<6} {r["out_format"]:<5} {r["seconds"]:>8.3f} s '
+                          f'{r["mpix_per_s"]:>8.1f} MPix/s {r["peak_rss_mb"]:>8.0f} MB', flush = True)
+                if not args.keep:
+                    os.remove(image)
+    finally:
+        if own_work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors = True)
+
+    report = {'environment': environment(), 'settings': {k: v for k, v in vars(args).items() if k not in ('out', 'compare')},
+              'results': results}
+    with open(args.out, 'w') as fp:
+        json.dump(report, fp, indent = 1)
+    print(f'results saved to {args.out}')
+
+    if args.compare:
+        with open(args.compare) as fp:
+            print(compare(results, json.load(fp)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
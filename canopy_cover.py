@@ -0,0 +1,198 @@
+"""
+Canopy cover (cc) of RGB orthomosaics and its fraction per field plot
+A dedicated path for cc, which is computed on every flight: the orthomosaic is streamed window by window, only the
+cc program is evaluated (the threshold tests are division free, see vi_expressions, the float temporaries are window
+sized and reused), and the result goes straight to
+    - a compact mask, <out_dir>/cc/<filename>_cc.tif, bit-packed (1 bit per pixel and a 1 bit nodata mask) or uint8,
+      both compressed (see vi_writers.CogWriter), instead of a 2 band float32 .dat
+    - the fractional cover of every plot, <out_dir>/cc/<filename>_cc_plots.csv, from two per plot pixel counts
+      (canopy and valid pixels) accumulated window by window
+As for the CHMs, the images are processed in parallel and the plots are rasterized once per grid (plot index).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from gen_dat_files import RGB_BANDS, DEFAULT_TILE_SIZE, get_block_windows
+from gen_chm_attributes import pixel_area, get_grid
+from image_reader import ImageReader
+from vi_expressions import CLASS_NODATA, compile_vis, valid_mask
+from vi_writers import CogWriter
+from zonal_stats import PlotLabels, get_plot_labels, save_zonal_stats_csv
+from pipeline_metrics import NULL_INSTRUMENTATION
+
+CC_STORAGE = {'bit': 1, 'uint8': 8} # storage of the mask -> CogWriter cc_nbits
+
+
+class CoverAccumulator:
+    """    Accumulates, per plot, the canopy and valid pixels of cc windows
+
+           Args:
+            n_plots (int)           : Number of plots, the labels are 1..n_plots (0 is outside of every plot)
+    """
+    def __init__(self, n_plots):
+        self.canopy = np.zeros(n_plots + 1, np.int64)
+        self.valid = np.zeros(n_plots + 1, np.int64)
+
+    def add(self, labels, cc):
+        """    Adds one window: labels (plot label raster) and cc (uint8 0/1, CLASS_NODATA for nodata)
+        """
+        in_plot = labels > 0
+        valid = in_plot & (cc != CLASS_NODATA)
+        self.valid += np.bincount(labels[valid], minlength = len(self.valid))
+        self.canopy += np.bincount(labels[in_plot & (cc == 1)], minlength = len(self.canopy))
+
+    def merge(self, other):
+        self.canopy += other.canopy
+        self.valid += other.valid
+
+    def finalize(self, area = None):
+        """    Returns 'cc' -> statistic name -> array with one value per plot: the fractional cover (NaN for plots
+               without valid pixels), the canopy and valid pixel counts and, with the pixel area, the canopy area
+        """
+        canopy = self.canopy[1:]
+        valid = self.valid[1:]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            cover = np.where(valid > 0, canopy / np.maximum(valid, 1), np.nan)
+        stats = {'cover': cover, 'canopy_pixels': canopy, 'valid_pixels': valid}
+        if area is not None:
+            stats['canopy_area'] = canopy * area
+        return {'cc': stats}
+
+
+def image_canopy_cover(image_file, out_dir, labels = None, tile_size = DEFAULT_TILE_SIZE, params = None, storage = 'bit',
+                       write_mask = True, metrics = None):
+    """    Computes the cc mask of one RGB orthomosaic and the fractional cover of its plots
+
+           Args:
+            image_file (str)        : The RGB orthomosaic
+            out_dir (str)           : The directory to which the results will be saved (in its cc folder)
+            labels (PlotLabels)     : Label raster of the plots on the grid of the image (default is None, no plots)
+            tile_size (int)         : Target edge of a window in pixels (default is DEFAULT_TILE_SIZE)
+            params (dict)           : Values overriding vi_expressions.VI_PARAMETERS, e.g. th1, th2, th3 (default is None)
+            storage (str)           : Storage of the mask, one of CC_STORAGE (default is bit)
+            write_mask (bool)       : Write the mask (default is True)
+            metrics (Instrumentation): Receives the stage timers and progress (default is None)
+
+           Returns:
+            result (dict)           : mask (path or None) and, with labels, plot_ids, stats (see CoverAccumulator) and csv
+    """
+    if storage not in CC_STORAGE:
+        raise ValueError(f'cc storage must be one of {list(CC_STORAGE)}, got {storage}')
+    metrics = metrics or NULL_INSTRUMENTATION
+    program = compile_vis('RGB', ['cc'])
+    filename = os.path.splitext(os.path.basename(image_file))[0][:][0:8]
+    cc_dir = os.path.join(out_dir, 'cc')
+
+    with metrics.stage('open'):
+        reader = ImageReader(image_file, RGB_BANDS, native = True) # uint8 RGB goes to the int16 cc kernel
+        writer = None
+        if write_mask:
+            writer = CogWriter(cc_dir, filename, 'RGB', ['cc'], reader.x_size, reader.y_size, reader.transform, reader.proj,
+                               cc_nbits = CC_STORAGE[storage])
+    accumulator = CoverAccumulator(len(labels)) if labels is not None else None
+
+    try:
+        for window in get_block_windows(reader.ds, tile_size):
+            with metrics.stage('read'):
+                bands = reader.read(window)
+            with metrics.stage('compute'):
+                cc = program.evaluate(bands, params, valid_mask(bands, reader.band_nodata))['cc']
+            if writer is not None:
+                with metrics.stage('write'):
+                    writer.write(window, {'cc': cc})
+                metrics.count('bytes_written', cc.nbytes * CC_STORAGE[storage] // 8)
+            if accumulator is not None:
+                with metrics.stage('zonal'):
+                    accumulator.add(labels.read(window), cc)
+            metrics.progress(window[2] * window[3], image_file)
+    except BaseException:
+        # cancelled or failed mid-image: no open datasets or partial masks are left behind
+        if writer is not None:
+            writer.abort()
+        reader.close()
+        raise
+
+    result = {'mask': None}
+    try:
+        with metrics.stage('close'):
+            if writer is not None:
+                try:
+                    writer.close()
+                except BaseException:
+                    writer.abort() # the conversion failed: the staging file is removed
+                    raise
+                result['mask'] = writer.output_paths()['cc']
+            if accumulator is not None:
+                result['plot_ids'] = labels.plot_ids
+                result['stats'] = accumulator.finalize(pixel_area(reader.transform))
+                result['csv'] = os.path.join(cc_dir, filename + '_cc_plots.csv')
+                save_zonal_stats_csv(result['csv'], labels.plot_ids, result['stats'])
+    finally:
+        reader.close()
+    return result
+
+def _cover_job(image_file, out_dir, label_file, plot_ids, tile_size, params, storage, write_mask):
+    # work unit of the process pool: the label raster is opened by path, GDAL datasets can't be pickled
+    labels = PlotLabels(label_file, plot_ids, persistent = True) if label_file else None
+    try:
+        return image_canopy_cover(image_file, out_dir, labels, tile_size, params, storage, write_mask)
+    finally:
+        if labels is not None:
+            labels.close()
+
+def get_canopy_cover(image_files, out_dir, shp_file = None, epsg = None, workers = None, tile_size = DEFAULT_TILE_SIZE,
+                     params = None, storage = 'bit', write_mask = True, id_field = None, index_dir = None, metrics = None):
+    """    Computes the cc masks of RGB orthomosaics and, with a shapefile, the fractional cover of every plot
+
+           Args:
+            image_files (list(str)) : RGB orthomosaics, e.g. one per flight date
+            out_dir (str)           : The directory to which the results will be saved (in its cc folder)
+            shp_file (str)          : Shapefile with the field plots (default is None, only the masks)
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            workers (int)           : If more than 1, process the images in a pool of processes (default is None)
+            tile_size (int)         : Target edge of a window in pixels (default is DEFAULT_TILE_SIZE)
+            params (dict)           : Values overriding vi_expressions.VI_PARAMETERS, e.g. th1, th2, th3 (default is None)
+            storage (str)           : Storage of the masks, one of CC_STORAGE (default is bit)
+            write_mask (bool)       : Write the masks (default is True)
+            id_field (str)          : Attribute identifying the plots (default is None, the feature id)
+            index_dir (str)         : Folder of the plot index, False to not keep the label rasters (default is None,
+                                      see zonal_stats.get_plot_labels)
+            metrics (Instrumentation): Receives the stage timers and progress (default is None)
+
+           Returns:
+            results (dict)          : Image filename -> result of image_canopy_cover
+    """
+    if not shp_file and not write_mask:
+        raise ValueError('Without a shapefile the cc masks must be written')
+    metrics = metrics or NULL_INSTRUMENTATION
+    grids = {} # grid -> images on it, so the plots are rasterized once per grid
+    sizes = {}
+    for f in image_files:
+        x, y, transform, proj = get_grid(f)
+        grids.setdefault((x, y, tuple(transform), proj), []).append(f)
+        sizes[f] = x * y
+        metrics.plan(x * y)
+
+    labels = {}
+    results = {}
+    try:
+        if shp_file:
+            with metrics.stage('rasterize'):
+                for grid in grids:
+                    labels[grid] = get_plot_labels(shp_file, *grid, epsg, id_field, index_dir)
+
+        jobs = [(f, labels.get(grid)) for grid, files in grids.items() for f in files]
+        if workers is not None and workers > 1:
+            with ProcessPoolExecutor(max_workers = workers) as pool:
+                futures = {f: pool.submit(_cover_job, f, out_dir, lab.path if lab else None, lab.plot_ids if lab else None,
+                                          tile_size, params, storage, write_mask) for f, lab in jobs}
+                for f, lab in jobs:
+                    results[f] = futures[f].result()
+                    metrics.progress(sizes[f], f)
+        else:
+            for f, lab in jobs:
+                results[f] = image_canopy_cover(f, out_dir, lab, tile_size, params, storage, write_mask, metrics)
+    finally:
+        for lab in labels.values():
+            lab.release()
+    return results
@@ -0,0 +1,494 @@
+"""
+Golden output checks of the VI pipeline
+Guards the performance work on the processing paths: small synthetic RGB(A), MULTI and CHM rasters and a shapefile
+of plots are generated locally (seeded, see bench_vi.make_synthetic_image, with a patch of black pixels where the
+formulas are undefined, scattered MULTI pixels with a near-zero green and red edge (gci / reci outliers), CHM spikes,
+and plots crossing the image edge and the transparent border), every processing mode is run
+on them and its outputs are compared with a reference computed without the VI engine:
+    VIs        : the original formulas of get_dat_for_vi, written out here (BASELINE_VIS) and not taken from
+                 vi_expressions, so a change of a definition or of the engine shows up as a difference; evaluated with
+                 numpy on the whole image (float32 bands), VI_NODATA / CLASS_NODATA on the masked pixels and where a
+                 formula is undefined, NaN / 0 instead for the ENVI outputs (vi_writers.envi_values)
+    plot stats : per plot numpy reductions (mean, std, np.percentile, ...) over masks of the plot rectangles, the
+                 percentiles compared within PERCENTILE_TOLERANCE of the spread (max - min) of each plot
+    ch / cv    : the same on the CHM, heights clipped at 0, the volume as the sum of height x pixel area
+    cover      : canopy and valid pixels of cc in every plot
+The modes, each timed, so a speed-up is validated for correctness in the same run:
+    whole           : get_dat_for_vi on the whole image (ENVI)
+    tiled           : window by window, the tile size does not divide the image (edge windows)
+    parallel        : windows in a pool of processes
+    pipelined       : reads, compute and writes overlapped in threads
+    cached          : through a ResultCache, run twice, the second run must skip every product (none planned,
+                      the outputs not rewritten)
+    cog             : COG output
+    zonal           : per plot VI statistics without rasters, tiled
+    zonal-parallel  : the same in a pool of processes
+    chm             : ch / cv of the plots (gen_chm_attributes), in a pool of processes
+    cover           : the canopy cover path (canopy_cover), bit-packed mask and plot cover
+
+    python check_golden_outputs.py
+    python check_golden_outputs.py --size 2000 --modes tiled parallel --param th1=0.9 --json golden.json
+Exits with 1 when an output differs from the reference. test_golden_outputs.py runs every mode under pytest.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from bench_vi import environment, make_synthetic_image
+
+IMAGE_NAMES = {'RGB': '20240601_rgb.tif', 'MULTI': '20240602_multi.tif'} # distinct date prefixes, the output names
+CHM_NAME    = '20240601_chm.tif'
+CHM_NODATA  = -9999.0
+EPSG        = 32614                                                       # the projection of the synthetic images
+DEFAULT_MODES = ['whole', 'tiled', 'parallel', 'pipelined', 'cached', 'cog', 'zonal', 'zonal-parallel', 'chm', 'cover']
+PERCENTILE_TOLERANCE = 1e-6 # tolerance of the plot percentiles, relative to the spread (max - min) of the plot
+OUTLIER_FRACTION = 1e-3     # MULTI pixels with a near-zero green and red edge
+CHM_SPIKE = 45.0            # height of the CHM spikes, in metres
+
+# VI name -> formula of the original get_dat_for_vi (b: float32 bands, p: VI parameters), per image type
+BASELINE_VIS = {
+    'RGB': {
+        'exg'   : lambda b, p: 2 * (b['green'] / (b['red'] + b['green'] + b['blue']))
+                               - b['red'] / (b['red'] + b['green'] + b['blue'])
+                               - b['blue'] / (b['red'] + b['green'] + b['blue']),
+        'grvi'  : lambda b, p: (b['green'] - b['red']) / (b['green'] + b['red']),
+        'mgrvi' : lambda b, p: (b['green'] ** 2 - b['red'] ** 2) / (b['green'] ** 2 + b['red'] ** 2),
+        'rgbvi' : lambda b, p: (b['green'] ** 2 - b['red'] * b['blue']) / (b['green'] ** 2 + b['red'] * b['blue']),
+        'exgr'  : lambda b, p: 2 * (b['green'] / (b['red'] + b['green'] + b['blue']))
+                               - b['red'] / (b['red'] + b['green'] + b['blue'])
+                               - b['blue'] / (b['red'] + b['green'] + b['blue'])
+                               - 1.4 * (b['red'] / (b['red'] + b['green'] + b['blue']))
+                               - b['green'] / (b['red'] + b['green'] + b['blue']),
+        'cc'    : lambda b, p: (b['red'] / b['green'] < p['th1']) & (b['blue'] / b['green'] < p['th2'])
+                               & (2 * b['green'] - b['blue'] - b['red'] > p['th3']),
+    },
+    'MULTI': {
+        'ndvi'  : lambda b, p: (b['nir'] - b['red']) / (b['nir'] + b['red']),
+        'ndre'  : lambda b, p: (b['nir'] - b['rededge']) / (b['nir'] + b['rededge']),
+        'gndvi' : lambda b, p: (b['nir'] - b['green']) / (b['nir'] + b['green']),
+        'savi'  : lambda b, p: ((b['nir'] - b['red']) * 1.5) / (b['nir'] + b['red'] + 0.5),
+        'osavi' : lambda b, p: ((b['nir'] - b['red']) * 1.16) / (b['nir'] + b['red'] + 0.16),
+        'msavi' : lambda b, p: 0.5 * (2 * b['nir'] + 1 - ((2 * b['nir'] + 1) ** 2 - 8 * (b['nir'] - b['red'])) ** (1.0 / 2)),
+        'gci'   : lambda b, p: b['nir'] / b['green'] - 1,
+        'reci'  : lambda b, p: b['nir'] / b['rededge'] - 1,
+        'grvi'  : lambda b, p: (b['green'] - b['red']) / (b['green'] + b['red']),
+    },
+}
+
+
+def _add_edge_cases(path, img_type, size, seed = 0):
+    # black pixels (alpha kept): zero denominators, undefined formulas
+    from osgeo import gdal
+    from gen_dat_files import MULTI_BANDS
+    ds = gdal.Open(path, gdal.GA_Update)
+    count = 3 if img_type == 'RGB' else ds.RasterCount
+    for k in range(1, count + 1):
+        ds.GetRasterBand(k).WriteArray(np.zeros((16, 16)), size // 3, size // 3)
+    if img_type == 'MULTI':
+        # scattered near-zero green and red edge: gci / reci of about 1e4 inside the plots
+        rng = np.random.default_rng(seed)
+        rows, cols = rng.integers(0, size, (2, max(int(size * size * OUTLIER_FRACTION), 1)))
+        for name in ('green', 'rededge'):
+            band = ds.GetRasterBand(MULTI_BANDS.index(name) + 1)
+            values = band.ReadAsArray()
+            values[rows, cols] = 1e-5
+            band.WriteArray(values)
+    ds = None
+
+def make_synthetic_chm(path, size, block_size = 256, seed = 0):
+    """    Writes a synthetic canopy height model on the grid of the synthetic orthomosaics: crop rows up to 1.5 m, ground
+           noise around 0 (negative heights included), scattered spikes of CHM_SPIKE and a nodata border
+
+           Returns:
+            path (str)
+    """
+    from osgeo import gdal, osr
+
+    ds = gdal.GetDriverByName('GTiff').Create(path, size, size, 1, gdal.GDT_Float32,
+                                              ['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}'])
+    ds.SetGeoTransform((500000.0, 0.01, 0.0, 3800000.0, 0.0, -0.01))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    ds.SetProjection(srs.ExportToWkt())
+    rng = np.random.default_rng(seed)
+    x = np.arange(size)
+    canopy = (np.sin(x / 25.0) > 0.2)[None, :] & (rng.random((size, size)) > 0.1)
+    height = np.where(canopy, rng.uniform(0.2, 1.5, (size, size)), rng.normal(0, 0.03, (size, size))).astype(np.float32)
+    height[rng.random((size, size)) < OUTLIER_FRACTION] = CHM_SPIKE # e.g. birds, poles, matching errors
+    border = size // 50
+    height[:border] = CHM_NODATA
+    height[:, -border:] = CHM_NODATA
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(CHM_NODATA)
+    band.WriteArray(height)
+    ds = None
+    return path
+
+def make_plot_shapefile(path, size, rows = 4, cols = 5):
+    """    Writes a shapefile of rectangular plots aligned to the pixels of the synthetic images: a grid of plots from the
+           top left corner (overlapping the transparent border) and one more plot crossing the right edge
+
+           Returns:
+            rects (list(tuple))     : (x0, y0, x1, y1) of every plot in pixels, in feature order
+    """
+    from osgeo import ogr, osr
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    ds = driver.CreateDataSource(path)
+    layer = ds.CreateLayer('plots', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('plot', ogr.OFTString))
+    width, height = size // (cols + 1), size // rows # the last column is left to the plot crossing the edge
+    rects = [(c * width + 3, r * height + 3, (c + 1) * width - 3, (r + 1) * height - 3) for r in range(rows) for c in range(cols)]
+    rects.append((size - width // 2, height // 2, size + width // 2, height)) # crosses the right edge
+    for k, (x0, y0, x1, y1) in enumerate(rects):
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for px, py in ((x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)):
+            ring.AddPoint_2D(500000.0 + px * 0.01, 3800000.0 - py * 0.01)
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('plot', f'P{k + 1:02d}')
+        feature.SetGeometry(polygon)
+        layer.CreateFeature(feature)
+    ds = None
+    return rects
+
+def _reference_labels(rects, size):
+    labels = np.zeros((size, size), np.int32)
+    for k, (x0, y0, x1, y1) in enumerate(rects):
+        labels[max(y0, 0):min(y1, size), max(x0, 0):min(x1, size)] = k + 1
+    return labels
+
+
+def reference_vis(image, img_type, vis, params = None):
+    """    Computes the VIs of an image with numpy, formula by formula from BASELINE_VIS (see the module docstring)
+
+           Returns:
+            rasters (dict)          : VI name -> float32 raster, or uint8 for the class VIs (e.g. cc)
+    """
+    from osgeo import gdal
+    from gen_dat_files import RGB_BANDS, MULTI_BANDS
+    from vi_expressions import VI_PARAMETERS, VI_NODATA, CLASS_NODATA
+
+    ds = gdal.Open(image)
+    band_names = RGB_BANDS if img_type == 'RGB' else MULTI_BANDS
+    bands = {band_names[k]: ds.GetRasterBand(k + 1).ReadAsArray().astype(np.float32) for k in range(ds.RasterCount)}
+    valid = bands.pop('alpha') > 0 if 'alpha' in bands else np.ones(next(iter(bands.values())).shape, bool)
+    params = dict(VI_PARAMETERS, **(params or {}))
+    rasters = {}
+    for vi in vis:
+        with np.errstate(all = 'ignore'):
+            value = BASELINE_VIS[img_type][vi](bands, params)
+        if value.dtype == bool:
+            rasters[vi] = np.where(valid, value, CLASS_NODATA).astype(np.uint8)
+        else:
+            rasters[vi] = np.where(valid & np.isfinite(value), value, VI_NODATA).astype(np.float32)
+    return rasters
+
+def _plot_stats(labels, values, valid, n_plots, percentiles):
+    stats = {name: np.full(n_plots, np.nan) for name in ['count', 'mean', 'std', 'min', 'max'] +
+             [f'p{q:g}' for q in percentiles]}
+    stats['count'] = np.zeros(n_plots, np.int64)
+    for k in range(n_plots):
+        v = values[(labels == k + 1) & valid].astype(np.float64)
+        stats['count'][k] = len(v)
+        if len(v):
+            stats['mean'][k], stats['std'][k], stats['min'][k], stats['max'][k] = v.mean(), v.std(), v.min(), v.max()
+            for q in percentiles:
+                stats[f'p{q:g}'][k] = np.percentile(v, q)
+    return stats
+
+def reference_zonal(rasters, labels, n_plots):
+    """    Returns the per plot statistics of the reference VIs (VI name -> statistic name -> array)
+    """
+    from vi_expressions import output_nodata
+    from zonal_stats import DEFAULT_PERCENTILES
+
+    return {vi: _plot_stats(labels, r, (r != output_nodata(r)) & np.isfinite(r), n_plots, DEFAULT_PERCENTILES)
+            for vi, r in rasters.items()}
+
+def reference_chm(chm_file, labels, n_plots):
+    """    Returns the reference ch / cv of the plots, as gen_chm_attributes.chm_plot_attributes gives them
+    """
+    from osgeo import gdal
+    from gen_chm_attributes import CHM_PERCENTILES, pixel_area
+
+    ds = gdal.Open(chm_file)
+    height = ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
+    valid = np.isfinite(height) & (height != CHM_NODATA)
+    height = np.where(valid, np.maximum(height, 0.0), 0.0)
+    volume = np.array([height[(labels == k + 1) & valid].astype(np.float64).sum() for k in range(n_plots)])
+    return {'height': _plot_stats(labels, height, valid, n_plots, CHM_PERCENTILES),
+            'volume': {'m3': volume * pixel_area(ds.GetGeoTransform())}}
+
+def reference_cover(cc, labels, n_plots):
+    """    Returns the reference plot cover of a cc raster, as canopy_cover.CoverAccumulator gives it
+    """
+    from vi_expressions import CLASS_NODATA
+
+    canopy = np.array([np.count_nonzero((labels == k + 1) & (cc == 1)) for k in range(n_plots)])
+    valid = np.array([np.count_nonzero((labels == k + 1) & (cc != CLASS_NODATA)) for k in range(n_plots)])
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        cover = np.where(valid > 0, canopy / np.maximum(valid, 1), np.nan)
+    return {'cc': {'cover': cover, 'canopy_pixels': canopy, 'valid_pixels': valid}}
+
+
+def read_raster(path, vi = None):
+    """    Reads a VI output: band 1, or the band described as vi (COG), with the pixels outside of an internal mask
+           (bit-packed cc) set to CLASS_NODATA
+    """
+    from osgeo import gdal
+    from vi_expressions import CLASS_NODATA
+
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    for k in range(1, ds.RasterCount + 1):
+        if vi is not None and ds.GetRasterBand(k).GetDescription() == vi:
+            band = ds.GetRasterBand(k)
+    values = band.ReadAsArray()
+    if band.GetMaskFlags() == gdal.GMF_PER_DATASET:
+        values[band.GetMaskBand().ReadAsArray() == 0] = CLASS_NODATA
+    return values
+
+def read_vi_outputs(out_format, out_dir, image, vis):
+    """    Returns VI name -> raster of the outputs of an image
+    """
+    from vi_writers import get_output_paths
+
+    filename = os.path.basename(image)[0:8]
+    return {vi: read_raster(path, vi) for vi, path in get_output_paths(out_format, out_dir, filename, vis).items()}
+
+def compare_rasters(rasters, reference, rtol, atol):
+    """    Returns VI name -> nodata (pixels nodata in one only), values (valid pixels out of tolerance, any difference
+           for the class VIs) and max_error
+    """
+    from vi_expressions import output_nodata
+
+    errors = {}
+    for vi, ref in reference.items():
+        if vi not in rasters:
+            errors[vi] = {'missing': True}
+            continue
+        out = rasters[vi]
+        nodata = output_nodata(ref)
+        ref_nodata, out_nodata = ref == nodata, out == nodata
+        mismatch = ref_nodata != out_nodata
+        if ref.dtype.kind == 'f': # NaN in the ENVI layout, a -10000 where the reference has NaN is a mismatch too
+            mismatch |= np.isnan(ref) != np.isnan(out)
+            ref_nodata |= np.isnan(ref)
+            out_nodata |= np.isnan(out)
+        valid = ~ref_nodata & ~out_nodata
+        a, b = out[valid].astype(np.float64), ref[valid].astype(np.float64)
+        bad = a != b if ref.dtype == np.uint8 else ~np.isclose(a, b, rtol, atol)
+        errors[vi] = {'nodata': int(np.count_nonzero(mismatch)), 'values': int(np.count_nonzero(bad)),
+                      'max_error': float(np.abs(a - b).max()) if len(a) else 0.0}
+    return errors
+
+def compare_stats(stats, reference, rtol, atol):
+    """    Returns <vi>_<stat> -> plots out of tolerance (NaN only matches NaN), the percentiles (p<q>) within
+           PERCENTILE_TOLERANCE of the spread of each plot (on top of rtol / atol)
+    """
+    errors = {}
+    for vi, vi_stats in reference.items():
+        spread = 0.0
+        if 'min' in vi_stats and 'max' in vi_stats:
+            spread = np.nan_to_num(np.asarray(vi_stats['max'], np.float64) - np.asarray(vi_stats['min'], np.float64))
+        for stat, ref in vi_stats.items():
+            out = stats.get(vi, {}).get(stat)
+            if out is None:
+                errors[f'{vi}_{stat}'] = len(ref)
+                continue
+            stat_atol = atol
+            if stat[0] == 'p' and stat[1:2].isdigit():
+                stat_atol = atol + PERCENTILE_TOLERANCE * spread
+            ok = np.isclose(np.asarray(out, np.float64), np.asarray(ref, np.float64), rtol, stat_atol, equal_nan = True)
+            errors[f'{vi}_{stat}'] = int(np.count_nonzero(~ok))
+    return errors
+
+
+def _run_vis(case, out_dir, **options):
+    from gen_dat_files import get_dat_for_vi
+    get_dat_for_vi([case['image']], out_dir, case['img_type'], case['vis'], params = case['params'], **options)
+    return {'rasters': read_vi_outputs(options.get('out_format', 'ENVI'), out_dir, case['image'], case['vis'])}
+
+def _run_zonal(case, out_dir, **options):
+    from gen_dat_files import get_dat_for_vi
+    zonal = get_dat_for_vi([case['image']], out_dir, case['img_type'], case['vis'], case['tile_size'],
+                           shp_file = case['shp_file'], epsg = EPSG, write_rasters = False, params = case['params'],
+                           **options)
+    return {'stats': zonal[case['image']]['stats']}
+
+def _output_mtimes(out_dir):
+    from result_cache import MANIFEST_NAME
+    return {os.path.join(root, name): os.stat(os.path.join(root, name)).st_mtime_ns
+            for root, _, names in os.walk(out_dir) for name in names if not name.startswith(MANIFEST_NAME)}
+
+def _run_cached(case, out_dir):
+    from gen_dat_files import get_dat_for_vi
+    from result_cache import ResultCache
+    get_dat_for_vi([case['image']], out_dir, case['img_type'], case['vis'], cache = ResultCache(out_dir),
+                   params = case['params'])
+    todo = ResultCache(out_dir).plan(case['image'], case['img_type'], case['vis'], case['params'])
+    if todo:
+        raise AssertionError(f'the cache plans {todo} again after the first run')
+    mtimes = _output_mtimes(out_dir)
+    time.sleep(0.01) # a rewrite gets a later modification time
+    start = time.perf_counter()
+    get_dat_for_vi([case['image']], out_dir, case['img_type'], case['vis'], cache = ResultCache(out_dir),
+                   params = case['params'])
+    warm_seconds = time.perf_counter() - start
+    rewritten = sorted(os.path.relpath(f, out_dir) for f, t in _output_mtimes(out_dir).items() if mtimes.get(f) != t)
+    if rewritten:
+        raise AssertionError(f'the second run rewrote {rewritten}')
+    return {'rasters': read_vi_outputs('ENVI', out_dir, case['image'], case['vis']),
+            'extra': {'warm_seconds': warm_seconds}}
+
+def _run_chm(case, out_dir):
+    from gen_chm_attributes import get_chm_attributes
+    results = get_chm_attributes([case['chm_file']], case['shp_file'], out_dir, EPSG, case['workers'], case['tile_size'])
+    return {'stats': results[case['chm_file']]['stats']}
+
+def _run_cover(case, out_dir):
+    from canopy_cover import get_canopy_cover
+    result = get_canopy_cover([case['image']], out_dir, case['shp_file'], EPSG, tile_size = case['tile_size'],
+                              params = case['params'], storage = 'bit')[case['image']]
+    stats = {'cc': {k: v for k, v in result['stats']['cc'].items() if k != 'canopy_area'}}
+    return {'rasters': {'cc': read_raster(result['mask'])}, 'stats': stats}
+
+# mode -> (run(case, out_dir), image types, reference)
+MODES = {
+    'whole'          : (lambda c, d: _run_vis(c, d), ['RGB', 'MULTI'], 'envi'),
+    'tiled'          : (lambda c, d: _run_vis(c, d, tile_size = c['tile_size']), ['RGB', 'MULTI'], 'envi'),
+    'parallel'       : (lambda c, d: _run_vis(c, d, tile_size = c['tile_size'], workers = c['workers']), ['RGB', 'MULTI'], 'envi'),
+    'pipelined'      : (lambda c, d: _run_vis(c, d, tile_size = c['tile_size'], pipelined = True), ['RGB', 'MULTI'], 'envi'),
+    'cached'         : (_run_cached, ['RGB', 'MULTI'], 'envi'),
+    'cog'            : (lambda c, d: _run_vis(c, d, tile_size = c['tile_size'], out_format = 'COG'), ['RGB', 'MULTI'], 'vis'),
+    'zonal'          : (lambda c, d: _run_zonal(c, d), ['RGB', 'MULTI'], 'zonal'),
+    'zonal-parallel' : (lambda c, d: _run_zonal(c, d, workers = c['workers']), ['RGB', 'MULTI'], 'zonal'),
+    'chm'            : (_run_chm, ['RGB'], 'chm'),
+    'cover'          : (_run_cover, ['RGB'], 'cover'),
+}
+
+def check_mode(mode, case, reference, work_dir, rtol, atol):
+    """    Runs one mode in a fresh output folder, times it and compares its outputs with the reference
+
+           Returns:
+            result (dict)           : mode, img_type, seconds, mpix_per_s, ok, rasters / stats errors and extra values
+    """
+    run = MODES[mode][0]
+    out_dir = tempfile.mkdtemp(prefix = f'{mode}_{case["img_type"]}_', dir = work_dir)
+    start = time.perf_counter()
+    try:
+        outputs = run(case, out_dir)
+        seconds = time.perf_counter() - start
+    except Exception as e:
+        return {'mode': mode, 'img_type': case['img_type'], 'seconds': time.perf_counter() - start, 'mpix_per_s': 0.0,
+                'ok': False, 'error': f'{type(e).__name__}: {e}'}
+    finally:
+        shutil.rmtree(out_dir, ignore_errors = True)
+
+    result = {'mode': mode, 'img_type': case['img_type'], 'seconds': seconds,
+              'mpix_per_s': case['pixels'] / seconds / 1e6 if seconds > 0 else 0.0}
+    result.update(outputs.get('extra', {}))
+    ok = True
+    if 'rasters' in outputs:
+        result['rasters'] = compare_rasters(outputs['rasters'], reference['rasters'], rtol, atol)
+        ok &= all(not e.get('missing') and e['nodata'] == 0 and e['values'] == 0 for e in result['rasters'].values())
+    if 'stats' in outputs:
+        result['stats'] = compare_stats(outputs['stats'], reference['stats'], rtol, atol)
+        ok &= not any(result['stats'].values())
+    result['ok'] = bool(ok)
+    return result
+
+def _failures(r):
+    if 'error' in r:
+        return r['error']
+    bad = [f'{vi}: {e}' for vi, e in r.get('rasters', {}).items() if e.get('missing') or e['nodata'] or e['values']]
+    bad += [f'{name}: {n} plot(s)' for name, n in r.get('stats', {}).items() if n]
+    return '; '.join(bad)
+
+def main(argv = None):
+    from generate_canopy_attributes_cli import parse_params
+    from vi_writers import envi_values
+
+    parser = argparse.ArgumentParser(description = 'Compare every processing mode of the VI pipeline with a reference')
+    parser.add_argument('--size', type = int, default = 1200, help = 'Edge of the synthetic images in pixels')
+    parser.add_argument('--block-size', type = int, default = 256, help = 'Internal tile edge of the synthetic images')
+    parser.add_argument('--tile-size', type = int, default = 300, help = 'Window edge of the tiled modes')
+    parser.add_argument('--workers', type = int, default = 2, help = 'Worker processes of the parallel modes')
+    parser.add_argument('--types', nargs = '+', default = ['RGB', 'MULTI'], choices = ['RGB', 'MULTI'])
+    parser.add_argument('--modes', nargs = '+', default = DEFAULT_MODES, choices = list(MODES))
+    parser.add_argument('--param', dest = 'params', action = 'append', metavar = 'NAME=VALUE',
+                        help = 'VI parameter used by every mode and the reference, e.g. th1=0.9 (repeatable)')
+    parser.add_argument('--rtol', type = float, default = 1e-5, help = 'Relative tolerance of the continuous values')
+    parser.add_argument('--atol', type = float, default = 1e-6, help = 'Absolute tolerance of the continuous values')
+    parser.add_argument('--work-dir', help = 'Folder for the synthetic data and outputs (default a temporary one)')
+    parser.add_argument('--keep', action = 'store_true', help = 'Keep the synthetic data')
+    parser.add_argument('--json', help = 'JSON file receiving the results, with the commit and library versions')
+    args = parser.parse_args(argv)
+
+    params = parse_params(args.params)
+    own_work_dir = args.work_dir is None
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix = 'golden_')
+    os.makedirs(work_dir, exist_ok = True)
+    results = []
+    try:
+        shp_file = os.path.join(work_dir, 'plots.shp')
+        rects = make_plot_shapefile(shp_file, args.size)
+        labels = _reference_labels(rects, args.size)
+        chm_file = make_synthetic_chm(os.path.join(work_dir, CHM_NAME), args.size, args.block_size)
+        chm_reference = {'stats': reference_chm(chm_file, labels, len(rects))}
+        for img_type in args.types:
+            modes = [m for m in args.modes if img_type in MODES[m][1]]
+            if not modes:
+                continue
+            image = os.path.join(work_dir, IMAGE_NAMES[img_type])
+            make_synthetic_image(image, img_type, args.size, args.block_size)
+            _add_edge_cases(image, img_type, args.size)
+            vis = list(BASELINE_VIS[img_type])
+            case = {'image': image, 'img_type': img_type, 'vis': vis, 'params': params, 'tile_size': args.tile_size,
+                    'workers': args.workers, 'shp_file': shp_file, 'chm_file': chm_file, 'pixels': args.size ** 2}
+
+            t = time.perf_counter()
+            rasters = reference_vis(image, img_type, vis, params)
+            references = {
+                'vis'   : {'rasters': rasters},
+                'envi'  : {'rasters': {vi: envi_values(r) for vi, r in rasters.items()}},
+                'zonal' : {'stats': reference_zonal(rasters, labels, len(rects))},
+                'chm'   : chm_reference,
+                'cover' : {'rasters': {'cc': rasters['cc']}, 'stats': reference_cover(rasters['cc'], labels, len(rects))}
+                          if 'cc' in rasters else None,
+            }
+            print(f'{img_type:<6} reference     {time.perf_counter() - t:>8.3f} s', flush = True)
+
+            for mode in modes:
+                r = check_mode(mode, case, references[MODES[mode][2]], work_dir, args.rtol, args.atol)
+                results.append(r)
+                warm = f' (warm {r["warm_seconds"]:.3f} s)' if 'warm_seconds' in r else ''
+                status = 'ok' if r['ok'] else 'DIFFERS: ' + _failures(r)
+                print(f'{img_type:<6} {mode:<14} {r["seconds"]:>8.3f} s {r["mpix_per_s"]:>8.1f} MPix/s  {status}{warm}',
+                      flush = True)
+    finally:
+        if own_work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors = True)
+
+    if args.json:
+        report = {'environment': environment(), 'settings': vars(args), 'results': results}
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent = 1)
+        print(f'results saved to {args.json}')
+    failed = [r for r in results if not r['ok']]
+    print(f'{len(results) - len(failed)} of {len(results)} mode(s) match the reference')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
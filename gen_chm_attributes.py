@@ -0,0 +1,154 @@
+"""
+Canopy height (ch) and canopy volume (cv) per field plot from the canopy height models (CHMs)
+Every CHM is streamed window by window against the label raster of the plots (see zonal_stats) and in one pass gives,
+per plot, the height statistics (count, mean, std, min, max and percentiles) and the canopy volume, the sum of
+height x pixel area. The CHMs (one per flight date) are processed in parallel, the plots are rasterized once per
+distinct grid (size, geotransform, projection) and the label raster, kept in the plot index (see zonal_stats),
+is shared by all CHMs on that grid and by the VIs of the orthomosaics on the same grid.
+"""
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from osgeo import gdal
+from gen_dat_files import DEFAULT_TILE_SIZE, get_block_windows
+from image_reader import ImageReader
+from zonal_stats import PlotLabels, ZonalAccumulator, get_plot_labels, save_zonal_stats_csv
+from pipeline_metrics import NULL_INSTRUMENTATION
+
+CHM_PERCENTILES = (50, 90, 95, 99) # the upper percentiles are the usual plot canopy heights
+
+
+def pixel_area(transform):
+    """    Returns the area of one pixel (in squared units of the projection) of a geotransform
+    """
+    return abs(transform[1] * transform[5] - transform[2] * transform[4])
+
+def get_grid(image_file):
+    """    Returns the grid of a raster: (x size, y size, geotransform, projection)
+    """
+    ds = gdal.Open(image_file)
+    return ds.RasterXSize, ds.RasterYSize, ds.GetGeoTransform(), ds.GetProjection()
+
+def chm_plot_attributes(chm_file, labels, tile_size = DEFAULT_TILE_SIZE, percentiles = CHM_PERCENTILES, min_height = 0.0,
+                        metrics = None, exact_percentiles = True):
+    """    Computes the height statistics and canopy volume of every plot of one CHM
+
+           Args:
+            chm_file (str)          : Canopy height model (1 band, heights in the units of the projection)
+            labels (PlotLabels)     : Label raster of the plots on the grid of the CHM
+            tile_size (int)         : Target edge of a window in pixels (default is DEFAULT_TILE_SIZE)
+            percentiles (tuple)     : Height percentiles to be reported (default is CHM_PERCENTILES)
+            min_height (float)      : Heights below it (ground, noise) count as 0 (default is 0.0)
+            metrics (Instrumentation): Receives the stage timers and progress (default is None)
+            exact_percentiles (bool): Exact percentiles, keeping every plot pixel, False for the per plot
+                                      histograms (default is True, see zonal_stats.ZonalAccumulator)
+
+           Returns:
+            stats (dict)            : 'height' -> statistic name -> array with one value per plot,
+                                      'volume' -> {'m3': array}, the canopy volume per plot
+    """
+    metrics = metrics or NULL_INSTRUMENTATION
+    reader = ImageReader(chm_file, ['height'])
+    nodata = reader.band_nodata['height']
+    area = pixel_area(reader.transform)
+    heights = ZonalAccumulator(len(labels), ['height'], percentiles, exact_percentiles)
+    volume = np.zeros(len(labels) + 1, np.float64)
+
+    for window in get_block_windows(reader.ds, tile_size):
+        with metrics.stage('read'):
+            height = reader.read(window)['height']
+            plot = labels.read(window)
+        with metrics.stage('compute'):
+            valid = np.isfinite(height)
+            if nodata is not None:
+                valid &= height != nodata
+            plot = np.where(valid, plot, 0)
+            np.maximum(height, 0.0, out = height, where = valid)
+            if min_height > 0:
+                height[valid & (height < min_height)] = 0.0
+            heights.add(plot, {'height': height})
+            in_plot = plot > 0
+            volume += np.bincount(plot[in_plot], weights = height[in_plot].astype(np.float64), minlength = len(volume))
+        metrics.progress(window[2] * window[3], chm_file)
+    reader.close()
+
+    stats = heights.finalize()
+    stats['volume'] = {'m3': volume[1:] * area}
+    return stats
+
+def _chm_job(chm_file, label_file, plot_ids, tile_size, percentiles, min_height, exact_percentiles):
+    # work unit of the process pool: the label raster is opened by path, GDAL datasets can't be pickled
+    labels = PlotLabels(label_file, plot_ids, persistent = True)
+    try:
+        return chm_plot_attributes(chm_file, labels, tile_size, percentiles, min_height, exact_percentiles = exact_percentiles)
+    finally:
+        labels.close()
+
+def get_chm_attributes(chm_files, shp_file, out_dir, epsg = None, workers = None, tile_size = DEFAULT_TILE_SIZE,
+                       percentiles = CHM_PERCENTILES, min_height = 0.0, id_field = None, index_dir = None, metrics = None,
+                       exact_percentiles = True):
+    """    Computes ch and cv per plot for every CHM and saves them to <out_dir>/chm/<filename>_chm_plots.csv
+
+           Args:
+            chm_files (list(str))   : Canopy height models, e.g. one per flight date
+            shp_file (str)          : Shapefile with the field plots
+            out_dir (str)           : The directory to which the results will be saved
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            workers (int)           : If more than 1, process the CHMs in a pool of processes (default is None)
+            tile_size (int)         : Target edge of a window in pixels (default is DEFAULT_TILE_SIZE)
+            percentiles (tuple)     : Height percentiles to be reported (default is CHM_PERCENTILES)
+            min_height (float)      : Heights below it count as 0 (default is 0.0)
+            id_field (str)          : Attribute identifying the plots (default is None, the feature id)
+            index_dir (str)         : Folder of the plot index, False to not keep the label rasters (default is None,
+                                      see zonal_stats.get_plot_labels)
+            metrics (Instrumentation): Receives the stage timers and progress (default is None)
+            exact_percentiles (bool): Exact percentiles, keeping every plot pixel (default is True)
+
+           Returns:
+            results (dict)          : CHM filename -> plot_ids, stats ('height' and 'volume', see chm_plot_attributes) and csv
+    """
+    metrics = metrics or NULL_INSTRUMENTATION
+    grids = {} # grid -> CHMs on it, so the plots are rasterized once per grid
+    sizes = {}
+    for f in chm_files:
+        x, y, transform, proj = get_grid(f)
+        grids.setdefault((x, y, tuple(transform), proj), []).append(f)
+        sizes[f] = x * y
+        metrics.plan(x * y)
+
+    labels = {}
+    results = {}
+    try:
+        with metrics.stage('rasterize'):
+            for grid in grids:
+                labels[grid] = get_plot_labels(shp_file, *grid, epsg, id_field, index_dir)
+
+        jobs = [(f, labels[grid]) for grid, files in grids.items() for f in files]
+        if workers is not None and workers > 1:
+            with ProcessPoolExecutor(max_workers = workers) as pool:
+                futures = {f: pool.submit(_chm_job, f, lab.path, lab.plot_ids, tile_size, percentiles, min_height,
+                                          exact_percentiles)
+                           for f, lab in jobs}
+                for f, lab in jobs:
+                    results[f] = {'plot_ids': lab.plot_ids, 'stats': futures[f].result()}
+                    metrics.progress(sizes[f], f)
+        else:
+            for f, lab in jobs:
+                results[f] = {'plot_ids': lab.plot_ids,
+                              'stats': chm_plot_attributes(f, lab, tile_size, percentiles, min_height, metrics,
+                                                           exact_percentiles)}
+    finally:
+        for lab in labels.values():
+            lab.release()
+
+    for f, result in results.items():
+        filename = os.path.splitext(os.path.basename(f))[0][:][0:8]
+        result['csv'] = os.path.join(out_dir, 'chm', filename + '_chm_plots.csv')
+        save_zonal_stats_csv(result['csv'], result['plot_ids'], result['stats'])
+    return results
+
+def get_chm_files(chm_dir):
+    """    Returns the CHMs (.tif) of a folder, sorted by name (the date prefix)
+    """
+    return sorted(glob.glob(os.path.join(chm_dir, '*.tif')))
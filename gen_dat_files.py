@@ -4,9 +4,22 @@ Generating the .dat files
 import sys
 import os
 import glob
-import rs2
 import numpy as np
 from osgeo import gdal, gdalnumeric, ogr, osr
+from vi_expressions import compile_vis, get_vi_names, valid_mask
+from vi_writers     import create_vi_dat_file, get_writer
+from image_reader   import ImageReader
+from zonal_stats    import open_plot_stats, close_plot_stats
+from pipeline_metrics import NULL_INSTRUMENTATION
+
+
+RGB_BANDS   = ['red', 'green', 'blue', 'alpha']             # band order of the RGB orthomosaics
+MULTI_BANDS = ['blue', 'green', 'red', 'rededge', 'nir']    # band order of the MULTI orthomosaics
+
+RGB_VIS     = get_vi_names('RGB')                          # ['exg', 'grvi', 'mgrvi', 'rgbvi', 'exgr', 'cc']
+MULTI_VIS   = get_vi_names('MULTI')                        # ['ndvi', 'ndre', 'gndvi', 'savi', 'osavi', 'msavi', 'gci', 'reci', 'grvi']
+
+DEFAULT_TILE_SIZE = 2048 # target edge (in pixels) of the windows used by the tiled mode
 
 
 def save_vi_dat_files(out, vi_name, filename, x, y, transform, proj, raster, alpha = None):
@@ -26,21 +39,143 @@ def save_vi_dat_files(out, vi_name, filename, x, y, transform, proj, raster, alp
            Returns:
             none
     """
-    dat_files_dir = os.path.join(out, vi_name) # create output folder for dat files
-    if not os.path.exists(dat_files_dir):
-        os.makedirs(dat_files_dir)
-
-    out_file = os.path.join(dat_files_dir, filename + '_' + vi_name + '.dat')
-    driver = gdal.GetDriverByName("ENVI")
-    outds = driver.Create(out_file, x, y, 2, gdal.GDT_Float32)
-    outds.SetGeoTransform(transform)
-    outds.SetProjection(proj)
+    outds = create_vi_dat_file(out, vi_name, filename, x, y, transform, proj)
     outds.GetRasterBand(1).WriteArray(raster)
     if alpha is not None:
         outds.GetRasterBand(2).WriteArray(alpha)
     outds = None
 
-def get_dat_for_vi(image_files, out_dir, img_type, vis_list):
+def get_block_windows(ds, tile_size = DEFAULT_TILE_SIZE):
+    """    Splits a raster into windows that are aligned to its native (GDAL) block layout
+
+           Args:
+            ds (gdal.Dataset)   : The opened orthomosaic
+            tile_size (int)     : Target edge of a window in pixels, rounded to whole blocks (default is DEFAULT_TILE_SIZE)
+
+           Returns:
+            windows (list(tuple)): List of (xoff, yoff, xsize, ysize) windows covering the whole raster
+    """
+    x_size = ds.RasterXSize
+    y_size = ds.RasterYSize
+    block_x, block_y = ds.GetRasterBand(1).GetBlockSize()
+
+    # grow the window to a whole number of native blocks, for striped files (block = one full row strip)
+    # the window keeps the full width and takes as many strips as fit in tile_size**2 pixels
+    win_x = min(x_size, max(block_x, (tile_size // block_x) * block_x))
+    win_y = max(block_y, ((tile_size * tile_size) // win_x // block_y) * block_y)
+    win_y = min(y_size, win_y)
+
+    windows = []
+    for yoff in range(0, y_size, win_y):
+        for xoff in range(0, x_size, win_x):
+            windows.append((xoff, yoff, min(win_x, x_size - xoff), min(win_y, y_size - yoff)))
+    return windows
+
+def read_window_bands(ds, band_names, window):
+    """    Reads one window of every band of an orthomosaic as float32
+
+           Args:
+            ds (gdal.Dataset)       : The opened orthomosaic
+            band_names (list(str))  : Names of the bands in file order (RGB_BANDS or MULTI_BANDS)
+            window (tuple)          : (xoff, yoff, xsize, ysize) window to be read
+
+           Returns:
+            bands (dict)            : Band name -> float32 numpy array (owned by the caller)
+    """
+    return ImageReader(ds, band_names).read(window, reuse = False)
+
+def get_dat_for_vi_tiled(image_files, out_dir, img_type, vis_list, tile_size = DEFAULT_TILE_SIZE, out_format = 'ENVI',
+                         writer_options = None, shp_file = None, epsg = None, write_rasters = True, metrics = None,
+                         use_vmem = False, params = None):
+    """    Generates the .dat files for the given Vegitation Indecies (VIs) one block-aligned window at a time,
+           peak memory depends on tile_size and not on the size of the orthomosaic
+
+           Args:
+            image_files (list(str)) : List of image filenames for all orthomosaic images to be processed
+            out_dir (str)           : The directory to which the results will be saved
+            img_type (str)          : Type of images to be processed: RGB or MULTI
+            vis_list (list(str))    : List of VIs to be generated for the orthomosaic(s)
+            tile_size (int)         : Target edge of a window in pixels (default is DEFAULT_TILE_SIZE)
+            out_format (str)        : Output format, one of vi_writers.WRITERS (default is ENVI)
+            writer_options (dict)   : Options of the output writer (default is None)
+            shp_file (str)          : If set, per plot statistics of the VIs are accumulated while they are computed
+                                      and saved to <out_dir>/zonal/<filename>_plots.csv (default is None)
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            write_rasters (bool)    : Write the VI rasters, False when only the plot statistics are needed (default is True)
+            metrics (Instrumentation): Receives the stage timers, counters and progress (default is None)
+            use_vmem (bool)         : Read raw images through memory-mapped views (see image_reader) (default is False)
+            params (dict)           : Values overriding vi_expressions.VI_PARAMETERS, e.g. the cc thresholds (default is None)
+
+           Returns:
+            zonal (dict)            : Image filename -> per plot statistics (see zonal_stats.close_plot_stats),
+                                      empty without shp_file
+    """
+    metrics = metrics or NULL_INSTRUMENTATION
+    band_names = RGB_BANDS if img_type == 'RGB' else MULTI_BANDS
+    program = compile_vis(img_type, vis_list) # all selected VIs in one pass, options that are not VIs (e.g. ch, cv) are skipped
+    zonal = {}
+
+    for f in image_files:
+        img_filename = os.path.splitext(os.path.basename(f))[0][:] # get filename without extension
+        with metrics.stage('open'):
+            # Open image without loading to memory, every window is read into the same buffer (native type when the
+            # VI kernels can use it, e.g. uint8 RGB, float32 otherwise)
+            reader = ImageReader(f, band_names, use_vmem, native = True)
+            x_size = reader.x_size
+            y_size = reader.y_size
+            geo_transform = reader.transform
+            geo_proj = reader.proj
+            metrics.plan(x_size * y_size)
+
+            writer = None
+            if write_rasters:
+                writer = get_writer(out_format, out_dir, img_filename[0:8], img_type, program.vis, x_size, y_size,
+                                    geo_transform, geo_proj, **(writer_options or {}))
+        if shp_file:
+            with metrics.stage('rasterize'):
+                labels, plot_stats = open_plot_stats(shp_file, program.vis, x_size, y_size, geo_transform, geo_proj, epsg)
+
+        try:
+            for window in get_block_windows(reader.ds, tile_size):
+                with metrics.stage('read'):
+                    bands = reader.read(window)
+                with metrics.stage('compute'):
+                    vi_rasters = program.evaluate(bands, params, valid_mask(bands, reader.band_nodata))
+                if writer is not None:
+                    with metrics.stage('write'):
+                        writer.write(window, vi_rasters, bands.get('alpha'))
+                    metrics.count('bytes_written', sum(v.nbytes for v in vi_rasters.values()))
+                if shp_file:
+                    with metrics.stage('zonal'):
+                        plot_stats.add(labels.read(window), vi_rasters)
+                metrics.count('bytes_read', sum(b.nbytes for b in bands.values()))
+                metrics.progress(window[2] * window[3], f) # raises job_manager.JobCancelled once the job is cancelled
+                bands = None; vi_rasters = None
+
+            with metrics.stage('close'):
+                if writer is not None:
+                    writer.close()
+                    writer = None
+        except BaseException:
+            # cancelled or failed mid-image: no open datasets or partial outputs are left behind
+            if writer is not None:
+                writer.abort()
+            if shp_file:
+                labels.release()
+            reader.close()
+            raise
+        if shp_file:
+            with metrics.stage('close'):
+                zonal[f] = close_plot_stats(out_dir, img_filename[0:8], labels, plot_stats)
+        reader.close()
+        writer = None; reader = None
+        metrics.event('image_done', image = f)
+
+    return zonal
+
+def get_dat_for_vi(image_files, out_dir, img_type, vis_list, tile_size = None, workers = None, out_format = 'ENVI',
+                   writer_options = None, shp_file = None, epsg = None, write_rasters = True, cache = None, metrics = None,
+                   pipelined = False, params = None, use_vmem = False):
     """    Generates the .dat files for the given Vegitation Indecies (VIs)
 
            Args:
@@ -48,117 +183,110 @@ def get_dat_for_vi(image_files, out_dir, img_type, vis_list):
             out_dir (StringVar)     : The directory to which the results will be saved
             img_type (str)          : Type of images to be processed: RGB or MULTI
             vis_list (list(str))    : List of VIs to be generated for the orthomosaic(s)
+            tile_size (int)         : If set, process the images window by window (see get_dat_for_vi_tiled) (default is None)
+            workers (int)           : If more than 1, spread the windows over a process pool (see gen_dat_parallel) (default is None)
+            out_format (str)        : Output format, one of vi_writers.WRITERS (default is ENVI)
+            writer_options (dict)   : Options of the output writer, e.g. compress, vi_dtype for COG (default is None)
+            shp_file (str)          : If set, also compute the per plot statistics of the VIs (tiled mode) (default is None)
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            write_rasters (bool)    : Write the VI rasters, False when only the plot statistics are needed (default is True)
+            cache (ResultCache)     : If set, only the (image, VI) products that are missing or outdated are computed,
+                                      not used with shp_file (see result_cache) (default is None)
+            metrics (Instrumentation): Receives the stage timers, counters and progress (see pipeline_metrics) (default is None)
+            pipelined (bool)        : Process the images window by window with the reads, compute and writes overlapped
+                                      in threads (see gen_dat_pipeline), ignored with workers (default is False)
+            params (dict)           : Values overriding vi_expressions.VI_PARAMETERS, e.g. the cc thresholds (default is None)
+            use_vmem (bool)         : Read raw images through memory-mapped views (see image_reader) (default is False)
 
            Returns:
-            none
+            zonal (dict)            : Image filename -> per plot statistics, empty without shp_file
     """
-    if img_type == 'RGB':
+    metrics = metrics or NULL_INSTRUMENTATION
+    if cache is not None and not shp_file and write_rasters:
+        # group the images by the VIs they still need, up to date products are skipped
+        groups = {}
         for f in image_files:
-            img_filename = os.path.splitext(os.path.basename(f))[0][:] # get filename without extension
+            todo = cache.plan(f, img_type, vis_list, params, out_format, writer_options)
+            if todo:
+                groups.setdefault(tuple(todo), []).append(f)
+        for todo, files in groups.items():
+            get_dat_for_vi(files, out_dir, img_type, list(todo), tile_size, workers, out_format, writer_options,
+                           metrics = metrics, pipelined = pipelined, params = params, use_vmem = use_vmem)
+            for f in files:
+                cache.record(f, img_type, list(todo), params, out_format, writer_options)
+        return {}
+
+    if workers is not None and workers > 1:
+        # imported here, gen_dat_parallel depends on this module
+        from gen_dat_parallel import get_dat_for_vi_parallel, format_throughput_report
+        report = get_dat_for_vi_parallel(image_files, out_dir, img_type, vis_list, tile_size or DEFAULT_TILE_SIZE, workers,
+                                         out_format = out_format, writer_options = writer_options, shp_file = shp_file,
+                                         epsg = epsg, write_rasters = write_rasters, metrics = metrics, params = params,
+                                         use_vmem = use_vmem)
+        # per image and total throughput of the workers, to the subscribers (e.g. the CLI with --progress, JsonLog)
+        metrics.event('throughput', text = format_throughput_report(report),
+                      **{k: v for k, v in report.items() if k != 'zonal'})
+        return report['zonal']
+
+    if pipelined:
+        from gen_dat_pipeline import get_dat_for_vi_pipelined # imported here, gen_dat_pipeline depends on this module
+        return get_dat_for_vi_pipelined(image_files, out_dir, img_type, vis_list, tile_size or DEFAULT_TILE_SIZE,
+                                        out_format = out_format, writer_options = writer_options, shp_file = shp_file,
+                                        epsg = epsg, write_rasters = write_rasters, metrics = metrics, params = params,
+                                        use_vmem = use_vmem)
+
+    if tile_size is not None or shp_file or not write_rasters:
+        return get_dat_for_vi_tiled(image_files, out_dir, img_type, vis_list, tile_size or DEFAULT_TILE_SIZE, out_format,
+                                    writer_options, shp_file, epsg, write_rasters, metrics, use_vmem, params)
+
+    band_names = RGB_BANDS if img_type == 'RGB' else MULTI_BANDS
+    vis = compile_vis(img_type, vis_list).vis # checks the VI names before any image is opened
+
+    for f in image_files:
+        img_filename = os.path.splitext(os.path.basename(f))[0][:] # get filename without extension
+        with metrics.stage('open'):
             # Open image and get some of its parameters
-            in_img = rs2.RSImage(f)
-            x_size = in_img.ds.RasterXSize
-            y_size = in_img.ds.RasterYSize
-            geo_transform = in_img.ds.GetGeoTransform()
-            geo_proj = in_img.ds.GetProjection()
-
-            # Read bands
-            red = in_img.img[0,:,:].astype(np.float32)
-            green = in_img.img[1,:,:].astype(np.float32)
-            blue = in_img.img[2,:,:].astype(np.float32)
-            alpha = in_img.img[3,:,:].astype(np.float32)
+            in_img = ImageReader(f, band_names, use_vmem, native = True)
+            x_size = in_img.x_size
+            y_size = in_img.y_size
+            geo_transform = in_img.transform
+            geo_proj = in_img.proj
+            metrics.plan(x_size * y_size)
+            band_nodata = in_img.band_nodata
 
+        with metrics.stage('read'):
+            # Read the bands straight into their working type (no second copy of the image is kept)
+            bands = in_img.read((0, 0, x_size, y_size), reuse = False)
+            in_img.close()
             in_img = None
 
-            for vi in vis_list:
-                # process selected vi
-                if vi == 'exg':
-                    red_s = np.float32(red)/np.float32(red+green+blue) #TODO: check why float is needed again!
-                    green_s = np.float32(green)/np.float32(red+green+blue)
-                    blue_s = np.float32(blue)/np.float32(red+green+blue)
-                    vi_raster = 2 * green_s - red_s - blue_s
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster, alpha)
-                    vi_raster = None; red_s = None; green_s = None; blue_s = None
-                if vi == 'grvi':
-                    vi_raster = (green - red) / (green + red)
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster, alpha)
-                    vi_raster = None
-                if vi == 'mgrvi':
-                    vi_raster = np.float32(green**2 - red**2) / np.float32(green**2+red**2)
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster, alpha)
-                    vi_raster = None
-                if vi == 'rgbvi':
-                    vi_raster = (green**2 - red * blue) / (green**2 + red * blue)
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster, alpha)
-                    vi_raster = None
-                if vi == 'exgr':
-                    red_s = np.float32(red)/np.float32(red+green+blue) #TODO: check why float is needed again!
-                    green_s = np.float32(green)/np.float32(red+green+blue)
-                    blue_s = np.float32(blue)/np.float32(red+green+blue)
-                    vi_raster = 2 * green_s - red_s - blue_s - 1.4 * red_s - green_s
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster, alpha)
-                    vi_raster = None
-                if vi == 'cc':#
-                    th1 = 0.95; th2 = 0.95; th3 = 20
-                    i1 = red / green; i2 = blue / green; i3 = 2 * green - blue - red
-                    cond1 = i1 < th1; cond2 = i2 < th2; cond3 = i3 > th3
-                    i1 = None; i2 = None; i3 = None
-                    vi_raster = (cond1 * cond2 * cond3)
-                    cond1 = None; cond2 = None; cond3 = None
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-
-        red = None; green = None; blue = None; alpha = None
-
-    if img_type == 'MULTI':
-        for f in image_files:
-            img_filename = os.path.splitext(os.path.basename(f))[0][:] # get filename without extension
-            # Open image without loading to memory
-            in_img = rs2.RSImage(f)
-            blue = in_img.img[0,:,:].astype(np.float32)
-            green = in_img.img[1,:,:].astype(np.float32)
-            red = in_img.img[2,:,:].astype(np.float32)
-            rededge = in_img.img[3,:,:].astype(np.float32)
-            nir = in_img.img[4,:,:].astype(np.float32)
+        with metrics.stage('compute'):
+            mask = valid_mask(bands, band_nodata)
+        with metrics.stage('write'):
+            writer = get_writer(out_format, out_dir, img_filename[0:8], img_type, vis, x_size, y_size,
+                                geo_transform, geo_proj, **(writer_options or {}))
+        bytes_written = 0
+        try:
+            for vi in vis:
+                # one VI at a time: a single full size VI raster (and the temporaries of its formula) is alive next to
+                # the bands, whatever the number of VIs. The program is dropped with its buffers once the VI is written.
+                with metrics.stage('compute'):
+                    program = compile_vis(img_type, [vi])
+                    raster = program.evaluate(bands, params, mask)[vi]
+                with metrics.stage('write'):
+                    writer.write((0, 0, x_size, y_size), {vi: raster}, bands.get('alpha'))
+                bytes_written += raster.nbytes
+                program = None; raster = None
+            with metrics.stage('write'):
+                writer.close()
+        except BaseException:
+            writer.abort() # no partial outputs are left behind
+            raise
+        metrics.count('bytes_read', sum(b.nbytes for b in bands.values()))
+        metrics.count('bytes_written', bytes_written)
+        metrics.progress(x_size * y_size, f)
+        metrics.event('image_done', image = f)
 
-            in_img = None
+        bands = None; mask = None; writer = None
 
-            for vi in vis_list:
-                if vi == 'ndvi':
-                    vi_raster = (nir - red)/(nir + red)
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-                if vi == 'ndre':
-                    vi_raster = (nir - rededge)/(nir + rededge)
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-                if vi == 'gndvi':
-                    vi_raster = (nir - green)/(nir + green)
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-                if vi == 'savi':
-                    vi_raster = ((nir - red)*(1.5))/(nir + red + 0.5)
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-                if vi == 'osavi':
-                    vi_raster = ((nir - red)*(1.16))/(nir + red + 0.16)
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-                if vi == 'msavi':
-                    vi_raster = 0.5*(2*nir+1-((2*nir+1)**2-8*(nir-red))**(1.0/2))
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-                if vi == 'gci':
-                    vi_raster = gci = nir/green - 1
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-                if vi == 'reci':
-                    vi_raster = nir/rededge - 1
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-                if vi == 'grvi':
-                    vi_raster = (green - red)/(green + red)
-                    save_vi_dat_files(out_dir, vi, img_filename[0:8], x_size, y_size, geo_transform, geo_proj, vi_raster)
-                    vi_raster = None
-
-            blue = None; green = None; red = None; rededge = None; nir = None
+    return {}
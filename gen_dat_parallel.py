@@ -0,0 +1,217 @@
+"""
+Generating the .dat files in parallel
+(image, window) work units are spread over a process pool. The workers read and compute the windows,
+the parent process is the only writer so the outputs are byte-identical to the serial path.
+The number of work units in flight is bounded to cap the memory held by finished but unwritten windows.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from osgeo import gdal
+from gen_dat_files import RGB_BANDS, MULTI_BANDS, DEFAULT_TILE_SIZE
+from gen_dat_files import get_block_windows
+from image_reader import ImageReader
+from vi_expressions import compile_vis, valid_mask
+from vi_writers import get_writer
+from zonal_stats import open_plot_stats, close_plot_stats
+from pipeline_metrics import NULL_INSTRUMENTATION
+
+# per worker process state, kept between work units so every image is opened (and every program compiled) once
+# and the windows of an image are read into the same buffer
+_worker_readers = {}
+_worker_programs = {}
+_WORKER_MAX_OPEN = 4
+
+
+def _compute_window(image_file, img_type, vis_list, window, params = None, use_vmem = False):
+    """    Work unit executed in the pool: reads one window of an image and computes the selected VIs
+
+           Returns:
+            vi_rasters (dict)       : VI name -> numpy array of the window
+            alpha (numpy array)     : Alpha band of the window, None for MULTI images
+            timings (dict)          : Seconds spent in the read and compute stages, bytes read
+    """
+    reader = _worker_readers.get(image_file)
+    if reader is None:
+        if len(_worker_readers) >= _WORKER_MAX_OPEN:
+            for r in _worker_readers.values():
+                r.close() # releases the dataset (and the memory maps with use_vmem) before the references are dropped
+            _worker_readers.clear()
+        reader = _worker_readers[image_file] = ImageReader(image_file, RGB_BANDS if img_type == 'RGB' else MULTI_BANDS,
+                                                           use_vmem, native = True)
+
+    program = _worker_programs.get((img_type, tuple(vis_list)))
+    if program is None:
+        program = _worker_programs[(img_type, tuple(vis_list))] = compile_vis(img_type, vis_list)
+
+    start = time.perf_counter()
+    bands = reader.read(window) # the result is pickled before the next unit overwrites the buffer
+    read_done = time.perf_counter()
+    vi_rasters = program.evaluate(bands, params, valid_mask(bands, reader.band_nodata))
+    timings = {'read': read_done - start, 'compute': time.perf_counter() - read_done,
+               'bytes_read': sum(b.nbytes for b in bands.values())}
+    return vi_rasters, bands.get('alpha'), timings
+
+def get_dat_for_vi_parallel(image_files, out_dir, img_type, vis_list, tile_size = DEFAULT_TILE_SIZE, workers = None,
+                            max_in_flight = None, mp_context = None, out_format = 'ENVI', writer_options = None,
+                            shp_file = None, epsg = None, write_rasters = True, metrics = None, params = None,
+                            use_vmem = False):
+    """    Generates the .dat files for the given Vegitation Indecies (VIs) using a pool of worker processes
+
+           Args:
+            image_files (list(str)) : List of image filenames for all orthomosaic images to be processed
+            out_dir (str)           : The directory to which the results will be saved
+            img_type (str)          : Type of images to be processed: RGB or MULTI
+            vis_list (list(str))    : List of VIs to be generated for the orthomosaic(s)
+            tile_size (int)         : Target edge of a window in pixels (default is DEFAULT_TILE_SIZE)
+            workers (int)           : Number of worker processes (default is os.cpu_count())
+            max_in_flight (int)     : Maximum number of submitted but unwritten windows (default is workers + 2)
+            mp_context (context)    : multiprocessing context used to start the workers (default is the platform default)
+            out_format (str)        : Output format, one of vi_writers.WRITERS (default is ENVI)
+            writer_options (dict)   : Options of the output writer (default is None)
+            shp_file (str)          : If set, also accumulate the per plot statistics of the VIs (default is None)
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            write_rasters (bool)    : Write the VI rasters (default is True)
+            metrics (Instrumentation): Receives the stage timers (summed over the workers), counters and progress (default is None)
+            params (dict)           : Values overriding vi_expressions.VI_PARAMETERS (default is None)
+            use_vmem (bool)         : Read raw images through memory-mapped views in the workers (see image_reader)
+                                      (default is False)
+
+           Returns:
+            report (dict)           : Throughput of the run: workers, pixels, seconds, mpix_per_s,
+                                      images, a list with the same values (plus windows) per image and
+                                      zonal, image filename -> per plot statistics (empty without shp_file)
+    """
+    metrics = metrics or NULL_INSTRUMENTATION
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers + 2
+    program = compile_vis(img_type, vis_list)
+    run_start = time.perf_counter()
+    if not program.vis:
+        return {'workers': workers, 'pixels': 0, 'seconds': 0.0, 'mpix_per_s': 0.0, 'images': [], 'zonal': {}}
+
+    # one job per image, opened only to get its grid and windows
+    jobs = []
+    for f in image_files:
+        in_ds = gdal.Open(f)
+        jobs.append({
+            'file'          : f,
+            'filename'      : os.path.splitext(os.path.basename(f))[0][:][0:8],
+            'x_size'        : in_ds.RasterXSize,
+            'y_size'        : in_ds.RasterYSize,
+            'geo_transform' : in_ds.GetGeoTransform(),
+            'geo_proj'      : in_ds.GetProjection(),
+            'windows'       : get_block_windows(in_ds, tile_size),
+            'writer'        : None,
+            'labels'        : None,
+            'plot_stats'    : None,
+            'remaining'     : 0,
+            'start'         : None,
+            'seconds'       : None,
+        })
+        jobs[-1]['remaining'] = len(jobs[-1]['windows'])
+        metrics.plan(in_ds.RasterXSize * in_ds.RasterYSize)
+        in_ds = None
+
+    units = iter([(j, window) for j in range(len(jobs)) for window in jobs[j]['windows']])
+    pending = {}
+    zonal = {}
+    with ProcessPoolExecutor(max_workers = workers, mp_context = mp_context) as pool:
+        try:
+            while True:
+                # keep at most max_in_flight work units submitted
+                while len(pending) < max_in_flight:
+                    unit = next(units, None)
+                    if unit is None:
+                        break
+                    job = jobs[unit[0]]
+                    if job['start'] is None: # outputs of an image are opened with its first window
+                        job['start'] = time.perf_counter()
+                        if write_rasters:
+                            job['writer'] = get_writer(out_format, out_dir, job['filename'], img_type, program.vis, job['x_size'],
+                                                       job['y_size'], job['geo_transform'], job['geo_proj'], **(writer_options or {}))
+                        if shp_file:
+                            job['labels'], job['plot_stats'] = open_plot_stats(shp_file, program.vis, job['x_size'], job['y_size'],
+                                                                               job['geo_transform'], job['geo_proj'], epsg)
+                    pending[pool.submit(_compute_window, job['file'], img_type, program.vis, unit[1], params,
+                                        use_vmem)] = unit
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                for fut in done:
+                    j, window = pending.pop(fut)
+                    vi_rasters, alpha, timings = fut.result()
+                    job = jobs[j]
+                    metrics.add_time('read', timings['read'])
+                    metrics.add_time('compute', timings['compute'])
+                    metrics.count('bytes_read', timings['bytes_read'])
+                    if job['writer'] is not None:
+                        with metrics.stage('write'):
+                            job['writer'].write(window, vi_rasters, alpha)
+                        metrics.count('bytes_written', sum(v.nbytes for v in vi_rasters.values()))
+                    if job['plot_stats'] is not None:
+                        with metrics.stage('zonal'):
+                            job['plot_stats'].add(job['labels'].read(window), vi_rasters)
+                    metrics.progress(window[2] * window[3], job['file'])
+                    job['remaining'] -= 1
+                    if job['remaining'] == 0: # last window of the image: close (flush) its outputs
+                        with metrics.stage('close'):
+                            if job['writer'] is not None:
+                                job['writer'].close()
+                            if job['plot_stats'] is not None:
+                                zonal[job['file']] = close_plot_stats(out_dir, job['filename'], job['labels'], job['plot_stats'])
+                        job['writer'] = None; job['labels'] = None; job['plot_stats'] = None
+                        metrics.event('image_done', image = job['file'])
+                        job['seconds'] = time.perf_counter() - job['start']
+        except BaseException:
+            for fut in pending:
+                fut.cancel()
+            # images still open were cancelled or failed mid-image: no open datasets or partial outputs are left behind
+            for job in jobs:
+                if job['writer'] is not None:
+                    job['writer'].abort()
+                if job['labels'] is not None:
+                    job['labels'].release()
+            raise
+
+    images = []
+    for job in jobs:
+        pixels = job['x_size'] * job['y_size']
+        seconds = job['seconds'] or 0.0
+        images.append({
+            'image'      : job['file'],
+            'windows'    : len(job['windows']),
+            'pixels'     : pixels,
+            'seconds'    : seconds,
+            'mpix_per_s' : pixels / seconds / 1e6 if seconds > 0 else 0.0,
+        })
+    # images overlap in time, so the run throughput uses the wall time of the whole run
+    pixels = sum(r['pixels'] for r in images)
+    seconds = time.perf_counter() - run_start
+    return {
+        'workers'    : workers,
+        'pixels'     : pixels,
+        'seconds'    : seconds,
+        'mpix_per_s' : pixels / seconds / 1e6 if seconds > 0 else 0.0,
+        'images'     : images,
+        'zonal'      : zonal,
+    }
+
+def format_throughput_report(report):
+    """    Formats the report returned by get_dat_for_vi_parallel as a table
+
+           Args:
+            report (dict)           : Throughput of the run
+
+           Returns:
+            text (str)              : One line per image and a total line
+    """
+    lines = [f'{"image":<40} {"windows":>8} {"MPix":>10} {"seconds":>10} {"MPix/s":>10}']
+    for r in report['images']:
+        lines.append(f'{os.path.basename(r["image"]):<40} {r["windows"]:>8} {r["pixels"] / 1e6:>10.1f} {r["seconds"]:>10.2f} {r["mpix_per_s"]:>10.1f}')
+    windows = sum(r['windows'] for r in report['images'])
+    lines.append(f'{"total (" + str(report["workers"]) + " workers)":<40} {windows:>8} {report["pixels"] / 1e6:>10.1f} '
+                 f'{report["seconds"]:>10.2f} {report["mpix_per_s"]:>10.1f}')
+    return '\n'.join(lines)
@@ -0,0 +1,222 @@
+"""
+Generating the .dat files with overlapped I/O
+Three stages connected by bounded queues, so the disk and the CPU work at the same time:
+    reader  (thread)        : reads the windows of all images, one after the other, into buffers of a small pool
+    compute (calling thread): evaluates the VI program on every window
+    writer  (thread)        : writes the windows and accumulates the plot statistics, then returns the buffer to the pool
+GDAL releases the GIL while it reads and writes, and numpy while it computes, so the read of the next window
+(or the next image) overlaps the compute of the current one and the write of the previous one. The queues and the
+pool bound the memory to 2 * queue_depth + 3 windows.
+"""
+import os
+import queue
+import threading
+import numpy as np
+from gen_dat_files import RGB_BANDS, MULTI_BANDS, DEFAULT_TILE_SIZE, get_block_windows
+from image_reader import ImageReader
+from vi_expressions import compile_vis, valid_mask
+from vi_writers import get_writer
+from zonal_stats import open_plot_stats, close_plot_stats
+from pipeline_metrics import NULL_INSTRUMENTATION
+
+_END = object() # last item of a queue
+
+
+class _Stop(Exception):
+    # raised in a stage when another stage failed
+    pass
+
+
+class _Pipeline:
+    """    State shared by the stages: the queues, the pool of read buffers and the first error
+    """
+    def __init__(self, queue_depth):
+        self.read_queue = queue.Queue(queue_depth)
+        self.write_queue = queue.Queue(queue_depth)
+        self.buffers = queue.Queue()        # free read buffers, reused or dropped by shape and type
+        self.n_buffers = 2 * queue_depth + 3 # read + compute + write in progress, plus the queued windows
+        self.created = 0
+        self.error = None
+        self.failed = threading.Event()
+
+    def put(self, q, item):
+        while True:
+            if self.failed.is_set():
+                raise _Stop()
+            try:
+                q.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, q):
+        while True:
+            if self.failed.is_set():
+                raise _Stop()
+            try:
+                return q.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+
+    def take_buffer(self, shape, dtype):
+        # a free buffer of the right shape and type, a new one while the pool isn't full, otherwise wait for one
+        while True:
+            try:
+                buf = self.buffers.get_nowait()
+            except queue.Empty:
+                if self.created < self.n_buffers:
+                    self.created += 1
+                    return np.empty(shape, dtype)
+                buf = self.get(self.buffers)
+            if buf.shape == shape and buf.dtype == dtype:
+                return buf
+            self.created -= 1 # window of another size (image edge or next image) or type, drop it
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.failed.set()
+
+
+def _read_stage(pipe, image_files, band_names, tile_size, metrics, use_vmem = False):
+    try:
+        for f in image_files:
+            with metrics.stage('open'):
+                reader = ImageReader(f, band_names, use_vmem, native = True)
+            windows = get_block_windows(reader.ds, tile_size)
+            pipe.put(pipe.read_queue, ('image', f, reader, len(windows)))
+            for window in windows:
+                buf = pipe.take_buffer((len(reader.band_names), window[3], window[2]), reader.dtype)
+                with metrics.stage('read'):
+                    bands = reader.read(window, out = buf)
+                metrics.count('bytes_read', buf.nbytes)
+                pipe.put(pipe.read_queue, ('window', f, window, buf, bands))
+            reader.close()
+        pipe.put(pipe.read_queue, _END)
+    except _Stop:
+        pass
+    except BaseException as e:
+        pipe.fail(e)
+
+def _write_stage(pipe, out_dir, img_type, vis, out_format, writer_options, shp_file, epsg, write_rasters, metrics, zonal):
+    outputs = {}
+    try:
+        while True:
+            item = pipe.get(pipe.write_queue)
+            if item is _END:
+                break
+            if item[0] == 'image':
+                _, f, grid, n_windows = item
+                filename = os.path.splitext(os.path.basename(f))[0][:][0:8]
+                writer = labels = plot_stats = None
+                with metrics.stage('open'):
+                    if write_rasters:
+                        writer = get_writer(out_format, out_dir, filename, img_type, vis, *grid, **(writer_options or {}))
+                if shp_file:
+                    with metrics.stage('rasterize'):
+                        labels, plot_stats = open_plot_stats(shp_file, vis, *grid, epsg)
+                outputs[f] = [filename, writer, labels, plot_stats, n_windows]
+                continue
+
+            _, f, window, buf, bands, vi_rasters = item
+            filename, writer, labels, plot_stats, _ = outputs[f]
+            if writer is not None:
+                with metrics.stage('write'):
+                    writer.write(window, vi_rasters, bands.get('alpha'))
+                metrics.count('bytes_written', sum(v.nbytes for v in vi_rasters.values()))
+            if plot_stats is not None:
+                with metrics.stage('zonal'):
+                    plot_stats.add(labels.read(window), vi_rasters)
+            pipe.buffers.put(buf)
+            metrics.progress(window[2] * window[3], f)
+
+            outputs[f][4] -= 1
+            if outputs[f][4] == 0: # last window of the image: close (flush) its outputs
+                with metrics.stage('close'):
+                    if writer is not None:
+                        writer.close()
+                    if plot_stats is not None:
+                        zonal[f] = close_plot_stats(out_dir, filename, labels, plot_stats)
+                del outputs[f]
+                metrics.event('image_done', image = f)
+    except _Stop:
+        pass
+    except BaseException as e:
+        pipe.fail(e)
+    finally:
+        # images still open were cancelled or failed mid-image: no open datasets or partial outputs are left behind
+        for filename, writer, labels, plot_stats, _ in outputs.values():
+            if writer is not None:
+                writer.abort()
+            if labels is not None:
+                labels.release()
+
+def get_dat_for_vi_pipelined(image_files, out_dir, img_type, vis_list, tile_size = DEFAULT_TILE_SIZE, queue_depth = 2,
+                             out_format = 'ENVI', writer_options = None, shp_file = None, epsg = None,
+                             write_rasters = True, metrics = None, params = None, use_vmem = False):
+    """    Generates the .dat files for the given Vegitation Indecies (VIs) with the reads, the compute and the writes
+           of the windows overlapped (see the module docstring). The outputs are the same as get_dat_for_vi_tiled.
+
+           Args:
+            image_files (list(str)) : List of image filenames for all orthomosaic images to be processed
+            out_dir (str)           : The directory to which the results will be saved
+            img_type (str)          : Type of images to be processed: RGB or MULTI
+            vis_list (list(str))    : List of VIs to be generated for the orthomosaic(s)
+            tile_size (int)         : Target edge of a window in pixels (default is DEFAULT_TILE_SIZE)
+            queue_depth (int)       : Windows waiting between two stages (default is 2)
+            out_format (str)        : Output format, one of vi_writers.WRITERS (default is ENVI)
+            writer_options (dict)   : Options of the output writer (default is None)
+            shp_file (str)          : If set, also accumulate the per plot statistics of the VIs (default is None)
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            write_rasters (bool)    : Write the VI rasters (default is True)
+            metrics (Instrumentation): Receives the stage timers, counters and progress (default is None)
+            params (dict)           : Values overriding vi_expressions.VI_PARAMETERS (default is None)
+            use_vmem (bool)         : Read raw images through memory-mapped views (see image_reader) (default is False)
+
+           Returns:
+            zonal (dict)            : Image filename -> per plot statistics, empty without shp_file
+    """
+    metrics = metrics or NULL_INSTRUMENTATION
+    band_names = RGB_BANDS if img_type == 'RGB' else MULTI_BANDS
+    program = compile_vis(img_type, vis_list)
+    zonal = {}
+    if not program.vis:
+        return zonal
+
+    pipe = _Pipeline(queue_depth)
+    reader_thread = threading.Thread(target = _read_stage, args = (pipe, image_files, band_names, tile_size, metrics, use_vmem),
+                                     name = 'vi-reader', daemon = True)
+    writer_thread = threading.Thread(target = _write_stage, name = 'vi-writer', daemon = True,
+                                     args = (pipe, out_dir, img_type, program.vis, out_format, writer_options,
+                                             shp_file, epsg, write_rasters, metrics, zonal))
+    reader_thread.start()
+    writer_thread.start()
+    try:
+        band_nodata = {}
+        while True:
+            item = pipe.get(pipe.read_queue)
+            if item is _END:
+                pipe.put(pipe.write_queue, _END)
+                break
+            if item[0] == 'image':
+                _, f, reader, n_windows = item
+                band_nodata = reader.band_nodata
+                metrics.plan(reader.x_size * reader.y_size)
+                grid = (reader.x_size, reader.y_size, reader.transform, reader.proj)
+                pipe.put(pipe.write_queue, ('image', f, grid, n_windows))
+                continue
+            _, f, window, buf, bands = item
+            with metrics.stage('compute'):
+                vi_rasters = program.evaluate(bands, params, valid_mask(bands, band_nodata))
+            pipe.put(pipe.write_queue, ('window', f, window, buf, bands, vi_rasters))
+    except _Stop:
+        pass
+    except BaseException as e:
+        pipe.fail(e)
+    finally:
+        reader_thread.join()
+        writer_thread.join()
+
+    if pipe.error is not None:
+        raise pipe.error
+    return zonal
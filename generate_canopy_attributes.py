@@ -12,11 +12,12 @@ import glob
 import tkinter as tk
 from   tkinter            import *
 from   tkinter.filedialog import askopenfilename, askdirectory
-from   threading          import *
-from   gen_dat_files      import get_dat_for_vi       # RGB VIs: exg, grvi, mgrvi, rgbvi, exgr
-from   gen_vi_boundary    import get_boundary_for_vi  # MULTI VIs: ndvi, ndre, gndvi, savi, osavi, msavi, gci, reci, grvi
-from   gen_ch_boundry     import get_ch_boundary
-from   gen_cv_boundary    import get_cv_boundary
+from   generate_canopy_attributes_cli import check_job, run_job # same processing as the command line, in queued jobs
+from   gen_dat_files      import DEFAULT_TILE_SIZE
+from   job_manager        import JobManager, DONE, FAILED, CANCELLED
+from   pipeline_metrics   import format_progress
+from   vi_expressions     import VI_PARAMETERS
+from   vi_preview         import PreviewSource, to_ppm    # quick looks at reduced resolution, e.g. to tune th1, th2, th3
 
 #TODO: add command for radio buttons to clear the lbl_msg values
 #TODO: find a way to list all available EPSG values insted of only having the two we use
@@ -43,25 +44,15 @@ multi_vi_chk_box_var   = [tk.IntVar() for i in range(len(multi_vis))]
 files                  = []
 chm_files              = []
 
+vi_params              = dict(VI_PARAMETERS)          # cc thresholds, tuned in the preview window
+
 widgets_width          = 25
 widgets_height         = 3
 
-def upload_img_threading():
-    t1 = Thread(target = upload_img)
-    t1.start()
-
-def upload_shp_threading():
-    t1 = Thread(target = upload_shp)
-    t1.start()
-
-def upload_chm_threading():
-    t1 = Thread(target = upload_chm)
-    t1.start()
-
-def generate_results_threading():
-    t1 = Thread(target = generate_results)
-    t1.start()
-
+job_manager            = JobManager(max_running = 1)  # queued jobs run one after the other
+poll_interval_ms       = 100
+close_timeout_ms       = 10000                        # wait for the cancelled jobs at most this long on close
+lst_jobs_ids           = []                           # job id of every line of lst_jobs
 
 def upload_img():
 
@@ -101,11 +92,12 @@ def upload_shp():
     lbl_msg["text"] = f'Uploaded the SHP file \n {shp_filename}'
 
 def upload_chm():
+    global chm_files # CHMs of chm_dir, enable the ch and cv options
     chm_dir.set(askdirectory())
-    chm_files = glob.glob(os.path.join(chm_dir.get(), '*.tif'))
+    chm_files = sorted(glob.glob(os.path.join(chm_dir.get(), '*.tif')))
 
     # add processing options related to CHM (ch and cv) to the processing list
-    if len(chm_files) and rd_btn_var.get() == 'RGB':
+    if len(chm_files) and rd_btn_var.get() == 'RGB' and 'ch' not in rgb_vis:
         rgb_vis.append('ch')
         rgb_vis.append('cv')
         set_processing_options()
@@ -139,50 +131,128 @@ def check_inputs(): #TODO : also check for the target options
 def check_optional_inputs():
     return
 
+def selected_vis():
+    if rd_btn_var.get() == 'RGB':
+        return [rgb_vis[i] for i in range(len(rgb_vis)) if rgb_vi_chk_box_var[i].get() != 0]
+    return [multi_vis[i] for i in range(len(multi_vis)) if multi_vi_chk_box_var[i].get() != 0]
+
 def generate_results():
     if not check_inputs():
         return
 
-    # rgb processing
-    if rd_btn_var.get() == 'RGB':
-        vis_to_process = []
-        for i in range(len(rgb_vis)):
-            if rgb_vi_chk_box_var[i].get() != 0 and (rgb_vis[i] != 'ch' or rgb_vis[i] != 'cv'): #TODO: fix condition
-                vis_to_process.append(rgb_vis[i])
-
-            if rgb_vi_chk_box_var[i].get() != 0 and rgb_vis[i] == 'ch':
-                get_ch_boundary(epsg_val, shp_file.get(), chm_files, results_dir.get())
-
-            if rgb_vi_chk_box_var[i].get() != 0 and rgb_vis[i] == 'cv':
-                get_cv_boundary(epsg_val, shp_file.get(), chm_files, results_dir.get())
-
-        get_dat_for_vi(files, results_dir.get(), rd_btn_var.get(), vis_to_process)
-
-        lbl_msg["text"] = f'Generated RGB dat files'
-
-    # multi processing
-    if rd_btn_var.get() == 'MULTI':
-        vis_to_process = []
-        for i in range(len(multi_vis)):
-            if multi_vi_chk_box_var[i].get() != 0:
-                vis_to_process.append(multi_vis[i])
-        get_dat_for_vi(files, results_dir.get(), rd_btn_var.get(), vis_to_process)
-        lbl_msg["text"] = f'Generated MULTI dat files'
-
-    if len(shp_file.get()) != 0:
-        if epsg_var.get() == "13N":
-            epsg_val = epsg_13
-        elif epsg_var.get() == "14N":
-            epsg_val = epsg_14
-        else:
-            lbl_msg["text"] = f'Set EPSG value'
-            return
+    # the inputs are read here, in the Tk main loop: the job works on this copy, the widgets can change meanwhile
+    job_args = dict(images    = list(files),
+                    out_dir   = results_dir.get(),
+                    img_type  = rd_btn_var.get(),
+                    vis       = selected_vis(),
+                    shp_file  = shp_file.get() or None,
+                    epsg      = epsg_var.get() if shp_file.get() else None,
+                    chm_dir   = chm_dir.get() or None,
+                    params    = dict(vi_params),
+                    tile_size = DEFAULT_TILE_SIZE) # window by window, so a cancel stops the job at its next window
+    try:
+        check_job(**job_args)
+    except ValueError as e:
+        lbl_msg["text"] = str(e)
+        return
 
-        # get_cc_boundary(epsg_val, shp_file.get(), results_dir.get())
-        get_boundary_for_vi(epsg_val, shp_file.get(), results_dir.get(), vis_to_process)
-        lbl_msg["text"] = f'Generated shapefile(s)'
+    name = f'{job_args["img_type"]} {", ".join(job_args["vis"])}'
+    job = job_manager.submit(name, run_job, cache = True, **job_args) # re-runs only compute the missing outputs
+    lbl_msg["text"] = f'Queued job #{job.id} \n {name}'
+
+def cancel_jobs():
+    # cancels the jobs selected in the list, all of them when none is selected
+    selected = [lst_jobs_ids[i] for i in lst_jobs.curselection()]
+    for job in job_manager.active():
+        if not selected or job.id in selected:
+            job_manager.cancel(job)
+
+def refresh_job_list():
+    lst_jobs.delete(0, tk.END)
+    lst_jobs_ids.clear()
+    for job in job_manager.jobs[-20:]:
+        lst_jobs.insert(tk.END, str(job))
+        lst_jobs_ids.append(job.id)
+
+def poll_jobs():
+    # progress and state changes of the jobs, posted by the worker threads, shown from the Tk main loop
+    events = job_manager.poll()
+    for job, event in events:
+        if event['event'] == 'progress':
+            current = os.path.basename(event['current'] or '')
+            lbl_msg["text"] = f'#{job.id} {current} \n {format_progress(event)}'
+        elif event['event'] != 'state': # e.g. the throughput reports of the parallel path
+            continue
+        elif event['state'] == DONE:
+            lbl_msg["text"] = f'#{job.id} done \n' + '\n'.join(job.result or [])
+        elif event['state'] == FAILED:
+            lbl_msg["text"] = f'#{job.id} failed \n {job.error}'
+        elif event['state'] == CANCELLED:
+            lbl_msg["text"] = f'#{job.id} cancelled'
+    if any(event['event'] == 'state' for _, event in events):
+        refresh_job_list()
+    window.after(poll_interval_ms, poll_jobs)
+
+def close_window():
+    # the jobs are cancelled, the window waits for the running ones (they stop at their next window and remove their
+    # partial outputs) from the Tk main loop, so it doesn't freeze, and closes after close_timeout_ms at the latest
+    window.protocol("WM_DELETE_WINDOW", lambda: None)
+    job_manager.cancel_all()
+    lbl_msg["text"] = 'Closing: cancelling the jobs'
+    wait_for_jobs(close_timeout_ms)
+
+def wait_for_jobs(remaining_ms):
+    if job_manager.active() and remaining_ms > 0:
+        window.after(poll_interval_ms, wait_for_jobs, remaining_ms - poll_interval_ms)
+    else:
+        window.destroy()
+
+def load_preview(image_file, img_type, metrics = None):
+    return PreviewSource(image_file, img_type)
+
+def show_preview():
+    if len(files) == 0 or rd_btn_var.get() == 'x':
+        lbl_msg["text"] = "Upload image(s) \nSelect image type\nto preview the VIs ..."
+        return
 
-    lbl_msg["text"] = f'Done processing selected \noptions ...'
+    if rd_btn_var.get() == 'RGB':
+        vis = [rgb_vis[i] for i in range(len(rgb_vis)) if rgb_vis[i] not in ('ch', 'cv')]
+    else:
+        vis = list(multi_vis)
+
+    # the decimated bands are read in a job, the window opens once they are loaded
+    job_manager.submit(f'preview {os.path.basename(files[-1])}', load_preview, files[-1], rd_btn_var.get(),
+                       on_done = lambda job: open_preview(job.result, vis))
+    lbl_msg["text"] = 'Loading the preview ...'
+
+def open_preview(source, vis):
+    lbl_msg["text"] = f'Preview from the {source.source} \n {os.path.basename(source.image_file)}'
+
+    preview = tk.Toplevel(window)
+    preview.title("VI Preview")
+    vi_var = tk.StringVar(value = 'cc' if 'cc' in vis else vis[0])
+    lbl_image = tk.Label(master = preview)
+
+    def refresh(*_):
+        raster = source.evaluate([vi_var.get()], vi_params)[vi_var.get()]
+        lbl_image.image = tk.PhotoImage(data = to_ppm(raster), format = 'PPM') # keep a reference, Tk doesn't
+        lbl_image["image"] = lbl_image.image
+
+    def set_param(name, value):
+        vi_params[name] = float(value)
+        if vi_var.get() == 'cc':
+            refresh()
+
+    tk.OptionMenu(preview, vi_var, *vis, command = refresh).grid(row = 0, column = 0, sticky = "ew")
+    ranges = {'th1': (0.5, 1.5, 0.01), 'th2': (0.5, 1.5, 0.01), 'th3': (0, 100, 1)}
+    for k, (name, (lo, hi, step)) in enumerate(ranges.items()):
+        scale = tk.Scale(master = preview, label = f'cc {name}', from_ = lo, to = hi, resolution = step,
+                         orient = tk.HORIZONTAL, length = 300,
+                         command = lambda value, name = name: set_param(name, value))
+        scale.set(vi_params[name])
+        scale.grid(row = k + 1, column = 0, sticky = "ew")
+    lbl_image.grid(row = len(ranges) + 1, column = 0)
+    refresh()
 
 
 window.title("Data Processing GUI")
@@ -233,7 +303,7 @@ btn_upload_img = tk.Button(
                     height = widgets_height,
                     bg     = "gainsboro",
                     fg     = "black",
-                    command= upload_img_threading
+                    command= upload_img
 )
 
 btn_delete_img = tk.Button(
@@ -299,7 +369,7 @@ btn_upload_shp = tk.Button(
                     height = widgets_height,
                     bg     = "gainsboro",
                     fg     = "black",
-                    command= upload_shp_threading
+                    command= upload_shp
 )
 
 btn_upload_chm = tk.Button(
@@ -309,7 +379,7 @@ btn_upload_chm = tk.Button(
                     height = widgets_height,
                     bg     = "gainsboro",
                     fg     = "black",
-                    command= upload_chm_threading
+                    command= upload_chm
 )
 
 txt_set_epsg = tk.Entry(
@@ -336,7 +406,34 @@ btn_gen_attributes = tk.Button(
                     height = widgets_height,
                     bg     = "gainsboro",
                     fg     = "black",
-                    command = generate_results_threading
+                    command = generate_results
+)
+
+btn_preview = tk.Button(
+                    master = right_pannel,
+                    text   = "Preview",
+                    width  = widgets_width,
+                    height = 1,
+                    bg     = "gainsboro",
+                    fg     = "black",
+                    command = show_preview
+)
+
+lst_jobs = tk.Listbox(
+                    master = right_pannel,
+                    width  = widgets_width,
+                    height = 4,
+                    selectmode = tk.EXTENDED
+)
+
+btn_cancel_jobs = tk.Button(
+                    master = right_pannel,
+                    text   = "Cancel Job(s)",
+                    width  = widgets_width,
+                    height = 1,
+                    bg     = "gainsboro",
+                    fg     = "black",
+                    command = cancel_jobs
 )
 
 lbl_msg = tk.Label(
@@ -372,15 +469,20 @@ lbl_select_img_type.grid    (row=0, column=0, sticky="ew")
 rd_btn_rgb.grid             (row=1, column=0, sticky="ew")
 rd_btn_multi.grid           (row=2, column=0, sticky="ew")
 
-# right pannel has the lbl_select_outputs, chk_box_pannel, btn_gen_attributes, lbl_msg
+# right pannel has the lbl_select_outputs, chk_box_pannel, btn_gen_attributes, btn_preview, lst_jobs, btn_cancel_jobs, lbl_msg
 right_pannel.grid       (row=0, column=1, sticky="ew", padx=5)
 lbl_select_outputs.grid (row=0, column=0, sticky="ew")
 chk_box_pannel.grid     (row=1, column=0, sticky="ew")
 btn_gen_attributes.grid (row=2, column=0, sticky="ew")
-lbl_msg.grid            (row=3, column=0, sticky="ew", pady=50)
+btn_preview.grid        (row=3, column=0, sticky="ew")
+lst_jobs.grid           (row=4, column=0, sticky="ew", pady=(10, 0))
+btn_cancel_jobs.grid    (row=5, column=0, sticky="ew")
+lbl_msg.grid            (row=6, column=0, sticky="ew", pady=30)
 
 txt_set_epsg.insert(INSERT, "Set EPSG 13N for Amarillo 14N Else")
 rd_btn_rgb.deselect()
 rd_btn_multi.deselect()
 
+window.protocol("WM_DELETE_WINDOW", close_window)
+window.after(poll_interval_ms, poll_jobs)
 window.mainloop()
@@ -0,0 +1,389 @@
+"""
+Command line (headless) entry point to generate canopy attributes, the same processing as the GUI without tkinter.
+Can be used as a script or imported (run_job / run_manifest).
+
+    python generate_canopy_attributes_cli.py --images a.tif b.tif --out-dir results --type RGB --vis exg cc \
+        --shp plots.shp --epsg 14N --chm-dir chms
+    python generate_canopy_attributes_cli.py --manifest jobs.json
+
+A manifest is a JSON file {"defaults": {...}, "jobs": [{...}, ...]} (or just the list of jobs), every job has the
+keyword arguments of run_job, the defaults are applied to every job. The jobs run back to back in the same process.
+GDAL, rs2 and the processing modules are only imported when the first job runs.
+--progress prints the progress (done %, MPix/s, ETA) and, with --workers, the throughput of every image, and
+--metrics-log appends every progress event, the throughput reports and the stage timers of the run as JSON lines to
+a file (see pipeline_metrics).
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+EPSG_VALUES = {'13N': 32613, '14N': 32614} # same zones as the GUI: 13N for Amarillo 14N Else
+IMG_TYPES   = ['RGB', 'MULTI']
+CHM_OPTIONS = ['ch', 'cv']                 # RGB options computed from the canopy height models
+CC_STORAGES = ['bit', 'uint8']             # storage of the cc masks of the canopy cover path (canopy_cover.CC_STORAGE)
+ATTRIBUTE_FORMATS = ['.gpkg', '.shp']      # outputs of the batched plot attributes (plot_attributes.DRIVERS)
+
+
+def parse_epsg(epsg):
+    """    Converts an EPSG value given as a UTM zone (13N, 14N) or a number to an int, None stays None
+    """
+    if epsg is None or epsg == '':
+        return None
+    if str(epsg).upper() in EPSG_VALUES:
+        return EPSG_VALUES[str(epsg).upper()]
+    try:
+        return int(epsg)
+    except ValueError:
+        raise ValueError(f'Unknown EPSG value: {epsg}') from None
+
+def parse_params(values):
+    """    Converts NAME=VALUE strings (e.g. th1=0.9) to a dict of VI parameters, None for no values
+    """
+    if not values:
+        return None
+    params = {}
+    for value in values:
+        name, sep, number = value.partition('=')
+        try:
+            if not sep:
+                raise ValueError
+            params[name.strip()] = float(number)
+        except ValueError:
+            raise ValueError(f'VI parameters are given as NAME=VALUE, got {value}') from None
+    return params
+
+def check_job(images, out_dir, img_type, vis, shp_file = None, epsg = None, chm_dir = None, out_format = 'ENVI',
+              zonal = False, write_rasters = True, time_series = None, params = None, cc_storage = None, attributes = None,
+              update_attributes = False):
+    """    Validates the inputs of a job before anything heavy is imported
+
+           Returns:
+            none, raises ValueError describing the first problem found
+    """
+    from vi_expressions import VI_PARAMETERS, get_vi_names
+
+    if not images:
+        raise ValueError('No images to process')
+    for f in images:
+        if not os.path.isfile(f):
+            raise ValueError(f'Image not found: {f}')
+    if not out_dir:
+        raise ValueError('No output folder')
+    if img_type not in IMG_TYPES:
+        raise ValueError(f'Image type must be one of {IMG_TYPES}, got {img_type}')
+    options = get_vi_names(img_type) + (CHM_OPTIONS if img_type == 'RGB' else [])
+    unknown = [vi for vi in vis if vi not in options]
+    if unknown:
+        raise ValueError(f'Unknown {img_type} options: {unknown}, expected some of {options}')
+    if shp_file and parse_epsg(epsg) is None:
+        raise ValueError('Set EPSG value')
+    if shp_file and not zonal and out_format != 'ENVI':
+        raise ValueError('The boundary (shp) step reads the ENVI .dat files, use the ENVI format or zonal')
+    if zonal and not shp_file:
+        raise ValueError('zonal needs a boundary (shp) file')
+    if not write_rasters and not zonal and not time_series and not (cc_storage and shp_file):
+        raise ValueError('Without the VI rasters only the zonal statistics, the time series or the plot cover can be generated')
+    if time_series and not shp_file:
+        raise ValueError('time_series needs a boundary (shp) file')
+    unknown = [name for name in (params or {}) if name not in VI_PARAMETERS]
+    if unknown:
+        raise ValueError(f'Unknown VI parameters: {unknown}, expected some of {list(VI_PARAMETERS)}')
+    if cc_storage is not None:
+        if cc_storage not in CC_STORAGES:
+            raise ValueError(f'cc storage must be one of {CC_STORAGES}, got {cc_storage}')
+        if img_type != 'RGB' or 'cc' not in vis:
+            raise ValueError('cc_storage applies to cc of RGB images')
+        others = [vi for vi in vis if vi != 'cc' and vi not in CHM_OPTIONS]
+        if others and not write_rasters and not zonal and not time_series:
+            raise ValueError(f'Without the VI rasters, zonal or the time series only the cc plot cover is generated, '
+                             f'{others} would be skipped: add zonal or time_series, or write the rasters')
+    if attributes:
+        if os.path.splitext(attributes)[1].lower() not in ATTRIBUTE_FORMATS:
+            raise ValueError(f'The plot attributes are written to a {" or ".join(ATTRIBUTE_FORMATS)} file, got {attributes}')
+        if not shp_file or not (zonal or cc_storage):
+            raise ValueError('attributes collects the per plot statistics of zonal or cc_storage, with a boundary (shp) file')
+    if update_attributes and not attributes:
+        raise ValueError('update_attributes needs an attributes file')
+    if any(vi in CHM_OPTIONS for vi in vis):
+        if not chm_dir or not os.path.isdir(chm_dir):
+            raise ValueError('ch and cv need a CHM folder')
+        if not shp_file:
+            raise ValueError('ch and cv need a boundary (shp) file')
+
+def run_job(images, out_dir, img_type, vis, shp_file = None, epsg = None, chm_dir = None, tile_size = None, workers = None,
+            out_format = 'ENVI', writer_options = None, zonal = False, write_rasters = True, cache = False,
+            cache_dir = None, cache_max_gb = None, force = False, metrics = None, pipelined = False, time_series = None,
+            params = None, preview = False, cc_storage = None, attributes = None, update_attributes = False,
+            use_vmem = False):
+    """    Generates the canopy attributes for a set of orthomosaics
+
+           Args:
+            images (list(str))      : List of image filenames for all orthomosaic images to be processed
+            out_dir (str)           : The directory to which the results will be saved
+            img_type (str)          : Type of images to be processed: RGB or MULTI
+            vis (list(str))         : List of VIs (and ch / cv for RGB) to be generated
+            shp_file (str)          : Shapefile with the field plots, if set the attributes are stored per plot (default is None)
+            epsg (str or int)       : EPSG value or UTM zone (13N, 14N) of the shapefile (default is None)
+            chm_dir (str)           : Folder with the canopy height models (.tif) needed by ch and cv (default is None)
+            tile_size (int)         : If set, process the images window by window (default is None)
+            workers (int)           : If more than 1, process the windows in a pool of processes (default is None)
+            out_format (str)        : Output format of the VI rasters: ENVI or COG (default is ENVI)
+            writer_options (dict)   : Options of the output writer, e.g. compress, vi_dtype for COG (default is None)
+            zonal (bool)            : Compute the per plot VI statistics while the VIs are computed (zonal_stats), and
+                                      ch / cv with the CHM engine (gen_chm_attributes), instead of running the
+                                      boundary steps (default is False)
+            write_rasters (bool)    : Write the VI rasters, False when only the zonal statistics are needed (default is True)
+            cache (bool)            : Skip the (image, VI) products that are up to date in out_dir (default is False)
+            cache_dir (str)         : Shared folder caching the products across output folders, implies cache (default is None)
+            cache_max_gb (float)    : Size limit of cache_dir, least recently used products are evicted (default is None)
+            force (bool)            : Recompute the products even if they are up to date (default is False)
+            metrics (Instrumentation): Receives the stage timers, counters and progress (default is None)
+            pipelined (bool)        : Overlap the reads, compute and writes of the windows in threads (default is False)
+            time_series (str)       : .npz table to which the per plot VI statistics of the dates not in it yet are
+                                      added (see time_series) (default is None)
+            params (dict)           : Values overriding vi_expressions.VI_PARAMETERS, e.g. the cc thresholds th1, th2,
+                                      th3 (default is None)
+            preview (bool)          : Only save reduced resolution previews of the VIs to <out_dir>/preview (see
+                                      vi_preview), to check the parameters before a full run (default is False)
+            cc_storage (str)        : If set (bit or uint8), cc goes through the canopy cover path (canopy_cover):
+                                      a compact mask in <out_dir>/cc and, with shp_file, the fractional cover of every
+                                      plot, instead of the .dat file and boundary step (default is None)
+            attributes (str)        : .gpkg (or .shp) to which every per plot statistic of the job (zonal VIs, ch / cv,
+                                      cc cover) is written at the end, in one batch (see plot_attributes) (default is None)
+            update_attributes (bool): Update the rows of an existing attributes file in place (default is False)
+            use_vmem (bool)         : Read raw (uncompressed) images through memory-mapped views when computing the
+                                      VIs (see image_reader) (default is False)
+
+           Returns:
+            messages (list(str))    : What was generated, in the order it was generated
+    """
+    check_job(images, out_dir, img_type, vis, shp_file, epsg, chm_dir, out_format, zonal, write_rasters, time_series, params,
+              cc_storage, attributes, update_attributes)
+    from gen_dat_files import DEFAULT_TILE_SIZE, get_dat_for_vi # GDAL is imported here, not at startup
+    from pipeline_metrics import NULL_INSTRUMENTATION
+    metrics = metrics or NULL_INSTRUMENTATION
+
+    epsg_val = parse_epsg(epsg)
+    vis_to_process = [vi for vi in vis if vi not in CHM_OPTIONS]
+    messages = []
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    if preview:
+        from vi_preview import save_previews
+        paths = save_previews(images, out_dir, img_type, vis_to_process, params)
+        return [f'Saved {len(paths)} preview(s) to {os.path.join(out_dir, "preview")}']
+
+    plot_results = [] # per plot results of the steps, for the attributes file
+    time_series_vis = vis_to_process
+    if cc_storage is not None:
+        # cc mask and fractional cover per plot in one pass, cc is then left out of the VI outputs (not the time series)
+        from canopy_cover import get_canopy_cover
+        plot_results.append(get_canopy_cover(images, out_dir, shp_file, epsg_val, workers, tile_size or DEFAULT_TILE_SIZE,
+                                             params, cc_storage, write_rasters, metrics = metrics))
+        vis_to_process = [vi for vi in vis_to_process if vi != 'cc']
+        messages.append('Generated cc ' + ' and '.join((['masks'] if write_rasters else []) + (['plot cover'] if shp_file else [])))
+
+    if ('ch' in vis or 'cv' in vis) and zonal:
+        # ch and cv of every plot in one pass over each CHM (see gen_chm_attributes)
+        from gen_chm_attributes import get_chm_attributes, get_chm_files
+        plot_results.append(get_chm_attributes(get_chm_files(chm_dir), shp_file, out_dir, epsg_val, workers,
+                                               tile_size or DEFAULT_TILE_SIZE, metrics = metrics))
+        messages.append('Generated ch / cv plot statistics')
+    elif 'ch' in vis or 'cv' in vis:
+        chm_files = sorted(glob.glob(os.path.join(chm_dir, '*.tif')))
+        if 'ch' in vis:
+            from gen_ch_boundry import get_ch_boundary
+            with metrics.stage('boundary'):
+                get_ch_boundary(epsg_val, shp_file, chm_files, out_dir)
+            messages.append('Generated ch shapefile(s)')
+        if 'cv' in vis:
+            from gen_cv_boundary import get_cv_boundary
+            with metrics.stage('boundary'):
+                get_cv_boundary(epsg_val, shp_file, chm_files, out_dir)
+            messages.append('Generated cv shapefile(s)')
+
+    if vis_to_process and zonal:
+        plot_results.append(get_dat_for_vi(images, out_dir, img_type, vis_to_process, tile_size, workers, out_format,
+                                           writer_options, shp_file, epsg_val, write_rasters, metrics = metrics,
+                                           pipelined = pipelined, params = params, use_vmem = use_vmem))
+        messages.append(f'Generated {img_type} plot statistics' + (' and dat files' if write_rasters else ''))
+    elif vis_to_process and write_rasters:
+        result_cache = None
+        if cache or cache_dir or force:
+            from result_cache import ResultCache
+            max_bytes = int(cache_max_gb * 1024 ** 3) if cache_max_gb else None
+            result_cache = ResultCache(out_dir, cache_dir, max_bytes, force)
+        get_dat_for_vi(images, out_dir, img_type, vis_to_process, tile_size, workers, out_format, writer_options,
+                       cache = result_cache, metrics = metrics, pipelined = pipelined, params = params,
+                       use_vmem = use_vmem)
+        messages.append(f'Generated {img_type} dat files')
+
+    if time_series and time_series_vis:
+        from time_series import update_time_series
+        _, added = update_time_series(images, time_series, img_type, time_series_vis, shp_file, epsg_val,
+                                      tile_size or DEFAULT_TILE_SIZE, workers, force = force, params = params,
+                                      metrics = metrics)
+        messages.append(f'Added {len(added)} date(s) to {time_series}')
+
+    if shp_file and vis_to_process and not zonal and write_rasters:
+        from gen_vi_boundary import get_boundary_for_vi
+        with metrics.stage('boundary'):
+            get_boundary_for_vi(epsg_val, shp_file, out_dir, vis_to_process)
+        messages.append('Generated shapefile(s)')
+
+    if attributes:
+        from plot_attributes import PlotAttributeTable, write_plot_attributes
+        table = PlotAttributeTable()
+        for results in plot_results:
+            table.add_results(results)
+        with metrics.stage('attributes'):
+            features = write_plot_attributes(table, shp_file, attributes, epsg_val, update = update_attributes)
+        messages.append(f'Wrote {len(table.columns)} attribute(s) of {features} plot(s) to {attributes}')
+
+    return messages
+
+def load_manifest(manifest_file):
+    """    Reads a manifest of jobs, applying its defaults to every job
+
+           Returns:
+            jobs (list(dict))       : Keyword arguments of run_job for every job
+    """
+    with open(manifest_file) as fp:
+        manifest = json.load(fp)
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    jobs = []
+    for job in manifest.get('jobs', []):
+        job = dict(manifest.get('defaults', {}), **job)
+        # relative paths in a manifest are relative to the manifest itself
+        job['images'] = [os.path.join(base_dir, f) for f in job.get('images', [])]
+        for key in ('out_dir', 'shp_file', 'chm_dir', 'time_series', 'attributes'):
+            if job.get(key):
+                job[key] = os.path.join(base_dir, job[key])
+        jobs.append(job)
+    return jobs
+
+def run_manifest(manifest_file, stop_on_error = False, metrics = None):
+    """    Runs all jobs of a manifest back to back in this process
+
+           Args:
+            manifest_file (str)     : JSON manifest (see the module docstring)
+            stop_on_error (bool)    : Stop at the first failing job instead of continuing (default is False)
+            metrics (Instrumentation): Shared by all jobs (default is None)
+
+           Returns:
+            results (list(dict))    : Per job: job, ok, seconds and messages or error
+    """
+    results = []
+    for job in load_manifest(manifest_file):
+        start = time.perf_counter()
+        try:
+            messages = run_job(metrics = metrics, **job)
+            results.append({'job': job, 'ok': True, 'seconds': time.perf_counter() - start, 'messages': messages})
+        except Exception as e:
+            results.append({'job': job, 'ok': False, 'seconds': time.perf_counter() - start, 'error': str(e)})
+            if stop_on_error:
+                break
+    return results
+
+def build_parser():
+    parser = argparse.ArgumentParser(description = 'Generate canopy attributes from RGB and/or Multispectral Imagery')
+    parser.add_argument('--manifest', help = 'JSON manifest with many jobs, the other job arguments are then ignored')
+    parser.add_argument('--images', nargs = '+', default = [], help = 'Orthomosaic image(s) to be processed')
+    parser.add_argument('--out-dir', help = 'The directory to which the results will be saved')
+    parser.add_argument('--type', dest = 'img_type', choices = IMG_TYPES, help = 'Type of images to be processed')
+    parser.add_argument('--vis', nargs = '+', default = [], help = 'VIs (and ch / cv for RGB) to be generated')
+    parser.add_argument('--shp', dest = 'shp_file', help = 'Boundary shapefile with the field plots')
+    parser.add_argument('--epsg', help = 'EPSG value or UTM zone (13N, 14N) of the shapefile')
+    parser.add_argument('--chm-dir', help = 'Folder with the canopy height models (needed by ch and cv)')
+    parser.add_argument('--tile-size', type = int, help = 'Process the images window by window')
+    parser.add_argument('--workers', type = int, help = 'Number of worker processes')
+    parser.add_argument('--pipelined', action = 'store_true',
+                        help = 'Overlap the reads, VI compute and writes of the windows (single process)')
+    parser.add_argument('--use-vmem', action = 'store_true',
+                        help = 'Read raw (uncompressed) images through memory-mapped views')
+    parser.add_argument('--format', dest = 'out_format', default = 'ENVI', choices = ['ENVI', 'COG'],
+                        help = 'ENVI: one .dat per VI, COG: one compressed Cloud-Optimized GeoTIFF per image')
+    parser.add_argument('--compress', choices = ['DEFLATE', 'ZSTD', 'LZW'], help = 'COG compression (default DEFLATE)')
+    parser.add_argument('--vi-dtype', choices = ['float32', 'float16', 'int16'], help = 'COG storage of the VIs (default float32)')
+    parser.add_argument('--zonal', action = 'store_true', help = 'Compute the per plot VI statistics in process (needs --shp)')
+    parser.add_argument('--no-rasters', dest = 'write_rasters', action = 'store_false',
+                        help = 'Only the zonal statistics, without writing the VI rasters')
+    parser.add_argument('--cache', action = 'store_true', help = 'Skip the image/VI outputs that are up to date')
+    parser.add_argument('--cache-dir', help = 'Shared folder caching the outputs across runs and output folders')
+    parser.add_argument('--cache-max-gb', type = float, help = 'Size limit of the shared cache folder')
+    parser.add_argument('--force', action = 'store_true', help = 'Recompute the outputs even if they are up to date')
+    parser.add_argument('--param', dest = 'params', action = 'append', metavar = 'NAME=VALUE',
+                        help = 'VI parameter, e.g. --param th1=0.9 for the cc thresholds th1, th2, th3 (repeatable)')
+    parser.add_argument('--preview', action = 'store_true',
+                        help = 'Only save reduced resolution previews of the VIs to check the parameters')
+    parser.add_argument('--cc-storage', choices = CC_STORAGES,
+                        help = 'Compute cc as a compact mask (bit-packed or uint8) and the cover fraction of every plot')
+    parser.add_argument('--attributes', help = '.gpkg (or .shp) receiving every per plot statistic of the job in one batch')
+    parser.add_argument('--update-attributes', action = 'store_true',
+                        help = 'Update the rows of an existing --attributes file in place')
+    parser.add_argument('--time-series', help = '.npz table of the per plot VI statistics by date, new dates are appended')
+    parser.add_argument('--stop-on-error', action = 'store_true', help = 'Stop a manifest at the first failing job')
+    parser.add_argument('--progress', action = 'store_true',
+                        help = 'Print the progress, throughput and ETA, and the per image throughput of --workers')
+    parser.add_argument('--metrics-log', help = 'Append the progress events and stage timers as JSON lines to this file')
+    return parser
+
+def build_metrics(progress = False, metrics_log = None):
+    """    Returns the Instrumentation of the --progress / --metrics-log options, None without them
+    """
+    if not progress and not metrics_log:
+        return None
+    from pipeline_metrics import Instrumentation, JsonLog, print_progress
+    metrics = Instrumentation()
+    if progress:
+        metrics.subscribe(print_progress)
+    if metrics_log:
+        metrics.subscribe(JsonLog(metrics_log))
+    return metrics
+
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+    metrics = build_metrics(args.progress, args.metrics_log)
+
+    if args.manifest:
+        results = run_manifest(args.manifest, args.stop_on_error, metrics)
+        if metrics is not None:
+            metrics.finish()
+        for r in results:
+            status = 'done' if r['ok'] else 'FAILED: ' + r['error']
+            print(f'{r["job"].get("out_dir")} ({r["seconds"]:.1f} s): {status}')
+        return 0 if all(r['ok'] for r in results) else 1
+
+    writer_options = {}
+    if args.compress:
+        writer_options['compress'] = args.compress
+    if args.vi_dtype:
+        writer_options['vi_dtype'] = args.vi_dtype
+
+    try:
+        for message in run_job(args.images, args.out_dir, args.img_type, args.vis, args.shp_file, args.epsg,
+                               args.chm_dir, args.tile_size, args.workers, args.out_format, writer_options,
+                               args.zonal, args.write_rasters, args.cache, args.cache_dir, args.cache_max_gb,
+                               args.force, metrics, args.pipelined, args.time_series, parse_params(args.params),
+                               args.preview, args.cc_storage, args.attributes, args.update_attributes,
+                               args.use_vmem):
+            print(message)
+    except ValueError as e:
+        print(f'Error: {e}', file = sys.stderr)
+        return 2
+    finally:
+        if metrics is not None:
+            metrics.finish()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Window reader of the orthomosaic bands
+The bands are never loaded as a whole native cube: every window is read (and converted to float32 by GDAL) straight
+into one preallocated (bands, rows, cols) float32 buffer that is reused by the next windows of the same size.
+For raw files (ENVI, uncompressed GeoTIFF) the bands can instead be exposed as memory-mapped views (GDAL virtual
+memory), the conversion to float32 is then a copy of the window into the same reused buffer.
+Where every band is, its data type, scale / offset and nodata come from the sensor profile of the file, detected
+and validated once when it is opened (see sensor_profiles). Integer images without scale / offset (e.g. uint8 RGB)
+can be read in their native type, for the VI kernels specialized per data type (see vi_expressions).
+"""
+import numpy as np
+from osgeo import gdal
+from sensor_profiles import detect_profile
+
+
+class ImageReader:
+    """    Reads windows of the bands of an orthomosaic as float32
+
+           Args:
+            image (str or gdal.Dataset) : The orthomosaic image (or its opened dataset)
+            band_names (list(str))      : Bands to be read, e.g. RGB_BANDS or MULTI_BANDS (found in the file with its
+                                          sensor profile), or any names read in file order
+            use_vmem (bool)             : Map the bands with GDAL virtual memory when the format allows it,
+                                          falls back to windowed reads otherwise (default is False)
+            native (bool)               : Read integer bands without scale / offset in their native type instead of
+                                          float32 (default is False)
+
+           Attributes:
+            x_size, y_size (int)        : Size of the image
+            transform (tuple)           : Geotransform
+            proj (str)                  : Projection
+            profile (SensorProfile)     : Band order, data type, scale / offset and nodata of the file
+            band_names (list(str))      : Bands read, the optional bands missing from the file (e.g. alpha) are left out
+            band_nodata (dict)          : Band name -> nodata value of the band (None when the band has none)
+            dtype (numpy dtype)         : Type of the arrays returned by read (float32, or the native type)
+    """
+    def __init__(self, image, band_names, use_vmem = False, native = False):
+        self.ds = gdal.Open(image) if isinstance(image, str) else image
+        if self.ds is None:
+            raise ValueError(f'Cannot open the image {image}')
+        self.profile = detect_profile(self.ds, band_names)
+        self.band_names = self.profile.band_names
+        self.x_size = self.ds.RasterXSize
+        self.y_size = self.ds.RasterYSize
+        self.transform = self.ds.GetGeoTransform()
+        self.proj = self.ds.GetProjection()
+        self.band_nodata = dict(self.profile.nodata)
+        self.dtype = self.profile.dtype if native and self.profile.native else np.dtype(np.float32)
+        self._band_numbers = [self.profile.band_index[name] for name in self.band_names]
+        self._buffer = None
+        self._views = self._map_bands() if use_vmem else None
+
+    def _map_bands(self):
+        views = []
+        try:
+            for k in self._band_numbers:
+                views.append(self.ds.GetRasterBand(k).GetVirtualMemAutoArray(gdal.GF_Read))
+        except (RuntimeError, AttributeError): # compressed / tiled formats, or GDAL without virtual memory
+            return None
+        return views
+
+    @property
+    def mapped(self):
+        """    True when the bands are read from memory-mapped views
+        """
+        return self._views is not None
+
+    def _window_buffer(self, xs, ys, reuse):
+        shape = (len(self.band_names), ys, xs)
+        if not reuse:
+            return np.empty(shape, self.dtype)
+        if self._buffer is None or self._buffer.shape != shape:
+            self._buffer = np.empty(shape, self.dtype)
+        return self._buffer
+
+    def read(self, window, reuse = True, out = None):
+        """    Reads one window of every band
+
+               Args:
+                window (tuple)          : (xoff, yoff, xsize, ysize) window to be read
+                reuse (bool)            : Read into the buffer of the previous window, whose arrays are then
+                                          overwritten. False gives arrays owned by the caller (default is True)
+                out (numpy array)       : (bands, rows, cols) buffer of type dtype to read into, e.g. from a pool of
+                                          buffers shared by threads (default is None)
+
+               Returns:
+                bands (dict)            : Band name -> numpy array of type dtype (views of one contiguous buffer),
+                                          scaled to physical values when the profile has scales / offsets
+        """
+        xoff, yoff, xs, ys = window
+        buf = out if out is not None else self._window_buffer(xs, ys, reuse)
+        for k in range(len(self.band_names)):
+            if self._views is not None:
+                np.copyto(buf[k], self._views[k][yoff:yoff + ys, xoff:xoff + xs], casting = 'unsafe')
+            else:
+                self.ds.GetRasterBand(self._band_numbers[k]).ReadAsArray(xoff, yoff, xs, ys, buf_obj = buf[k])
+        bands = {self.band_names[k]: buf[k] for k in range(len(self.band_names))}
+        if self.profile.scaled:
+            self._apply_scale(bands)
+        return bands
+
+    def _apply_scale(self, bands):
+        # digital numbers -> physical values, in place, the nodata pixels keep their value for valid_mask
+        for name, band in bands.items():
+            scale, offset = self.profile.scale[name], self.profile.offset[name]
+            if name == 'alpha' or (scale is None and offset is None):
+                continue
+            nodata = self.band_nodata[name]
+            keep = band == nodata if nodata is not None else None
+            if scale is not None:
+                band *= scale
+            if offset is not None:
+                band += offset
+            if keep is not None:
+                band[keep] = nodata
+
+    def close(self):
+        self._views = None
+        self._buffer = None
+        self.ds = None
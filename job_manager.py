@@ -0,0 +1,186 @@
+"""
+Queue of the processing jobs of the GUI
+The jobs run in worker threads, at most max_running at a time, the others wait in a first in first out queue.
+Every job gets its own Instrumentation (JobMetrics) which also checks for cancellation: a cancelled job stops at
+its next window (the processing functions report the progress of every window), a queued job is dropped at once.
+The worker threads never touch the widgets: the state changes and progress events of the jobs are put in a queue
+which the Tk main loop drains with poll(), e.g. every 100 ms with window.after().
+"""
+import collections
+import itertools
+import queue
+import threading
+from pipeline_metrics import Instrumentation
+
+QUEUED    = 'queued'
+RUNNING   = 'running'
+DONE      = 'done'
+FAILED    = 'failed'
+CANCELLED = 'cancelled'
+FINISHED  = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """    Raised in a job at its next window after it was cancelled
+    """
+    pass
+
+
+class JobMetrics(Instrumentation):
+    """    Instrumentation of one job, raises JobCancelled from progress() once the job is cancelled
+
+           Args:
+            job (Job)               : The job reporting to it
+            subscribers (list)      : Callables receiving the event dicts (default is None)
+            min_interval (float)    : Minimum seconds between two progress events (default is 0.2)
+    """
+    def __init__(self, job, subscribers = None, min_interval = 0.2):
+        super().__init__(subscribers, min_interval)
+        self.job = job
+
+    def progress(self, pixels, current = None):
+        if self.job.cancel_requested.is_set():
+            raise JobCancelled(f'{self.job.name} cancelled')
+        super().progress(pixels, current)
+
+
+class Job:
+    """    One queued call: target(*args, metrics = <JobMetrics>, **kwargs)
+
+           Attributes:
+            id (int)                : Number of the job, in submission order
+            name (str)              : Label of the job in the GUI
+            state (str)             : QUEUED, RUNNING, DONE, FAILED or CANCELLED
+            result                  : Return value of target once DONE
+            error (Exception)       : Raised by target once FAILED
+            last_event (dict)       : Last progress event of the job
+            on_done (callable)      : Called with the job once DONE, in the thread calling JobManager.poll (default is None)
+    """
+    def __init__(self, job_id, name, target, args, kwargs, on_done = None):
+        self.id = job_id
+        self.name = name
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.last_event = None
+        self.cancel_requested = threading.Event()
+        self.metrics = None
+
+    def __str__(self):
+        return f'#{self.id} {self.name}: {self.state}'
+
+
+class JobManager:
+    """    Runs the submitted jobs in worker threads, max_running at a time
+
+           Args:
+            max_running (int)       : Jobs running at the same time (default is 1)
+            min_interval (float)    : Minimum seconds between two progress events of a job (default is 0.2)
+    """
+    def __init__(self, max_running = 1, min_interval = 0.2):
+        self.max_running = max_running
+        self.min_interval = min_interval
+        self.jobs = []                      # every submitted job, in submission order
+        self._waiting = collections.deque()
+        self._threads = {}                  # job id -> worker thread
+        self._events = queue.Queue()        # (job, event) for the thread polling (the Tk main loop)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, name, target, *args, on_done = None, **kwargs):
+        """    Queues target(*args, metrics = <JobMetrics>, **kwargs), e.g. run_job of generate_canopy_attributes_cli
+
+               Returns:
+                job (Job)               : The queued job
+        """
+        job = Job(next(self._ids), name, target, args, kwargs, on_done)
+        job.metrics = JobMetrics(job, [lambda event, job = job: self._events.put((job, event))], self.min_interval)
+        with self._lock:
+            self.jobs.append(job)
+            self._waiting.append(job)
+        self._post(job, QUEUED)
+        self._start_waiting()
+        return job
+
+    def _post(self, job, state):
+        job.state = state
+        self._events.put((job, {'event': 'state', 'state': state}))
+
+    def _start_waiting(self):
+        with self._lock:
+            while self._waiting and len(self._threads) < self.max_running:
+                job = self._waiting.popleft()
+                thread = threading.Thread(target = self._run, args = (job,), name = f'job-{job.id}', daemon = True)
+                self._threads[job.id] = thread
+                job.state = RUNNING # set before the thread starts, so a cancel() can't see it as queued
+                thread.start()
+
+    def _run(self, job):
+        self._post(job, RUNNING)
+        try:
+            job.result = job.target(*job.args, metrics = job.metrics, **job.kwargs)
+            state = DONE
+        except JobCancelled:
+            state = CANCELLED
+        except Exception as e:
+            job.error = e
+            state = FAILED
+        with self._lock:
+            del self._threads[job.id]
+        self._post(job, state)
+        self._start_waiting()
+
+    def cancel(self, job):
+        """    Cancels a job: a queued job is dropped, a running job stops at its next window
+        """
+        with self._lock:
+            if job.state == QUEUED and job in self._waiting:
+                self._waiting.remove(job)
+                dropped = True
+            else:
+                dropped = False
+                if job.state == RUNNING:
+                    job.cancel_requested.set()
+        if dropped:
+            self._post(job, CANCELLED)
+
+    def cancel_all(self):
+        """    Cancels every queued and running job
+        """
+        for job in list(self.jobs):
+            self.cancel(job)
+
+    def active(self):
+        """    Returns the jobs queued or running
+        """
+        return [job for job in self.jobs if job.state not in FINISHED]
+
+    def poll(self, max_events = 200):
+        """    Returns the (job, event) pairs posted since the last call, to be called from the Tk main loop only.
+               The on_done callbacks of the finished jobs are run here.
+        """
+        events = []
+        while len(events) < max_events:
+            try:
+                job, event = self._events.get_nowait()
+            except queue.Empty:
+                break
+            if event['event'] == 'progress':
+                job.last_event = event
+            elif event['event'] == 'state' and event['state'] == DONE and job.on_done is not None:
+                job.on_done(job)
+            events.append((job, event))
+        return events
+
+    def shutdown(self, timeout = None):
+        """    Cancels every job and waits for the running ones to stop (at their next window)
+        """
+        self.cancel_all()
+        with self._lock:
+            threads = list(self._threads.values())
+        for thread in threads:
+            thread.join(timeout)
@@ -0,0 +1,214 @@
+"""
+Instrumentation of the processing pipeline
+The processing functions take an Instrumentation and report to it:
+    stages   : time spent per stage (open, read, compute, write, zonal, boundary, ...)
+    counters : bytes and pixels (bytes_read, bytes_written, pixels)
+    progress : pixels done out of the pixels planned, sent to the subscribers with the throughput and an ETA
+    events   : e.g. the per image throughput table of the parallel path (throughput, see gen_dat_parallel)
+Subscribers are callables receiving event dicts, e.g. a GUI label, the CLI (print_progress) or a JSON log (JsonLog).
+Without an Instrumentation the functions use NULL_INSTRUMENTATION, whose methods do nothing.
+"""
+import json
+import sys
+import threading
+import time
+
+
+class _Timer:
+    __slots__ = ('_metrics', '_name', '_start')
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.add_time(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class Instrumentation:
+    """    Collects stage timers, counters and progress of a run and forwards events to subscribers
+
+           Args:
+            subscribers (list)      : Callables receiving the event dicts (default is None)
+            min_interval (float)    : Minimum seconds between two progress events, the last one is always sent (default is 0.2)
+    """
+    enabled = True
+
+    def __init__(self, subscribers = None, min_interval = 0.2):
+        self.subscribers = list(subscribers or [])
+        self.min_interval = min_interval
+        self.stages = {}        # name -> [seconds, calls]
+        self.counters = {}      # name -> value
+        self.total_pixels = 0
+        self.done_pixels = 0
+        self.current = None     # what is being processed (e.g. the image file)
+        self._start = time.perf_counter()
+        self._last_event = 0.0
+        self._lock = threading.Lock() # the writer threads and pool callbacks report concurrently
+
+    def subscribe(self, callback):
+        """    Adds a subscriber, a callable receiving every event dict
+        """
+        self.subscribers.append(callback)
+
+    def stage(self, name):
+        """    Returns a context manager adding the time spent in its block to the stage
+        """
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            stage = self.stages.setdefault(name, [0.0, 0])
+            stage[0] += seconds
+            stage[1] += 1
+
+    def count(self, name, value):
+        """    Adds value to the counter name (e.g. bytes_read, pixels)
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def plan(self, pixels):
+        """    Adds pixels to the work planned for the run (the base of the progress and ETA)
+        """
+        with self._lock:
+            self.total_pixels += pixels
+
+    def event(self, name, **values):
+        """    Sends an event to the subscribers
+        """
+        event = {'event': name, 'time': time.time(), 'elapsed_s': time.perf_counter() - self._start}
+        event.update(values)
+        for callback in self.subscribers:
+            callback(event)
+
+    def progress(self, pixels, current = None):
+        """    Reports pixels as done and sends a progress event (at most every min_interval seconds)
+        """
+        with self._lock:
+            self.done_pixels += pixels
+            if current is not None:
+                self.current = current
+            now = time.perf_counter()
+            finished = self.total_pixels and self.done_pixels >= self.total_pixels
+            if not finished and now - self._last_event < self.min_interval:
+                return
+            self._last_event = now
+            elapsed = now - self._start
+            rate = self.done_pixels / elapsed if elapsed > 0 else 0.0
+            remaining = max(self.total_pixels - self.done_pixels, 0)
+            values = {
+                'current'      : self.current,
+                'done_pixels'  : self.done_pixels,
+                'total_pixels' : self.total_pixels,
+                'fraction'     : self.done_pixels / self.total_pixels if self.total_pixels else None,
+                'mpix_per_s'   : rate / 1e6,
+                'eta_s'        : remaining / rate if rate > 0 else None,
+            }
+        self.event('progress', **values)
+
+    def summary(self):
+        """    Returns the stage timers, counters and throughput of the run so far
+        """
+        elapsed = time.perf_counter() - self._start
+        with self._lock:
+            return {
+                'elapsed_s'  : elapsed,
+                'stages'     : {name: {'seconds': s[0], 'calls': s[1]} for name, s in self.stages.items()},
+                'counters'   : dict(self.counters),
+                'pixels'     : self.done_pixels,
+                'mpix_per_s' : self.done_pixels / elapsed / 1e6 if elapsed > 0 else 0.0,
+            }
+
+    def finish(self):
+        """    Sends the done event with the summary of the run
+        """
+        self.event('done', **self.summary())
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullInstrumentation:
+    """    Instrumentation doing nothing, the default of the processing functions
+    """
+    enabled = False
+    _timer = _NullTimer()
+
+    def subscribe(self, callback):
+        pass
+
+    def stage(self, name):
+        return self._timer
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def plan(self, pixels):
+        pass
+
+    def event(self, name, **values):
+        pass
+
+    def progress(self, pixels, current = None):
+        pass
+
+    def summary(self):
+        return {}
+
+    def finish(self):
+        pass
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+def format_progress(event):
+    """    Formats a progress event as one line: done %, throughput and ETA
+    """
+    if event['event'] != 'progress':
+        return ''
+    fraction = f'{100 * event["fraction"]:5.1f} %' if event['fraction'] is not None else f'{event["done_pixels"] / 1e6:.1f} MPix'
+    eta = f'ETA {event["eta_s"]:.0f} s' if event['eta_s'] is not None else 'ETA -'
+    return f'{fraction}  {event["mpix_per_s"]:.1f} MPix/s  {eta}'
+
+def print_progress(event, stream = sys.stderr):
+    """    Subscriber printing the progress events on one updated line, and the throughput reports
+    """
+    if event['event'] == 'progress':
+        stream.write('\r' + format_progress(event))
+        stream.flush()
+    elif event['event'] == 'throughput':
+        stream.write('\n' + event['text'] + '\n')
+        stream.flush()
+    elif event['event'] == 'done':
+        stream.write('\n')
+        stream.flush()
+
+
+class JsonLog:
+    """    Subscriber appending every event as one JSON line to a file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps(event, default = str) + '\n')
@@ -0,0 +1,268 @@
+"""
+Per plot attributes written back to the plot polygons in one batch
+The boundary steps write one shapefile per VI (and per CHM), the whole .dbf being rewritten for every output. Here the
+per plot statistics of a run (zonal VIs, ch / cv, cc cover, of every image / date) are collected in a
+PlotAttributeTable, one numpy array per attribute column (no per feature objects), and written in one go:
+    - GeoPackage (.gpkg, the default): one layer, every feature inserted in a single transaction, the spatial index
+      (R-tree) created once after the inserts instead of being updated row by row
+    - shapefile (.shp), when one is required: the attribute names are shortened to the 10 characters of the .dbf, the
+      full names are kept in <out>_fields.csv, and the spatial index (.qix) is also created at the end
+The attributes are named <date>_<vi>_<stat>, e.g. 20230601_exg_mean, 20230601_height_p90, 20230601_cc_cover.
+With update, an existing output is updated in place: its rows are matched by plot_id, the new attributes are added as
+columns and only the attribute values are rewritten, the geometries and the other columns are left untouched.
+"""
+import csv
+import os
+import numpy as np
+from osgeo import ogr, osr
+
+PLOT_ID_FIELD = 'plot_id'
+DRIVERS = {'.gpkg': 'GPKG', '.shp': 'ESRI Shapefile'}
+DBF_NAME_LENGTH = 10
+
+
+class PlotAttributeTable:
+    """    Per plot attributes in columnar buffers, one numpy array per attribute
+
+           Args:
+            plot_ids (list)         : Identifier of every plot (default is None, taken from the first results added)
+    """
+    def __init__(self, plot_ids = None):
+        self.plot_ids = [str(p) for p in plot_ids] if plot_ids is not None else None
+        self.columns = {} # attribute name -> array with one value per plot (int64 counts, float64 otherwise)
+
+    def __len__(self):
+        return len(self.plot_ids) if self.plot_ids is not None else 0
+
+    def add(self, prefix, plot_ids, stats):
+        """    Adds the statistics of one image as <prefix>_<vi>_<stat> columns
+
+               Args:
+                prefix (str)            : Prefix of the attribute names, e.g. the date of the image
+                plot_ids (list)         : Identifier of every plot, as in the table
+                stats (dict)            : VI name -> statistic name -> array with one value per plot
+        """
+        plot_ids = [str(p) for p in plot_ids]
+        if self.plot_ids is None:
+            self.plot_ids = plot_ids
+        elif plot_ids != self.plot_ids:
+            raise ValueError(f'The plots of {prefix} differ from the plots of the table')
+        for vi, vi_stats in stats.items():
+            for stat, values in vi_stats.items():
+                values = np.asarray(values)
+                values = values.astype(np.int64 if values.dtype.kind in 'iub' else np.float64, copy = False)
+                self.columns[f'{prefix}_{vi}_{stat}'] = values
+
+    def add_results(self, results):
+        """    Adds the per plot results of a processing step, e.g. of gen_dat_files.get_dat_for_vi (with a shapefile),
+               gen_chm_attributes.get_chm_attributes or canopy_cover.get_canopy_cover
+
+               Args:
+                results (dict)          : Image filename -> dict with plot_ids and stats
+        """
+        for f, result in results.items():
+            if 'stats' in result:
+                self.add(os.path.basename(f)[0:8], result['plot_ids'], result['stats'])
+
+    def rows(self):
+        """    Returns plot_id -> row of the plot in the columns
+        """
+        return {plot_id: k for k, plot_id in enumerate(self.plot_ids or [])}
+
+
+def _field_type(values):
+    return ogr.OFTInteger64 if values.dtype.kind == 'i' else ogr.OFTReal
+
+def _column_values(values):
+    # python values of a column, None for NaN (written as null), converted once and not per feature
+    if values.dtype.kind == 'f':
+        return [None if v != v else v for v in values.tolist()]
+    return values.tolist()
+
+def fields_file(out_file):
+    """    Returns the CSV keeping the full attribute names of a shapefile output (<out>_fields.csv)
+    """
+    return os.path.splitext(out_file)[0] + '_fields.csv'
+
+def _load_field_names(out_file):
+    names = {}
+    if os.path.exists(fields_file(out_file)):
+        with open(fields_file(out_file), newline = '') as fp:
+            for row in csv.DictReader(fp):
+                names[row['name']] = row['field']
+    return names
+
+def _save_field_names(out_file, names):
+    tmp = fields_file(out_file) + '.tmp'
+    with open(tmp, 'w', newline = '') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['field', 'name'])
+        for name, field in names.items():
+            writer.writerow([field, name])
+    os.replace(tmp, fields_file(out_file))
+
+def _dbf_field_names(names, known, taken):
+    """    Returns attribute name -> .dbf field name (at most 10 characters, unique regardless of case), keeping the
+           field names already given in known and avoiding the names in taken
+    """
+    fields = {}
+    used = {name.upper() for name in taken} | {field.upper() for field in known.values()}
+    for name in names:
+        if name in known:
+            fields[name] = known[name]
+            continue
+        field = name[:DBF_NAME_LENGTH]
+        k = 1
+        while field.upper() in used:
+            suffix = str(k)
+            field = name[:DBF_NAME_LENGTH - len(suffix)] + suffix
+            k += 1
+        used.add(field.upper())
+        fields[name] = field
+    return fields
+
+def _field_names(layer):
+    defn = layer.GetLayerDefn()
+    return [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+
+def _create_columns(layer, table, fields):
+    # creates the attribute columns missing from the layer, returns their (field index, python values)
+    existing = set(_field_names(layer))
+    for name, values in table.columns.items():
+        if fields[name] not in existing:
+            layer.CreateField(ogr.FieldDefn(fields[name], _field_type(values)))
+    defn = layer.GetLayerDefn()
+    return [(defn.GetFieldIndex(fields[name]), _column_values(values)) for name, values in table.columns.items()]
+
+def _set_row(feature, columns, row):
+    for index, values in columns:
+        value = values[row]
+        if value is None:
+            feature.SetFieldNull(index)
+        else:
+            feature.SetField(index, value)
+
+def _begin(ds):
+    # one transaction for all the rows where the format has them (GeoPackage), the shapefiles are written directly
+    if ds.TestCapability(ogr.ODsCTransactions):
+        ds.StartTransaction()
+        return True
+    return False
+
+def _create_spatial_index(ds, layer, driver_name):
+    name = layer.GetName()
+    if driver_name == 'GPKG':
+        ds.ExecuteSQL(f"SELECT CreateSpatialIndex('{name}', '{layer.GetGeometryColumn()}')")
+    else:
+        ds.ExecuteSQL(f'CREATE SPATIAL INDEX ON "{name}"')
+
+def write_plot_attributes(table, shp_file, out_file, epsg = None, id_field = None, update = False, layer_name = None):
+    """    Writes the attributes of a PlotAttributeTable with the plot polygons to a GeoPackage or a shapefile
+
+           Args:
+            table (PlotAttributeTable): The per plot attributes
+            shp_file (str)          : Shapefile with the field plots, the plots of the table
+            out_file (str)          : Output .gpkg or .shp
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            id_field (str)          : Attribute identifying the plots, as for the statistics (default is None, the
+                                      feature id)
+            update (bool)           : If out_file exists, update its rows in place instead of writing it again
+                                      (default is False)
+            layer_name (str)        : Layer of the output (default is None, the name of the shapefile)
+
+           Returns:
+            features (int)          : Number of features written or updated
+    """
+    ext = os.path.splitext(out_file)[1].lower()
+    if ext not in DRIVERS:
+        raise ValueError(f'The plot attributes are written to one of {list(DRIVERS)}, got {out_file}')
+    if table.plot_ids is None:
+        raise ValueError('No plot attributes to write')
+    driver_name = DRIVERS[ext]
+    layer_name = layer_name or os.path.splitext(os.path.basename(shp_file))[0]
+    out_dir = os.path.dirname(out_file)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if update and os.path.exists(out_file):
+        return _update_plot_attributes(table, out_file, driver_name, layer_name)
+
+    src = ogr.Open(shp_file)
+    src_layer = src.GetLayer()
+    srs = src_layer.GetSpatialRef()
+    if srs is None and epsg is not None:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(int(epsg))
+
+    driver = ogr.GetDriverByName(driver_name)
+    if os.path.exists(out_file):
+        driver.DeleteDataSource(out_file)
+    ds = driver.CreateDataSource(out_file)
+    options = ['SPATIAL_INDEX=NO'] if driver_name == 'GPKG' else []
+    layer = ds.CreateLayer(layer_name, srs, src_layer.GetGeomType(), options)
+
+    # the attributes of the plots, their plot_id, then the statistics
+    src_defn = src_layer.GetLayerDefn()
+    for i in range(src_defn.GetFieldCount()):
+        if src_defn.GetFieldDefn(i).GetName() != PLOT_ID_FIELD:
+            layer.CreateField(src_defn.GetFieldDefn(i))
+    layer.CreateField(ogr.FieldDefn(PLOT_ID_FIELD, ogr.OFTString))
+    fields = {name: name for name in table.columns}
+    if driver_name != 'GPKG':
+        fields = _dbf_field_names(table.columns, {}, _field_names(layer))
+    columns = _create_columns(layer, table, fields)
+    defn = layer.GetLayerDefn()
+    id_index = defn.GetFieldIndex(PLOT_ID_FIELD)
+    rows = table.rows()
+
+    in_transaction = _begin(ds)
+    features = 0
+    for feature in src_layer:
+        geom = feature.GetGeometryRef()
+        if geom is None: # skipped when rasterized, not a plot of the statistics
+            continue
+        plot_id = str(feature.GetField(id_field) if id_field else feature.GetFID())
+        out_feature = ogr.Feature(defn)
+        out_feature.SetFrom(feature)
+        out_feature.SetField(id_index, plot_id)
+        if plot_id in rows:
+            _set_row(out_feature, columns, rows[plot_id])
+        layer.CreateFeature(out_feature)
+        features += 1
+    if in_transaction:
+        ds.CommitTransaction()
+    src = None
+
+    _create_spatial_index(ds, layer, driver_name)
+    ds = None
+    if driver_name != 'GPKG':
+        _save_field_names(out_file, fields)
+    return features
+
+def _update_plot_attributes(table, out_file, driver_name, layer_name):
+    ds = ogr.Open(out_file, 1)
+    layer = ds.GetLayerByName(layer_name) or ds.GetLayer()
+    if PLOT_ID_FIELD not in _field_names(layer):
+        raise ValueError(f'{out_file} has no {PLOT_ID_FIELD} column, it was not written by write_plot_attributes')
+    fields = {name: name for name in table.columns}
+    if driver_name != 'GPKG':
+        known = _load_field_names(out_file)
+        fields = _dbf_field_names(table.columns, known, [f for f in _field_names(layer) if f not in known.values()])
+    columns = _create_columns(layer, table, fields) # new columns only, a GeoPackage adds them without a copy
+    rows = table.rows()
+
+    # the features are read before any is rewritten, the layer is not modified while it is being iterated
+    layer.ResetReading()
+    updates = [(feature, rows[feature.GetField(PLOT_ID_FIELD)]) for feature in layer
+               if feature.GetField(PLOT_ID_FIELD) in rows]
+    in_transaction = _begin(ds)
+    for feature, row in updates:
+        _set_row(feature, columns, row)
+        layer.SetFeature(feature)
+    if in_transaction:
+        ds.CommitTransaction()
+    features = len(updates)
+    ds = None
+    if driver_name != 'GPKG':
+        known.update(fields)
+        _save_field_names(out_file, known)
+    return features
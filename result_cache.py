@@ -0,0 +1,233 @@
+"""
+Content-addressed cache of the generated VI rasters
+Every output file (a product: one VI for ENVI, the VI bundle or cc for COG) gets a key hashed from
+    - the identity of the input image (path, size, mtime, optionally a hash of its content)
+    - the version of the definition of every VI in the product (see vi_expressions.vi_definition_version)
+    - the parameters the VIs use (e.g. the cc thresholds), the output format and the writer options
+A manifest in the output folder records the key of every product, so re-runs only compute the missing or
+outdated (image, VI) products. Optionally the products are also stored in a shared cache folder (bounded in size,
+least recently used entries are evicted first) from which they are copied instead of recomputed.
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from vi_expressions import VI_PARAMETERS, compile_vis, vi_definition_version
+from vi_writers import get_output_paths
+
+CACHE_VERSION = 5 # 2: masked and undefined pixels are nodata, 3: cc stored as uint8 (ENVI) or bits (COG),
+                  # 4: cc back to the 2 band float32 ENVI layout, 5: ENVI nodata back to NaN (VIs) and 0 (cc)
+MANIFEST_NAME = '.vi_cache_manifest.json'
+
+
+def file_identity(path, hash_content = False):
+    """    Returns what identifies an input file: absolute path, size, mtime and optionally the sha256 of its content
+    """
+    st = os.stat(path)
+    identity = {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if hash_content:
+        h = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 24), b''):
+                h.update(chunk)
+        identity['sha256'] = h.hexdigest()
+    return identity
+
+def product_key(identity, img_type, vis, params = None, out_format = 'ENVI', writer_options = None):
+    """    Returns the key of a product: a sha256 of everything its content depends on
+
+           Args:
+            identity (dict)         : Identity of the input image (see file_identity)
+            img_type (str)          : Type of the image: RGB or MULTI
+            vis (list(str))         : VIs stored in the product
+            params (dict)           : Values overriding VI_PARAMETERS (default is None)
+            out_format (str)        : Output format (default is ENVI)
+            writer_options (dict)   : Options of the output writer (default is None)
+
+           Returns:
+            key (str)
+    """
+    used = {}
+    for vi in sorted(vis):
+        for name in compile_vis(img_type, [vi]).params:
+            used[name] = (params or {}).get(name, VI_PARAMETERS[name])
+    description = {
+        'cache_version'  : CACHE_VERSION,
+        'image'          : identity,
+        'img_type'       : img_type,
+        'vis'            : {vi: vi_definition_version(img_type, vi) for vi in sorted(vis)},
+        'params'         : used,
+        'out_format'     : out_format,
+        'writer_options' : writer_options or {},
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys = True, default = str).encode()).hexdigest()
+
+def _product_files(path):
+    # the main file and its sidecars (.hdr, .aux.xml, ...)
+    base = os.path.splitext(path)[0]
+    return sorted(set(glob.glob(glob.escape(base) + '.*')) | set(glob.glob(glob.escape(path) + '.*')) | {path})
+
+
+class ResultCache:
+    """    Decides which (image, VI) products have to be computed and records the ones that were
+
+           Args:
+            out_dir (str)           : The directory to which the results are saved (holds the manifest)
+            cache_dir (str)         : Shared folder storing the products by key (default is None, no shared cache)
+            max_cache_bytes (int)   : Size limit of the shared folder (default is None, unlimited)
+            force (bool)            : Recompute everything, the manifest and shared folder are still updated (default is False)
+            hash_content (bool)     : Identify the images by the hash of their content, not only size and mtime (default is False)
+    """
+    def __init__(self, out_dir, cache_dir = None, max_cache_bytes = None, force = False, hash_content = False):
+        self.out_dir = out_dir
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.force = force
+        self.hash_content = hash_content
+        self.manifest_file = os.path.join(out_dir, MANIFEST_NAME)
+        self._identities = {}
+        self.manifest = {'version': CACHE_VERSION, 'products': {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as fp:
+                manifest = json.load(fp)
+            if manifest.get('version') == CACHE_VERSION:
+                self.manifest = manifest
+
+    def _identity(self, image_file):
+        if image_file not in self._identities:
+            self._identities[image_file] = file_identity(image_file, self.hash_content)
+        return self._identities[image_file]
+
+    def _products(self, image_file, img_type, vis, params, out_format, writer_options):
+        # output file -> (VIs in it, key)
+        filename = os.path.splitext(os.path.basename(image_file))[0][:][0:8]
+        groups = {}
+        for vi, path in get_output_paths(out_format, self.out_dir, filename, vis).items():
+            groups.setdefault(path, []).append(vi)
+        identity = self._identity(image_file)
+        return {path: (group, product_key(identity, img_type, group, params, out_format, writer_options))
+                for path, group in groups.items()}
+
+    def plan(self, image_file, img_type, vis_list, params = None, out_format = 'ENVI', writer_options = None):
+        """    Returns the VIs of an image that have to be computed, products found in the shared folder are restored
+
+               Args:
+                image_file (str)        : The orthomosaic image
+                img_type (str)          : Type of the image: RGB or MULTI
+                vis_list (list(str))    : VIs selected for the image (names unknown to img_type are ignored)
+                params (dict)           : Values overriding VI_PARAMETERS (default is None)
+                out_format (str)        : Output format (default is ENVI)
+                writer_options (dict)   : Options of the output writer (default is None)
+
+               Returns:
+                todo (list(str))        : VIs to be computed, in the order of vis_list
+        """
+        vis = compile_vis(img_type, vis_list).vis
+        todo = []
+        for path, (group, key) in self._products(image_file, img_type, vis, params, out_format, writer_options).items():
+            if self.force:
+                todo.extend(group)
+                continue
+            entry = self.manifest['products'].get(os.path.relpath(path, self.out_dir))
+            if entry is not None and entry['key'] == key and all(os.path.exists(os.path.join(self.out_dir, f))
+                                                                 for f in entry['files']):
+                continue
+            if self._restore(path, key, image_file, group):
+                continue
+            todo.extend(group)
+        self.save()
+        return [vi for vi in vis if vi in todo]
+
+    def record(self, image_file, img_type, vis_list, params = None, out_format = 'ENVI', writer_options = None):
+        """    Records the products of VIs that were just computed (and stores them in the shared folder)
+        """
+        vis = compile_vis(img_type, vis_list).vis
+        for path, (group, key) in self._products(image_file, img_type, vis, params, out_format, writer_options).items():
+            files = [os.path.relpath(f, self.out_dir) for f in _product_files(path) if os.path.exists(f)]
+            self.manifest['products'][os.path.relpath(path, self.out_dir)] = {
+                'key'     : key,
+                'image'   : os.path.abspath(image_file),
+                'vis'     : group,
+                'files'   : files,
+                'created' : time.time(),
+            }
+            if self.cache_dir is not None:
+                self._store(key, files)
+        self.save()
+        if self.cache_dir is not None:
+            self.evict()
+
+    def save(self):
+        """    Writes the manifest (atomically, a crash never leaves a truncated manifest)
+        """
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        tmp = self.manifest_file + '.tmp' + uuid.uuid4().hex # other processes (and hosts) may save it too
+        with open(tmp, 'w') as fp:
+            json.dump(self.manifest, fp, indent = 1)
+        os.replace(tmp, self.manifest_file)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _store(self, key, files):
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(os.path.join(entry_dir, 'entry.json')):
+            return
+        tmp_dir = entry_dir + '.tmp' + uuid.uuid4().hex # unique across the processes and hosts sharing cache_dir
+        os.makedirs(tmp_dir, exist_ok = True)
+        for f in files:
+            dst = os.path.join(tmp_dir, f)
+            os.makedirs(os.path.dirname(dst), exist_ok = True)
+            shutil.copy2(os.path.join(self.out_dir, f), dst)
+        with open(os.path.join(tmp_dir, 'entry.json'), 'w') as fp:
+            json.dump({'key': key, 'files': files}, fp)
+        try:
+            os.rename(tmp_dir, entry_dir) # another process may have stored the same key meanwhile
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    def _restore(self, path, key, image_file, group):
+        if self.cache_dir is None:
+            return False
+        entry_dir = self._entry_dir(key)
+        entry_file = os.path.join(entry_dir, 'entry.json')
+        if not os.path.exists(entry_file):
+            return False
+        with open(entry_file) as fp:
+            files = json.load(fp)['files']
+        for f in files:
+            dst = os.path.join(self.out_dir, f)
+            os.makedirs(os.path.dirname(dst), exist_ok = True)
+            shutil.copy2(os.path.join(entry_dir, f), dst)
+        os.utime(entry_file) # most recently used
+        self.manifest['products'][os.path.relpath(path, self.out_dir)] = {
+            'key': key, 'image': os.path.abspath(image_file), 'vis': group, 'files': files, 'created': time.time()}
+        return True
+
+    def evict(self):
+        """    Removes the least recently used entries of the shared folder until it fits in max_cache_bytes
+
+               Returns:
+                removed (int)           : Number of entries removed
+        """
+        if self.cache_dir is None or self.max_cache_bytes is None or not os.path.isdir(self.cache_dir):
+            return 0
+        entries = []
+        total = 0
+        for entry_file in glob.glob(os.path.join(self.cache_dir, '*', '*', 'entry.json')):
+            entry_dir = os.path.dirname(entry_file)
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, names in os.walk(entry_dir) for f in names)
+            entries.append((os.path.getmtime(entry_file), size, entry_dir))
+            total += size
+        removed = 0
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_cache_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors = True)
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,159 @@
+"""
+Sensor profiles of the orthomosaics
+A profile says how the bands of an image type are stored in one file: the band number of every band name, the
+native data type, the scale / offset of every band (digital numbers -> reflectance) and its nodata value.
+It is detected once per file, when the file is opened (image_reader.ImageReader), from the GDAL metadata:
+    band descriptions    : e.g. Blue, Green, Red, Red edge, NIR, as written by Pix4D, Metashape, ... (BAND_ALIASES)
+    color interpretation : the red, green, blue and alpha bands of RGB(A) GeoTIFFs (any order, e.g. BGRA)
+    otherwise            : the band order of the image type (IMAGE_PROFILES), as before
+and validated against the image type chosen by the user (the RGB / MULTI option): an image of the other type, or
+with missing bands, fails at open with a message saying what the file holds instead of giving wrong VIs.
+An RGB file of 4 bands whose 4th band has neither a description nor a color interpretation (undefined, e.g. an
+RGBA GeoTIFF written without EXTRASAMPLES) keeps it as alpha, as in the default order.
+Every image of a batch gets its own profile, so batches mixing sensors (band orders, 8 / 16 bit / float data,
+reflectance scales) are read correctly.
+"""
+import numpy as np
+from osgeo import gdal
+
+# band names of every image type in their default file order, the optional bands may be missing
+IMAGE_PROFILES = {
+    'RGB'   : {'bands': ['red', 'green', 'blue', 'alpha'], 'optional': ['alpha']},
+    'MULTI' : {'bands': ['blue', 'green', 'red', 'rededge', 'nir'], 'optional': []},
+}
+
+# normalized band description (lower case, without spaces, _ and -) -> band name
+BAND_ALIASES = {
+    'red': 'red', 'r': 'red',
+    'green': 'green', 'g': 'green',
+    'blue': 'blue', 'b': 'blue',
+    'alpha': 'alpha', 'mask': 'alpha', 'a': 'alpha',
+    'rededge': 'rededge', 're': 'rededge', 'edge': 'rededge',
+    'nir': 'nir', 'nearinfrared': 'nir', 'nearir': 'nir', 'infrared': 'nir',
+}
+
+_COLOR_BANDS = {
+    gdal.GCI_RedBand   : 'red',
+    gdal.GCI_GreenBand : 'green',
+    gdal.GCI_BlueBand  : 'blue',
+    gdal.GCI_AlphaBand : 'alpha',
+}
+
+_GDAL_DTYPES = {
+    gdal.GDT_Byte    : np.uint8,
+    gdal.GDT_UInt16  : np.uint16,
+    gdal.GDT_Int16   : np.int16,
+    gdal.GDT_UInt32  : np.uint32,
+    gdal.GDT_Int32   : np.int32,
+    gdal.GDT_Float32 : np.float32,
+    gdal.GDT_Float64 : np.float64,
+}
+
+_MULTI_ONLY = ('rededge', 'nir')
+
+
+def _band_key(description):
+    return ''.join(c for c in (description or '').lower() if c.isalnum())
+
+
+class SensorProfile:
+    """    Where and how the bands of an image type are stored in one file
+
+           Attributes:
+            img_type (str)          : Image type of the band names (RGB, MULTI, or None for other band sets)
+            source (str)            : How the band order was found: descriptions, color, or default
+            band_names (list(str))  : Band names present in the file (the optional bands may be missing)
+            band_index (dict)       : Band name -> band number in the file (1 based)
+            dtype (numpy dtype)     : Native data type of the bands
+            scale, offset (dict)    : Band name -> scale / offset of the band (None when the band has none)
+            nodata (dict)           : Band name -> nodata value of the band (None when the band has none)
+    """
+    def __init__(self, img_type, source, band_index, dtype, scale, offset, nodata):
+        self.img_type = img_type
+        self.source = source
+        self.band_index = band_index
+        self.band_names = list(band_index)
+        self.dtype = np.dtype(dtype)
+        self.scale = scale
+        self.offset = offset
+        self.nodata = nodata
+
+    def __repr__(self):
+        order = ', '.join(f'{name}={k}' for name, k in self.band_index.items())
+        return f'SensorProfile({self.img_type}, {self.dtype.name}, {order}, from {self.source})'
+
+    @property
+    def scaled(self):
+        """    True when some band has a scale or an offset to apply
+        """
+        return any(v is not None for v in self.scale.values()) or any(v is not None for v in self.offset.values())
+
+    @property
+    def native(self):
+        """    True when the bands can be read in their native integer type (no scale / offset to apply)
+        """
+        return np.issubdtype(self.dtype, np.integer) and not self.scaled
+
+
+def image_type_of(band_names):
+    """    Returns the image type whose bands are band_names (e.g. RGB_BANDS -> RGB), None for other band sets
+    """
+    for img_type, profile in IMAGE_PROFILES.items():
+        if list(band_names) == profile['bands']:
+            return img_type
+    return None
+
+def detect_profile(ds, band_names):
+    """    Finds and validates where the bands are in an opened image (see the module docstring)
+
+           Args:
+            ds (gdal.Dataset)       : The opened image
+            band_names (list(str))  : Bands to be read, e.g. RGB_BANDS, MULTI_BANDS, or any names read in file order
+
+           Returns:
+            profile (SensorProfile)
+    """
+    img_type = image_type_of(band_names)
+    optional = IMAGE_PROFILES[img_type]['optional'] if img_type else []
+    required = [name for name in band_names if name not in optional]
+    count = ds.RasterCount
+    name = ds.GetDescription()
+
+    by_description = {}
+    by_color = {}
+    for k in range(1, count + 1):
+        band = ds.GetRasterBand(k)
+        alias = BAND_ALIASES.get(_band_key(band.GetDescription()))
+        if alias is not None:
+            by_description.setdefault(alias, k)
+        color = _COLOR_BANDS.get(band.GetColorInterpretation())
+        if color is not None:
+            by_color.setdefault(color, k)
+
+    if img_type == 'RGB' and any(b in by_description for b in _MULTI_ONLY):
+        raise ValueError(f'{name} is a multispectral image (bands {sorted(by_description)}), not RGB')
+    if img_type == 'MULTI' and count <= 4 and all(b in by_color for b in ('red', 'green', 'blue')):
+        raise ValueError(f'{name} is an RGB image ({count} bands), not MULTI')
+
+    if img_type and all(b in by_description for b in required):
+        source, found = 'descriptions', by_description
+    elif img_type == 'RGB' and all(b in by_color for b in required):
+        source, found = 'color', by_color
+    else:
+        if count < len(required):
+            raise ValueError(f'{name} has {count} bands, expected {len(required)} ({", ".join(required)})')
+        source, found = 'default', {band_names[k]: k + 1 for k in range(min(count, len(band_names)))}
+    if (img_type == 'RGB' and 'alpha' in band_names and 'alpha' not in found and count == 4 and 4 not in found.values()
+            and ds.GetRasterBand(4).GetColorInterpretation() == gdal.GCI_Undefined):
+        found = dict(found, alpha = 4)
+    band_index = {b: found[b] for b in band_names if b in found}
+
+    dtypes, scale, offset, nodata = [], {}, {}, {}
+    for b, k in band_index.items():
+        band = ds.GetRasterBand(k)
+        dtypes.append(_GDAL_DTYPES.get(band.DataType, np.float64))
+        s, o = band.GetScale(), band.GetOffset()
+        scale[b] = s if s not in (None, 1.0) else None
+        offset[b] = o if o not in (None, 0.0) else None
+        nodata[b] = band.GetNoDataValue()
+    return SensorProfile(img_type, source, band_index, np.result_type(*dtypes), scale, offset, nodata)
@@ -0,0 +1,18 @@
+"""
+pytest entry point of the golden output checks (check_golden_outputs): every processing mode on small synthetic
+images, compared with the reference. Skipped where GDAL is not installed.
+
+    python -m pytest -q test_golden_outputs.py
+"""
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+
+from check_golden_outputs import DEFAULT_MODES, main
+
+
+@pytest.mark.parametrize('mode', DEFAULT_MODES)
+def test_golden_outputs(mode, tmp_path):
+    # a tile size that does not divide the image, so the edge windows are checked
+    assert main(['--size', '400', '--block-size', '128', '--tile-size', '150', '--modes', mode,
+                 '--work-dir', str(tmp_path)]) == 0
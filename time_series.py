@@ -0,0 +1,184 @@
+"""
+Time series of the per plot VI statistics across flight dates
+The orthomosaics are grouped by date (the 8 character prefix of their filename, as the outputs are named), the
+dates are processed concurrently and every date gives the statistics of every plot and VI (the images of one date,
+e.g. tiles of one flight, are accumulated together). The results are kept in one compact table, a .npz file with
+    plot_ids (plot), dates (date), sources (date), vis (vi), stats (stat)
+    values   (plot, date, vi, stat) float64
+New flights are appended to the table: the dates already in it are not recomputed (unless forced).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from osgeo import gdal
+from gen_dat_files import RGB_BANDS, MULTI_BANDS, DEFAULT_TILE_SIZE, get_block_windows
+from image_reader import ImageReader
+from vi_expressions import compile_vis, valid_mask
+from zonal_stats import DEFAULT_PERCENTILES, ZonalAccumulator, get_plot_labels
+from pipeline_metrics import NULL_INSTRUMENTATION
+
+
+def image_date(image_file):
+    """    Returns the date of an orthomosaic, the first 8 characters of its filename (YYYYMMDD)
+    """
+    return os.path.basename(image_file)[0:8]
+
+def image_pixels(image_files):
+    """    Returns the number of pixels of the images (read from their headers), the work planned for a date
+    """
+    pixels = 0
+    for f in image_files:
+        ds = gdal.Open(f)
+        if ds is None:
+            raise ValueError(f'Cannot open the image {f}')
+        pixels += ds.RasterXSize * ds.RasterYSize
+        ds = None
+    return pixels
+
+def group_by_date(image_files):
+    """    Returns date -> images of that date, sorted by date
+    """
+    groups = {}
+    for f in image_files:
+        groups.setdefault(image_date(f), []).append(f)
+    return dict(sorted(groups.items()))
+
+def date_plot_stats(image_files, img_type, vis_list, shp_file, epsg = None, tile_size = DEFAULT_TILE_SIZE,
+                    percentiles = DEFAULT_PERCENTILES, index_dir = None, params = None, exact_percentiles = True):
+    """    Computes the per plot statistics of the VIs over the images of one date
+
+           Returns:
+            plot_ids (list)         : Identifier of every plot
+            stats (dict)            : VI name -> statistic name -> array with one value per plot
+            pixels (int)            : Number of pixels processed
+    """
+    band_names = RGB_BANDS if img_type == 'RGB' else MULTI_BANDS
+    program = compile_vis(img_type, vis_list)
+    accumulator = None
+    plot_ids = None
+    pixels = 0
+    for f in image_files:
+        reader = ImageReader(f, band_names, native = True)
+        labels = get_plot_labels(shp_file, reader.x_size, reader.y_size, reader.transform, reader.proj, epsg,
+                                 index_dir = index_dir)
+        if accumulator is None: # the labels of a shapefile are the same on every grid (feature order)
+            accumulator = ZonalAccumulator(len(labels), program.vis, percentiles, exact_percentiles)
+            plot_ids = labels.plot_ids
+        for window in get_block_windows(reader.ds, tile_size):
+            bands = reader.read(window)
+            vi_rasters = program.evaluate(bands, params, valid_mask(bands, reader.band_nodata))
+            accumulator.add(labels.read(window), vi_rasters)
+        pixels += reader.x_size * reader.y_size
+        labels.release()
+        reader.close()
+    return plot_ids, accumulator.finalize(), pixels
+
+def load_time_series(table_file):
+    """    Reads a time series table
+
+           Returns:
+            table (dict)            : plot_ids, dates, sources, vis, stats (lists) and values (plot, date, vi, stat),
+                                      None when the file doesn't exist
+    """
+    if not os.path.exists(table_file):
+        return None
+    with np.load(table_file, allow_pickle = False) as data:
+        table = {name: data[name].tolist() for name in ('plot_ids', 'dates', 'sources', 'vis', 'stats')}
+        table['values'] = data['values']
+    return table
+
+def save_time_series(table_file, table):
+    """    Writes a time series table (atomically, a crash never leaves a truncated table)
+    """
+    out_dir = os.path.dirname(table_file)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    tmp = table_file + '.tmp.npz'
+    np.savez_compressed(tmp, values = table['values'],
+                        **{name: np.array([str(v) for v in table[name]]) for name in ('plot_ids', 'dates', 'sources', 'vis', 'stats')})
+    os.replace(tmp, table_file)
+
+def date_values(stats, vis, stat_names):
+    """    Returns the (plot, vi, stat) array of the statistics of one date
+    """
+    return np.stack([np.stack([np.asarray(stats[vi][s], np.float64) for s in stat_names], axis = -1) for vi in vis], axis = 1)
+
+def update_time_series(image_files, table_file, img_type, vis_list, shp_file, epsg = None, tile_size = DEFAULT_TILE_SIZE,
+                       workers = None, percentiles = DEFAULT_PERCENTILES, force = False, index_dir = None, params = None,
+                       metrics = None, exact_percentiles = True):
+    """    Adds the dates of the images that are not in the time series table yet
+
+           Args:
+            image_files (list(str)) : Orthomosaics of any number of dates
+            table_file (str)        : The .npz table, created on the first run
+            img_type (str)          : Type of images to be processed: RGB or MULTI
+            vis_list (list(str))    : VIs of the table (must match the table when it exists)
+            shp_file (str)          : Shapefile with the field plots
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            tile_size (int)         : Target edge of a window in pixels (default is DEFAULT_TILE_SIZE)
+            workers (int)           : If more than 1, process the dates in a pool of processes (default is None)
+            percentiles (tuple)     : Percentiles to be reported (default is DEFAULT_PERCENTILES)
+            force (bool)            : Recompute the dates already in the table (default is False)
+            index_dir (str)         : Folder of the plot index (default is None, see zonal_stats.get_plot_labels)
+            params (dict)           : Values overriding vi_expressions.VI_PARAMETERS (default is None)
+            metrics (Instrumentation): Receives the progress in pixels, like the other steps, reported per date (default is None)
+            exact_percentiles (bool): Exact percentiles, keeping every plot pixel of a date, False for the per plot
+                                      histograms (default is True, see zonal_stats.ZonalAccumulator)
+
+           Returns:
+            table (dict)            : The updated table (see load_time_series)
+            added (list(str))       : Dates computed by this run
+    """
+    metrics = metrics or NULL_INSTRUMENTATION
+    vis = compile_vis(img_type, vis_list).vis
+    stat_names = ZonalAccumulator(0, [], percentiles).stat_names()
+    table = load_time_series(table_file)
+    if table is not None and (table['vis'] != vis or table['stats'] != stat_names):
+        raise ValueError(f'{table_file} holds the VIs {table["vis"]} with {table["stats"]}, '
+                         f'got {vis} with {stat_names}: use another table')
+
+    groups = group_by_date(image_files)
+    todo = {date: files for date, files in groups.items() if force or table is None or date not in table['dates']}
+    if not todo:
+        return table, []
+    metrics.plan(sum(image_pixels(files) for files in todo.values()))
+
+    results = {}
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = {date: pool.submit(date_plot_stats, files, img_type, vis, shp_file, epsg, tile_size, percentiles,
+                                         index_dir, params, exact_percentiles) for date, files in todo.items()}
+            for date in todo:
+                results[date] = futures[date].result()
+                metrics.progress(results[date][2], date)
+    else:
+        for date, files in todo.items():
+            results[date] = date_plot_stats(files, img_type, vis, shp_file, epsg, tile_size, percentiles, index_dir, params,
+                                            exact_percentiles)
+            metrics.progress(results[date][2], date)
+
+    columns = {} # date -> (source, (plot, vi, stat) values)
+    plot_ids = None
+    if table is not None:
+        plot_ids = [str(p) for p in table['plot_ids']]
+        for k, date in enumerate(table['dates']):
+            columns[date] = (table['sources'][k], table['values'][:, k])
+    for date, (ids, stats, _) in results.items():
+        ids = [str(p) for p in ids]
+        if plot_ids is None:
+            plot_ids = ids
+        elif ids != plot_ids:
+            raise ValueError(f'The plots of {date} differ from the plots of {table_file}: use another table')
+        columns[date] = (';'.join(os.path.basename(f) for f in todo[date]), date_values(stats, vis, stat_names))
+
+    dates = sorted(columns)
+    table = {
+        'plot_ids' : plot_ids,
+        'dates'    : dates,
+        'sources'  : [columns[d][0] for d in dates],
+        'vis'      : vis,
+        'stats'    : stat_names,
+        'values'   : np.stack([columns[d][1] for d in dates], axis = 1),
+    }
+    save_time_series(table_file, table)
+    return table, list(todo)
@@ -0,0 +1,491 @@
+"""
+VI expression engine
+Every Vegitation Index (VI) is defined once as an arithmetic expression over the band names.
+The selected VIs are parsed into a single DAG in which common subexpressions (e.g. red+green+blue, nir-red)
+are shared, so they are evaluated only once per image/window. Temporaries are freed (or computed in place)
+as soon as their last consumer has run.
+Invalid pixels get one defined nodata value in the same pass: pixels outside the valid mask (alpha = 0 or band
+nodata) and pixels where a formula is undefined (zero denominators, square roots of negative values) are set to
+VI_NODATA, or CLASS_NODATA for the 0/1 class VIs (e.g. cc). On valid pixels the values are those of the formulas.
+Bands read in their native integer type (e.g. uint8 RGB, see image_reader) go to the kernels registered for that
+type (VI_KERNELS, e.g. cc in int16 arithmetic), the other VIs are evaluated on float32 copies of the bands they use.
+A kernel gives exactly the values of the expression and is only used while the VI keeps the definition it was
+written for.
+"""
+import ast
+import hashlib
+import operator
+from fractions import Fraction
+import numpy as np
+
+
+# Named terms that can be used inside the VI definitions (expanded before building the DAG)
+VI_TERMS = {
+    'RGB': {
+        'rgb_sum' : 'red + green + blue',
+        'red_s'   : 'red / rgb_sum',
+        'green_s' : 'green / rgb_sum',
+        'blue_s'  : 'blue / rgb_sum',
+    },
+    'MULTI': {},
+}
+
+# VI name -> expression, per image type. Operation order follows the original formulas so the results are identical
+VI_DEFINITIONS = {
+    'RGB': {
+        'exg'   : '2 * green_s - red_s - blue_s',
+        'grvi'  : '(green - red) / (green + red)',
+        'mgrvi' : '(green ** 2 - red ** 2) / (green ** 2 + red ** 2)',
+        'rgbvi' : '(green ** 2 - red * blue) / (green ** 2 + red * blue)',
+        'exgr'  : '2 * green_s - red_s - blue_s - 1.4 * red_s - green_s',
+        # red / green < th1 without the ratio rasters: same classes (green = 0 is never canopy in both forms)
+        'cc'    : '(red < th1 * green) * (blue < th2 * green) * (2 * green - blue - red > th3)',
+    },
+    'MULTI': {
+        'ndvi'  : '(nir - red) / (nir + red)',
+        'ndre'  : '(nir - rededge) / (nir + rededge)',
+        'gndvi' : '(nir - green) / (nir + green)',
+        'savi'  : '((nir - red) * 1.5) / (nir + red + 0.5)',
+        'osavi' : '((nir - red) * 1.16) / (nir + red + 0.16)',
+        'msavi' : '0.5 * (2 * nir + 1 - ((2 * nir + 1) ** 2 - 8 * (nir - red)) ** (1.0 / 2))',
+        'gci'   : 'nir / green - 1',
+        'reci'  : 'nir / rededge - 1',
+        'grvi'  : '(green - red) / (green + red)',
+    },
+}
+
+VI_NODATA    = -10000.0   # nodata of the continuous VIs (outside of the range of every VI)
+CLASS_NODATA = 255        # nodata of the class VIs (comparisons, e.g. cc), stored as uint8 0/1
+
+VI_KERNELS = {} # (img_type, vi, dtype name) -> (definition version, kernel), see register_kernel
+
+# Tunable parameters used by the VI definitions and their default values
+VI_PARAMETERS = {
+    'th1' : 0.95,   # cc: red/green threshold
+    'th2' : 0.95,   # cc: blue/green threshold
+    'th3' : 20,     # cc: 2*green-blue-red threshold
+}
+
+_BIN_OPS = {
+    ast.Add  : ('add', np.add),
+    ast.Sub  : ('sub', np.subtract),
+    ast.Mult : ('mul', np.multiply),
+    ast.Div  : ('div', np.true_divide),
+    ast.Pow  : ('pow', operator.pow), # ndarray.__pow__ keeps the square/sqrt fast paths of the original formulas
+}
+
+_CMP_OPS = {
+    ast.Lt   : ('lt', np.less),
+    ast.LtE  : ('le', np.less_equal),
+    ast.Gt   : ('gt', np.greater),
+    ast.GtE  : ('ge', np.greater_equal),
+}
+
+# x ** 2 and x ** 0.5 as ufuncs, so they can be computed in place (same results as the ndarray fast paths)
+_POW_UFUNCS = {
+    2   : ('square', np.square),
+    0.5 : ('sqrt', np.sqrt),
+}
+
+_COMMUTATIVE = ('add', 'mul')
+_INPLACE = ('add', 'sub', 'mul', 'div', 'neg', 'square', 'sqrt', 'lt', 'le', 'gt', 'ge')
+
+
+def register_vi(img_type, vi_name, expression):
+    """    Adds (or replaces) a VI definition in the registry
+
+           Args:
+            img_type (str)      : Type of images the VI applies to: RGB or MULTI
+            vi_name (str)       : Name of the VI
+            expression (str)    : Arithmetic expression over the band names, terms and parameters
+
+           Returns:
+            none
+    """
+    _parse(expression) # fail early on unsupported syntax
+    VI_DEFINITIONS.setdefault(img_type, {})[vi_name] = expression
+    VI_TERMS.setdefault(img_type, {})
+
+def get_vi_names(img_type):
+    """    Returns the names of the VIs defined for an image type (empty list for unknown types)
+    """
+    return list(VI_DEFINITIONS.get(img_type, {}).keys())
+
+def expand_vi_expression(img_type, vi_name):
+    """    Returns the VI expression with all named terms substituted (used to version VI definitions)
+    """
+    return ast.unparse(_expand(_parse(VI_DEFINITIONS[img_type][vi_name]), VI_TERMS.get(img_type, {})))
+
+def vi_definition_version(img_type, vi_name):
+    """    Returns a short hash identifying the current definition of a VI, it changes whenever the formula changes
+    """
+    return hashlib.sha1(expand_vi_expression(img_type, vi_name).encode()).hexdigest()[:12]
+
+def compile_vis(img_type, vis_list):
+    """    Builds a VIProgram computing the given VIs in a single pass
+
+           Args:
+            img_type (str)          : Type of images to be processed: RGB or MULTI
+            vis_list (list(str))    : List of VIs to be computed, names unknown to img_type are ignored (e.g. ch, cv)
+
+           Returns:
+            program (VIProgram)     : Compiled program, reusable for every image/window of the same type
+    """
+    return VIProgram(img_type, [vi for vi in vis_list if vi in VI_DEFINITIONS.get(img_type, {})])
+
+def register_kernel(img_type, vi_name, dtype, func):
+    """    Registers a kernel computing a VI from bands of a native data type, for the current definition of the VI
+
+           Args:
+            img_type (str)      : Type of images the VI applies to: RGB or MULTI
+            vi_name (str)       : Name of the VI
+            dtype (str)         : Native data type of the bands, e.g. uint8
+            func (callable)     : func(bands, params, mask) -> the VI raster as evaluate() gives it, or None when it
+                                  can't compute it exactly for these params (the expression is then evaluated)
+
+           Returns:
+            none
+    """
+    VI_KERNELS[(img_type, vi_name, np.dtype(dtype).name)] = (vi_definition_version(img_type, vi_name), func)
+
+def get_kernel(img_type, vi_name, dtype):
+    """    Returns the kernel of a VI for bands of a native data type, None when there is none (or the VI was redefined)
+    """
+    version, func = VI_KERNELS.get((img_type, vi_name, np.dtype(dtype).name), (None, None))
+    if func is None or version != vi_definition_version(img_type, vi_name):
+        return None
+    return func
+
+def valid_mask(bands, band_nodata = None):
+    """    Returns the mask of the valid pixels of a window (None when every pixel is valid)
+
+           Args:
+            bands (dict)            : Band name -> numpy array, the pixels with alpha = 0 are invalid
+            band_nodata (dict)      : Band name -> nodata value of the band, or None (default is None)
+
+           Returns:
+            mask (numpy array)      : bool, True for the valid pixels
+    """
+    mask = None
+    if 'alpha' in bands:
+        mask = bands['alpha'] > 0
+    for name, value in (band_nodata or {}).items():
+        if value is None or name == 'alpha' or name not in bands:
+            continue
+        valid = ~np.isnan(bands[name]) if np.isnan(value) else bands[name] != value
+        mask = valid if mask is None else np.logical_and(mask, valid, out = mask)
+    return mask
+
+def output_nodata(raster):
+    """    Returns the nodata value of a VI raster computed by a VIProgram (depends on its data type)
+    """
+    return CLASS_NODATA if raster.dtype == np.uint8 else VI_NODATA
+
+
+def _parse(expression):
+    tree = ast.parse(expression, mode = 'eval').body
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Constant, ast.Load,
+                                 ast.USub, ast.UAdd, *_BIN_OPS, *_CMP_OPS)):
+            raise ValueError(f'Unsupported syntax in VI expression: {expression}')
+        if isinstance(node, ast.Compare) and len(node.ops) != 1:
+            raise ValueError(f'Chained comparisons are not supported: {expression}')
+    return tree
+
+def _expand(node, terms, seen = ()):
+    if isinstance(node, ast.Name) and node.id in terms:
+        if node.id in seen:
+            raise ValueError(f'Recursive VI term: {node.id}')
+        return _expand(_parse(terms[node.id]), terms, seen + (node.id,))
+    for field, value in ast.iter_fields(node):
+        if isinstance(value, ast.AST):
+            setattr(node, field, _expand(value, terms, seen))
+        elif isinstance(value, list):
+            setattr(node, field, [_expand(v, terms, seen) if isinstance(v, ast.AST) else v for v in value])
+    return node
+
+
+class VIProgram:
+    """    A set of VIs compiled into a DAG of numpy operations with shared subexpressions
+
+           Attributes:
+            img_type (str)          : Type of images the program applies to
+            vis (list(str))         : VIs produced by evaluate()
+            inputs (list(str))      : Band names read by the program
+            params (list(str))      : Parameter names used by the program
+    """
+    def __init__(self, img_type, vis_list):
+        self.img_type = img_type
+        self.vis = list(vis_list)
+        self.inputs = []
+        self.params = []
+        self._nodes = []        # (kind, op_name, func, args) in topological order
+        self._keys = {}         # canonical key -> node index (common subexpression elimination)
+        self._outputs = {}      # vi -> node index
+        terms = VI_TERMS.get(img_type, {})
+        for vi in self.vis:
+            self._outputs[vi] = self._build(_expand(_parse(VI_DEFINITIONS[img_type][vi]), terms))
+
+        # number of consumers of every node, used to free temporaries or overwrite them in place
+        self._uses = [0] * len(self._nodes)
+        for kind, op_name, func, args in self._nodes:
+            for a in args:
+                self._uses[a] += 1
+        self._pool = []         # released temporaries reused as out= buffers by the next windows
+        self._native = {}       # (dtype, vis) -> program of the VIs without a kernel for bands of that native type
+
+    def __repr__(self):
+        return f'VIProgram({self.img_type}, {self.vis}, {self.num_operations()} operations)'
+
+    def num_operations(self):
+        """    Returns the number of array operations evaluated per window
+        """
+        return sum(1 for kind, op_name, func, args in self._nodes if kind == 'op')
+
+    def _add(self, key, node):
+        if key not in self._keys:
+            self._keys[key] = len(self._nodes)
+            self._nodes.append(node)
+        return self._keys[key]
+
+    def _build(self, node):
+        if isinstance(node, ast.Constant):
+            return self._add(('const', node.value), ('const', None, node.value, ()))
+        if isinstance(node, ast.Name):
+            if node.id in VI_PARAMETERS:
+                if node.id not in self.params:
+                    self.params.append(node.id)
+                return self._add(('param', node.id), ('param', None, node.id, ()))
+            if node.id not in self.inputs:
+                self.inputs.append(node.id)
+            return self._add(('input', node.id), ('input', None, node.id, ()))
+        if isinstance(node, ast.UnaryOp):
+            arg = self._build(node.operand)
+            if isinstance(node.op, ast.UAdd):
+                return arg
+            if self._nodes[arg][0] == 'const':
+                return self._add(('const', -self._nodes[arg][2]), ('const', None, -self._nodes[arg][2], ()))
+            return self._add(('neg', arg), ('op', 'neg', np.negative, (arg,)))
+        if isinstance(node, ast.Compare):
+            op_name, func = _CMP_OPS[type(node.ops[0])]
+            left = node.left; right = node.comparators[0]
+        else:
+            op_name, func = _BIN_OPS[type(node.op)]
+            left = node.left; right = node.right
+        a = self._build(left); b = self._build(right)
+        if self._nodes[a][0] == 'const' and self._nodes[b][0] == 'const': # fold constants, e.g. 1.0/2
+            value = func(self._nodes[a][2], self._nodes[b][2])
+            return self._add(('const', value), ('const', None, value, ()))
+        if op_name == 'pow' and self._nodes[b][0] == 'const' and self._nodes[b][2] in _POW_UFUNCS:
+            op_name, func = _POW_UFUNCS[self._nodes[b][2]]
+            return self._add((op_name, a), ('op', op_name, func, (a,)))
+        key_args = tuple(sorted((a, b))) if op_name in _COMMUTATIVE else (a, b)
+        return self._add((op_name,) + key_args, ('op', op_name, func, (a, b)))
+
+    def evaluate(self, bands, params = None, mask = None):
+        """    Computes all VIs of the program
+
+               Args:
+                bands (dict)        : Band name -> float32 numpy array (all arrays of the same shape), or arrays of the
+                                      native integer type of the image (see the module docstring)
+                params (dict)       : Values overriding VI_PARAMETERS (default is None)
+                mask (numpy array)  : bool, True for the valid pixels (default is None, valid_mask(bands): alpha > 0)
+
+               Returns:
+                results (dict)      : VI name -> numpy array, float32 (nodata VI_NODATA) or uint8 for the class VIs
+                                      (nodata CLASS_NODATA)
+        """
+        if any(bands[name].dtype != np.float32 for name in self.inputs):
+            return self._evaluate_native(bands, params, mask)
+        shapes = set(bands[name].shape for name in self.inputs)
+        self._pool = [buf for buf in self._pool if buf.shape in shapes] # drop buffers of differently sized windows
+        if mask is None:
+            mask = valid_mask(bands)
+
+        values = [None] * len(self._nodes)
+        remaining = list(self._uses)
+        outputs = set(self._outputs.values())
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'): # undefined pixels become nodata
+            self._run(bands, params, values, remaining, outputs)
+
+        # one pass per VI setting the invalid and undefined pixels to nodata
+        invalid = None
+        if mask is not None:
+            invalid = self._buffer(mask.shape, bool)
+            np.logical_not(mask, out = invalid)
+        scratch = None
+        done = {}
+        for i in outputs:
+            raster = values[i]
+            if not isinstance(raster, np.ndarray):
+                continue
+            if self._nodes[i][0] != 'op': # a band returned as is, don't modify the input
+                raster = raster.copy()
+            if raster.dtype == bool:
+                raster = raster.view(np.uint8)
+                if invalid is not None:
+                    np.copyto(raster, CLASS_NODATA, where = invalid)
+            else:
+                if scratch is None:
+                    scratch = self._buffer(raster.shape, bool)
+                np.isfinite(raster, out = scratch)
+                np.logical_not(scratch, out = scratch)
+                if invalid is not None:
+                    np.logical_or(scratch, invalid, out = scratch)
+                np.copyto(raster, VI_NODATA, where = scratch)
+            done[i] = raster
+        for buf in (invalid, scratch):
+            if buf is not None:
+                self._pool.append(buf)
+
+        results = {}
+        for vi in self.vis:
+            i = self._outputs[vi]
+            results[vi] = done.get(i, values[i])
+        return results
+
+    def _evaluate_native(self, bands, params, mask):
+        # the VIs with a kernel for the native type of the bands, the others on float32 copies of their bands
+        dtype = np.result_type(*[bands[name] for name in self.inputs])
+        if mask is None:
+            mask = valid_mask(bands)
+        results = {}
+        rest = []
+        for vi in self.vis:
+            kernel = get_kernel(self.img_type, vi, dtype)
+            raster = kernel(bands, params, mask) if kernel is not None else None
+            if raster is None:
+                rest.append(vi)
+            else:
+                results[vi] = raster
+        if rest:
+            key = (dtype.name, tuple(rest))
+            if key not in self._native:
+                self._native[key] = VIProgram(self.img_type, rest)
+            program = self._native[key]
+            floats = {}
+            for name in program.inputs:
+                floats[name] = self._buffer(bands[name].shape, np.float32)
+                np.copyto(floats[name], bands[name])
+            results.update(program.evaluate(floats, params, mask))
+            self._pool.extend(floats.values()) # the results never alias the input bands
+        return {vi: results[vi] for vi in self.vis}
+
+    def _buffer(self, shape, dtype):
+        for k, buf in enumerate(self._pool):
+            if buf.shape == shape and buf.dtype == dtype:
+                return self._pool.pop(k)
+        return np.empty(shape, dtype)
+
+    def _run(self, bands, params, values, remaining, outputs):
+        for i, (kind, op_name, func, args) in enumerate(self._nodes):
+            if kind == 'const':
+                values[i] = func
+                continue
+            if kind == 'input':
+                values[i] = bands[func]
+                continue
+            if kind == 'param':
+                values[i] = params[func] if params is not None and func in params else VI_PARAMETERS[func]
+                continue
+
+            operands = [values[a] for a in args]
+            out = None
+            if op_name in _INPLACE:
+                out = self._find_out(i, args, operands, remaining, outputs)
+            if out is not None:
+                values[i] = func(*operands, out = out)
+            else:
+                values[i] = func(*operands)
+
+            # release temporaries whose last consumer just ran
+            for a in args:
+                remaining[a] -= 1
+                if remaining[a] == 0 and a not in outputs and self._nodes[a][0] == 'op':
+                    if values[a] is not values[i] and isinstance(values[a], np.ndarray):
+                        self._pool.append(values[a])
+                    values[a] = None
+
+    def _find_out(self, i, args, operands, remaining, outputs):
+        # an operand that is a temporary at its last use can be overwritten with the result
+        arrays = [o for o in operands if isinstance(o, np.ndarray)]
+        if not arrays:
+            return None
+        shape = np.broadcast_shapes(*[o.shape for o in arrays])
+        dtype = np.result_type(*operands)
+        if self._nodes[i][1] in ('lt', 'le', 'gt', 'ge'):
+            dtype = np.dtype(bool)
+        for a, o in zip(args, operands):
+            if (self._nodes[a][0] == 'op' and remaining[a] == 1 and a not in outputs and args.count(a) == 1
+                    and isinstance(o, np.ndarray) and o.shape == shape and o.dtype == dtype):
+                return o
+        # otherwise reuse a buffer released by an earlier operation or window
+        for k, buf in enumerate(self._pool):
+            if buf.shape == shape and buf.dtype == dtype:
+                return self._pool.pop(k)
+        return None
+
+
+# Kernels specialized per native data type
+
+_CC_INT_LIMIT = 128 # int16 arithmetic: 255 * 128 < 2 ** 15
+_cc_thresholds = {}
+
+def _param_value(params, name):
+    return params[name] if params is not None and name in params else VI_PARAMETERS[name]
+
+def _int_ratio(th):
+    # (m, k) with red * k < m * green exactly when red < th * green in float32 (as the expression), for every uint8
+    # red and green, None when no such small integers exist
+    frac = Fraction(float(np.float32(th))).limit_denominator(_CC_INT_LIMIT)
+    m, k = frac.numerator, frac.denominator
+    if not 0 <= m <= _CC_INT_LIMIT:
+        return None
+    values = np.arange(256, dtype = np.float32)
+    expected = values[:, None] < th * values[None, :]
+    ints = np.arange(256, dtype = np.int32)
+    if not np.array_equal(ints[:, None] * k < m * ints[None, :], expected):
+        return None
+    return m, k
+
+def _int_threshold(th):
+    # t with v > t exactly when v > th in float32, for every integer v = 2 * green - blue - red of uint8 bands
+    values = np.arange(-510, 511, dtype = np.float32)
+    expected = values > th
+    t = int(np.count_nonzero(~expected)) - 511
+    if not np.array_equal(np.arange(-510, 511) > t, expected):
+        return None
+    return t
+
+def _cc_uint8(bands, params, mask):
+    """    cc of uint8 RGB bands in int16 arithmetic, the float thresholds replaced by exactly equivalent integer ones
+    """
+    key = tuple(_param_value(params, name) for name in ('th1', 'th2', 'th3'))
+    if key not in _cc_thresholds:
+        _cc_thresholds[key] = (_int_ratio(key[0]), _int_ratio(key[1]), _int_threshold(key[2]))
+    (ratio1, ratio2, t3) = _cc_thresholds[key]
+    if ratio1 is None or ratio2 is None or t3 is None:
+        return None
+    red = bands['red'].astype(np.int16)
+    green = bands['green'].astype(np.int16)
+    blue = bands['blue'].astype(np.int16)
+    right = np.multiply(green, ratio1[0])
+    left = np.multiply(red, ratio1[1])
+    cc = np.less(left, right)
+    if ratio2 != ratio1:
+        np.multiply(green, ratio2[0], out = right)
+    np.multiply(blue, ratio2[1], out = left)
+    test = np.less(left, right)
+    cc &= test
+    np.add(green, green, out = right)
+    right -= blue
+    right -= red
+    np.greater(right, t3, out = test)
+    cc &= test
+    cc = cc.view(np.uint8)
+    if mask is not None:
+        np.copyto(cc, CLASS_NODATA, where = ~mask)
+    return cc
+
+register_kernel('RGB', 'cc', 'uint8', _cc_uint8)
@@ -0,0 +1,163 @@
+"""
+Quick-look previews of the Vegitation Indecies (VIs) at reduced resolution
+The bands are read once, decimated to about max_size pixels on the longest edge: from the overviews of the image
+when it has some (GDAL picks the closest level), otherwise from a decimated copy built once and cached by the
+identity of the image. The VIs are then evaluated from the bands in memory, so changing a parameter (e.g. the cc
+thresholds th1, th2, th3) re-evaluates the preview in milliseconds. The previews are rendered as PPM images, which
+Tk (PhotoImage) and most viewers read without any imaging library.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+from osgeo import gdal
+from gen_dat_files import RGB_BANDS, MULTI_BANDS
+from result_cache import file_identity
+from sensor_profiles import detect_profile
+from vi_expressions import VI_NODATA, CLASS_NODATA, compile_vis, valid_mask
+
+DEFAULT_PREVIEW_SIZE = 1024
+PREVIEW_DIR_NAME     = 'vi_preview'
+
+# colour ramp of the continuous VIs (low -> high) and colours of the cc classes (0, 1)
+VI_RAMP   = np.array([[165, 0, 38], [255, 255, 191], [0, 104, 55]], np.float32)
+CC_COLORS = np.array([[200, 180, 140], [0, 150, 0]], np.uint8)
+NODATA_COLOR = np.array([0, 0, 0], np.uint8)
+
+
+def preview_size(x_size, y_size, max_size = DEFAULT_PREVIEW_SIZE):
+    """    Returns the (x, y) size of the preview of an image, the full size when it is already small
+    """
+    scale = max(x_size, y_size) / float(max_size)
+    if scale <= 1:
+        return x_size, y_size
+    return max(1, int(round(x_size / scale))), max(1, int(round(y_size / scale)))
+
+def _decimated_copy(image_file, x, y, cache_dir):
+    # image without overviews: one decimated copy per image (and preview size), reused by every later preview
+    identity = file_identity(image_file)
+    key = hashlib.sha256(json.dumps([identity, x, y], sort_keys = True).encode()).hexdigest()
+    out_file = os.path.join(cache_dir, key + '.tif')
+    if not os.path.exists(out_file):
+        os.makedirs(cache_dir, exist_ok = True)
+        tmp = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp.tif')
+        gdal.Translate(tmp, image_file, width = x, height = y, resampleAlg = 'average',
+                       creationOptions = ['TILED=YES', 'COMPRESS=DEFLATE'])
+        os.replace(tmp, out_file)
+    return out_file
+
+
+class PreviewSource:
+    """    Bands of an orthomosaic decimated for previews, kept in memory
+
+           Args:
+            image_file (str)        : The orthomosaic image
+            img_type (str)          : Type of the image: RGB or MULTI
+            max_size (int)          : Longest edge of the preview in pixels (default is DEFAULT_PREVIEW_SIZE)
+            cache_dir (str)         : Folder of the decimated copies of images without overviews
+                                      (default is None, vi_preview in the temporary folder)
+
+           Attributes:
+            x_size, y_size (int)    : Size of the preview
+            scale (float)           : Full resolution pixels per preview pixel
+            source (str)            : overviews, cache or full (the image is small enough)
+            profile (SensorProfile) : Band order, scale / offset and nodata of the image (see sensor_profiles)
+    """
+    def __init__(self, image_file, img_type, max_size = DEFAULT_PREVIEW_SIZE, cache_dir = None):
+        self.image_file = image_file
+        self.img_type = img_type
+        ds = gdal.Open(image_file)
+        self.profile = detect_profile(ds, RGB_BANDS if img_type == 'RGB' else MULTI_BANDS) # the band order, as read
+        full_x, full_y = ds.RasterXSize, ds.RasterYSize
+        self.x_size, self.y_size = preview_size(full_x, full_y, max_size)
+        self.scale = full_x / float(self.x_size)
+
+        if (self.x_size, self.y_size) == (full_x, full_y):
+            self.source = 'full'
+        elif ds.GetRasterBand(1).GetOverviewCount() > 0:
+            self.source = 'overviews'
+        else:
+            self.source = 'cache'
+            ds = gdal.Open(_decimated_copy(image_file, self.x_size, self.y_size,
+                                           cache_dir or os.path.join(tempfile.gettempdir(), PREVIEW_DIR_NAME)))
+
+        # decimated reads straight into float32, GDAL uses the closest overview level (the decimated copy keeps the
+        # band order of the image), then scaled to physical values as image_reader.ImageReader does
+        self.bands = {}
+        for name, k in self.profile.band_index.items():
+            buf = np.empty((self.y_size, self.x_size), np.float32)
+            ds.GetRasterBand(k).ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize, buf_xsize = self.x_size,
+                                            buf_ysize = self.y_size, buf_obj = buf, resample_alg = gdal.GRIORA_Average)
+            self.bands[name] = buf
+        self.mask = valid_mask(self.bands, self.profile.nodata)
+        for name, band in self.bands.items():
+            if name != 'alpha' and self.profile.scale[name] is not None:
+                band *= self.profile.scale[name]
+            if name != 'alpha' and self.profile.offset[name] is not None:
+                band += self.profile.offset[name]
+        self._programs = {}
+
+    def evaluate(self, vis_list, params = None):
+        """    Computes VIs on the preview bands
+
+               Args:
+                vis_list (list(str))    : VIs to be computed
+                params (dict)           : Values overriding vi_expressions.VI_PARAMETERS, e.g. th1, th2, th3 (default is None)
+
+               Returns:
+                vi_rasters (dict)       : VI name -> numpy array of the preview
+        """
+        key = tuple(vis_list)
+        if key not in self._programs:
+            self._programs[key] = compile_vis(self.img_type, vis_list)
+        return self._programs[key].evaluate(self.bands, params, self.mask)
+
+
+def render_rgb(raster):
+    """    Colours a VI raster: the class VIs (uint8, e.g. cc) with CC_COLORS, the continuous VIs with VI_RAMP
+           stretched between their 2nd and 98th percentiles. Nodata pixels are NODATA_COLOR.
+
+           Returns:
+            rgb (numpy array)       : (rows, cols, 3) uint8
+    """
+    rgb = np.empty(raster.shape + (3,), np.uint8)
+    if raster.dtype == np.uint8:
+        rgb[...] = CC_COLORS[np.minimum(raster, 1)]
+        rgb[raster == CLASS_NODATA] = NODATA_COLOR
+        return rgb
+    valid = raster != VI_NODATA
+    if valid.any():
+        lo, hi = np.percentile(raster[valid], [2, 98])
+    else:
+        lo, hi = 0.0, 1.0
+    t = np.clip((raster - lo) / ((hi - lo) or 1.0), 0, 1) * (len(VI_RAMP) - 1)
+    stops = np.arange(len(VI_RAMP))
+    for c in range(3):
+        rgb[..., c] = np.interp(t, stops, VI_RAMP[:, c]).astype(np.uint8)
+    rgb[~valid] = NODATA_COLOR
+    return rgb
+
+def to_ppm(raster):
+    """    Returns a VI raster rendered as binary PPM (P6) data, e.g. for tk.PhotoImage(data = ..., format = 'PPM')
+    """
+    rgb = render_rgb(raster)
+    return b'P6 %d %d 255\n' % (rgb.shape[1], rgb.shape[0]) + rgb.tobytes()
+
+def save_previews(image_files, out_dir, img_type, vis_list, params = None, max_size = DEFAULT_PREVIEW_SIZE):
+    """    Saves the previews of the VIs of every image to <out_dir>/preview/<filename>_<vi>.ppm
+
+           Returns:
+            paths (list(str))       : Saved previews
+    """
+    preview_dir = os.path.join(out_dir, 'preview')
+    if not os.path.exists(preview_dir):
+        os.makedirs(preview_dir)
+    paths = []
+    for f in image_files:
+        filename = os.path.splitext(os.path.basename(f))[0][:][0:8]
+        for vi, raster in PreviewSource(f, img_type, max_size).evaluate(vis_list, params).items():
+            paths.append(os.path.join(preview_dir, filename + '_' + vi + '.ppm'))
+            with open(paths[-1], 'wb') as fp:
+                fp.write(to_ppm(raster))
+    return paths
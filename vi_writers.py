@@ -0,0 +1,297 @@
+"""
+Output writers for the Vegitation Indecies (VIs)
+A writer is opened once per orthomosaic, receives the computed VIs window by window and is closed at the end.
+    ENVI : one uncompressed 2 band float32 .dat per VI (band 2 is the alpha band of RGB images), the original layout,
+           kept as is for cc (0 / 1 as float32, see canopy_cover for the compact cc masks)
+    COG  : one tiled, compressed Cloud-Optimized GeoTIFF with overviews holding all selected VIs (one band each),
+           plus a uint8 or 1 bit COG for cc (GeoTIFF bands share one data type)
+The masked pixels already hold the nodata value of the VI program (vi_expressions.VI_NODATA / CLASS_NODATA).
+The COG writer declares it as the nodata value of the bands. The ENVI writer keeps the values of the original .dat
+files, read by the boundary steps with nan-aware statistics and without the header nodata: NaN for the masked and
+undefined pixels of the continuous VIs, 0 for the masked pixels of cc, no nodata in the header (see envi_values).
+"""
+import os
+import numpy as np
+from osgeo import gdal
+from vi_expressions import VI_NODATA, CLASS_NODATA, output_nodata
+
+COG_VI_DTYPES = ['float32', 'float16', 'int16'] # storage of the continuous VIs in the COG writer
+COG_CC_NBITS  = [8, 1]                          # storage of cc in the COG writer: uint8 or bit-packed
+INT16_NODATA  = -32768
+
+
+def create_vi_dat_file(out, vi_name, filename, x, y, transform, proj):
+    """    Creates an empty .dat file for the given Vegitation Index (VI) so it can be filled window by window
+
+           Args:
+            out (str)           : The directory to which the results will be saved
+            vi_name (str)       : Name of the VI for which the dat file will be created
+            file_name (str)     : Name of the orthomosaic image file
+            x (int)             : x size of the orthomosaic
+            y (int)             : y size of the orthomosaic
+            transform (tuple)   : Orthomosaic geotransform
+            proj (tuple)        : Orthomosaic projection
+
+           Returns:
+            outds (gdal.Dataset): The opened 2 band float32 ENVI dataset
+    """
+    dat_files_dir = os.path.join(out, vi_name) # create output folder for dat files
+    if not os.path.exists(dat_files_dir):
+        os.makedirs(dat_files_dir)
+
+    out_file = os.path.join(dat_files_dir, filename + '_' + vi_name + '.dat')
+    driver = gdal.GetDriverByName("ENVI")
+    outds = driver.Create(out_file, x, y, 2, gdal.GDT_Float32)
+    outds.SetGeoTransform(transform)
+    outds.SetProjection(proj)
+    return outds
+
+
+def envi_values(raster):
+    """    Returns a VI raster with its nodata pixels as in the original .dat files: NaN for the continuous VIs (float32),
+           0 for the class VIs (uint8, e.g. cc)
+    """
+    nodata = raster == output_nodata(raster)
+    if raster.dtype == np.uint8:
+        return np.where(nodata, 0, raster).astype(np.uint8)
+    return np.where(nodata, np.nan, raster).astype(np.float32)
+
+
+class EnviWriter:
+    """    Writes every VI to its own 2 band float32 ENVI file: <out_dir>/<vi>/<filename>_<vi>.dat
+    """
+    def __init__(self, out_dir, filename, img_type, vis, x, y, transform, proj):
+        self.out_dir = out_dir
+        self.filename = filename
+        self.img_type = img_type
+        self.vis = list(vis)
+        self._out_ds = {}
+        for vi in self.vis:
+            self._out_ds[vi] = create_vi_dat_file(out_dir, vi, filename, x, y, transform, proj)
+
+    @staticmethod
+    def paths(out_dir, filename, vis):
+        """    Returns VI name -> output file
+        """
+        return {vi: os.path.join(out_dir, vi, filename + '_' + vi + '.dat') for vi in vis}
+
+    def output_paths(self):
+        return self.paths(self.out_dir, self.filename, self.vis)
+
+    def write(self, window, vi_rasters, alpha = None):
+        """    Writes one window of every computed VI
+
+               Args:
+                window (tuple)          : (xoff, yoff, xsize, ysize) window to be written
+                vi_rasters (dict)       : VI name -> numpy array of the window
+                alpha (numpy array)     : Alpha band of the window -only for RGB images- (default is None)
+        """
+        xoff, yoff = window[0], window[1]
+        for vi in vi_rasters:
+            # a copy, the window may still be read after the write (e.g. by the zonal statistics)
+            self._out_ds[vi].GetRasterBand(1).WriteArray(envi_values(vi_rasters[vi]), xoff, yoff)
+            if self.img_type == 'RGB' and vi != 'cc' and alpha is not None: # cc is saved without the alpha band
+                self._out_ds[vi].GetRasterBand(2).WriteArray(alpha, xoff, yoff)
+
+    def close(self):
+        self._out_ds = {} # dereferencing the datasets flushes them
+
+    def abort(self):
+        """    Closes the files and removes them, for an image that was cancelled or failed before its last window
+        """
+        self._out_ds = {}
+        for path in self.output_paths().values():
+            if os.path.exists(path):
+                gdal.GetDriverByName('ENVI').Delete(path)
+
+
+class CogWriter:
+    """    Writes all VIs of an image to <out_dir>/<filename>_vis.tif (one band per VI, band description = VI name)
+           and cc to <out_dir>/<filename>_cc.tif as uint8 or bits. The windows go to a tiled, compressed staging GeoTIFF
+           which is converted to a COG (with overviews) on close. The pixels masked by the alpha band are nodata.
+           With cc_nbits = 1 cc takes 1 bit per pixel (before compression), a 1 bit value can't hold CLASS_NODATA so
+           its nodata pixels are stored as 0 and flagged by the internal (also 1 bit) mask of the file instead.
+
+           Options:
+            compress (str)      : DEFLATE, ZSTD or LZW (default is DEFLATE)
+            level (int)         : Compression level (default is None, the driver default)
+            vi_dtype (str)      : Storage of the continuous VIs: float32, float16 or int16 scaled by vi_scale (default is float32)
+            vi_scale (float)    : Scale of the int16 storage, value = stored / vi_scale (default is 10000)
+            block_size (int)    : Edge of the internal tiles (default is 512)
+            overviews (bool)    : Build overviews (default is True)
+            cc_nbits (int)      : Storage of cc: 8 (uint8, nodata CLASS_NODATA) or 1 (bits and a nodata mask) (default is 8)
+    """
+    def __init__(self, out_dir, filename, img_type, vis, x, y, transform, proj, compress = 'DEFLATE', level = None,
+                 vi_dtype = 'float32', vi_scale = 10000, block_size = 512, overviews = True, cc_nbits = 8):
+        if vi_dtype not in COG_VI_DTYPES:
+            raise ValueError(f'vi_dtype must be one of {COG_VI_DTYPES}, got {vi_dtype}')
+        if cc_nbits not in COG_CC_NBITS:
+            raise ValueError(f'cc_nbits must be one of {COG_CC_NBITS}, got {cc_nbits}')
+        self.out_dir = out_dir
+        self.filename = filename
+        self.img_type = img_type
+        self.vis = list(vis)
+        self.compress = compress
+        self.level = level
+        self.vi_dtype = vi_dtype
+        self.vi_scale = vi_scale
+        self.block_size = block_size
+        self.overviews = overviews
+        self.cc_nbits = cc_nbits
+        self._bands = [vi for vi in self.vis if vi != 'cc']
+        self._staging = {}
+        self._nbits = {}
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        paths = self.output_paths()
+        if self._bands:
+            gdal_type = gdal.GDT_Int16 if vi_dtype == 'int16' else gdal.GDT_Float32
+            nbits = 16 if vi_dtype == 'float16' else None
+            ds = self._create_staging(paths[self._bands[0]], len(self._bands), gdal_type, x, y, transform, proj, nbits)
+            for b in range(len(self._bands)):
+                band = ds.GetRasterBand(b + 1)
+                band.SetDescription(self._bands[b])
+                if vi_dtype == 'int16':
+                    band.SetNoDataValue(INT16_NODATA)
+                    band.SetScale(1.0 / vi_scale)
+                    band.SetOffset(0.0)
+                else:
+                    band.SetNoDataValue(VI_NODATA)
+            self._staging['vis'] = ds
+            self._nbits['vis'] = nbits
+        if 'cc' in self.vis:
+            nbits = 1 if cc_nbits == 1 else None
+            ds = self._create_staging(paths['cc'], 1, gdal.GDT_Byte, x, y, transform, proj, nbits)
+            ds.GetRasterBand(1).SetDescription('cc')
+            if nbits is None:
+                ds.GetRasterBand(1).SetNoDataValue(CLASS_NODATA)
+            else:
+                gdal.SetThreadLocalConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+                ds.CreateMaskBand(gdal.GMF_PER_DATASET)
+                gdal.SetThreadLocalConfigOption('GDAL_TIFF_INTERNAL_MASK', None)
+            self._staging['cc'] = ds
+            self._nbits['cc'] = nbits
+
+    @staticmethod
+    def paths(out_dir, filename, vis):
+        """    Returns VI name -> output file (all continuous VIs share one file)
+        """
+        paths = {}
+        for vi in vis:
+            name = '_cc.tif' if vi == 'cc' else '_vis.tif'
+            paths[vi] = os.path.join(out_dir, filename + name)
+        return paths
+
+    def output_paths(self):
+        return self.paths(self.out_dir, self.filename, self.vis)
+
+    def _creation_options(self, gdal_type, nbits = None):
+        options = [f'COMPRESS={self.compress}', f'BLOCKSIZE={self.block_size}']
+        # horizontal differencing for integers, floating point predictor for floats
+        options.append('PREDICTOR=' + ('3' if gdal_type == gdal.GDT_Float32 else '2'))
+        if self.level is not None:
+            options.append(f'LEVEL={self.level}')
+        if nbits is not None:
+            options.append(f'NBITS={nbits}')
+        return options
+
+    def _create_staging(self, out_file, count, gdal_type, x, y, transform, proj, nbits = None):
+        options = ['TILED=YES', f'BLOCKXSIZE={self.block_size}', f'BLOCKYSIZE={self.block_size}', 'BIGTIFF=IF_SAFER',
+                   f'COMPRESS={self.compress}']
+        if nbits is not None:
+            options.append(f'NBITS={nbits}')
+        ds = gdal.GetDriverByName('GTiff').Create(out_file + '.tmp.tif', x, y, count, gdal_type, options)
+        ds.SetGeoTransform(transform)
+        ds.SetProjection(proj)
+        return ds
+
+    def write(self, window, vi_rasters, alpha = None):
+        """    Writes one window of every computed VI
+
+               Args:
+                window (tuple)          : (xoff, yoff, xsize, ysize) window to be written
+                vi_rasters (dict)       : VI name -> numpy array of the window
+                alpha (numpy array)     : Not used, the masked pixels are already nodata (default is None)
+        """
+        xoff, yoff = window[0], window[1]
+        for b in range(len(self._bands)):
+            vi = self._bands[b]
+            if vi not in vi_rasters:
+                continue
+            raster = vi_rasters[vi]
+            if self.vi_dtype == 'int16':
+                scaled = np.multiply(raster, self.vi_scale, dtype = np.float32)
+                invalid = (raster == VI_NODATA) | ~np.isfinite(scaled)
+                np.clip(scaled, -32767, 32767, out = scaled)
+                np.rint(scaled, out = scaled)
+                raster = scaled.astype(np.int16)
+                raster[invalid] = INT16_NODATA
+            self._staging['vis'].GetRasterBand(b + 1).WriteArray(raster, xoff, yoff)
+        if 'cc' in vi_rasters and 'cc' in self._staging:
+            cc = vi_rasters['cc'].astype(np.uint8, copy = False)
+            band = self._staging['cc'].GetRasterBand(1)
+            if self.cc_nbits == 1:
+                valid = cc != CLASS_NODATA
+                band.GetMaskBand().WriteArray(valid.view(np.uint8) * np.uint8(255), xoff, yoff)
+                cc = np.where(valid, cc, np.uint8(0))
+            band.WriteArray(cc, xoff, yoff)
+
+    def close(self):
+        """    Converts the staging files to COGs and removes them
+        """
+        paths = self.output_paths()
+        for key, ds in self._staging.items():
+            out_file = paths['cc'] if key == 'cc' else paths[self._bands[0]]
+            gdal_type = ds.GetRasterBand(1).DataType
+            nbits = self._nbits.get(key)
+            ds.FlushCache()
+            ds = None
+            options = self._creation_options(gdal_type, nbits)
+            options.append('OVERVIEWS=' + ('AUTO' if self.overviews else 'NONE'))
+            options.append('RESAMPLING=' + ('NEAREST' if key == 'cc' else 'AVERAGE'))
+            gdal.Translate(out_file, out_file + '.tmp.tif', format = 'COG', creationOptions = options)
+            gdal.GetDriverByName('GTiff').Delete(out_file + '.tmp.tif')
+        self._staging = {}
+
+    def abort(self):
+        """    Closes and removes the staging files, for an image that was cancelled or failed before its last window
+        """
+        self._staging = {}
+        for path in set(self.output_paths().values()):
+            if os.path.exists(path + '.tmp.tif'):
+                gdal.GetDriverByName('GTiff').Delete(path + '.tmp.tif')
+
+
+WRITERS = {
+    'ENVI' : EnviWriter,
+    'COG'  : CogWriter,
+}
+
+def get_output_paths(out_format, out_dir, filename, vis):
+    """    Returns VI name -> output file of a writer without creating anything, VIs sharing a file are written together
+    """
+    if out_format not in WRITERS:
+        raise ValueError(f'Output format must be one of {list(WRITERS)}, got {out_format}')
+    return WRITERS[out_format].paths(out_dir, filename, vis)
+
+def get_writer(out_format, out_dir, filename, img_type, vis, x, y, transform, proj, **options):
+    """    Opens the writer of the given output format for one orthomosaic
+
+           Args:
+            out_format (str)    : One of WRITERS (ENVI, COG)
+            out_dir (str)       : The directory to which the results will be saved
+            filename (str)      : Name used for the output files (the date prefix of the orthomosaic)
+            img_type (str)      : Type of the image: RGB or MULTI
+            vis (list(str))     : VIs that will be written
+            x, y (int)          : Size of the orthomosaic
+            transform (tuple)   : Orthomosaic geotransform
+            proj (str)          : Orthomosaic projection
+            options             : Writer specific options (see CogWriter)
+
+           Returns:
+            writer              : Object with write(window, vi_rasters, alpha) and close()
+    """
+    if out_format not in WRITERS:
+        raise ValueError(f'Output format must be one of {list(WRITERS)}, got {out_format}')
+    return WRITERS[out_format](out_dir, filename, img_type, vis, x, y, transform, proj, **options)
@@ -0,0 +1,329 @@
+"""
+File based work queue to spread the jobs of a manifest over many worker processes and hosts
+The queue is a folder on a filesystem shared by the workers, every unit of work is one JSON file moving between
+    pending/<id>.json            : waiting to be claimed
+    leased/<id>.<worker>.json    : claimed by a worker, kept alive by its heartbeat (the file mtime)
+    done/<id>.json               : finished, with the messages of run_job, the worker and the time taken
+    failed/<id>.json             : failed max_attempts times, with the errors of every attempt
+Every move is an os.rename, which is atomic on a filesystem: of the workers renaming the same pending file only one
+succeeds and owns the lease. A lease whose heartbeat is older than lease_timeout (the worker died or its host went
+down) is put back in pending by the next worker looking for work. A failing unit is retried up to max_attempts.
+No server is needed, the workers can be started and stopped at any time.
+
+    python work_queue.py enqueue jobs.json queue             # one unit per image of every job of the manifest
+    python work_queue.py work queue --processes 4            # on every host, until the queue is empty
+    python work_queue.py status queue
+    python work_queue.py retry queue                         # failed units back to pending
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from generate_canopy_attributes_cli import CHM_OPTIONS, check_job, load_manifest, run_job
+
+STATES = ['pending', 'leased', 'done', 'failed']
+DEFAULT_LEASE_TIMEOUT = 600.0 # seconds without heartbeat before a lease is taken back
+DEFAULT_HEARTBEAT     = 30.0
+DEFAULT_MAX_ATTEMPTS  = 3
+CHECKED_ARGS = list(inspect.signature(check_job).parameters) # arguments of run_job validated at enqueue time
+
+
+def init_queue(queue_dir):
+    """    Creates the folders of a queue (nothing happens if they exist)
+    """
+    for state in STATES + ['tmp']:
+        os.makedirs(os.path.join(queue_dir, state), exist_ok = True)
+
+def _write_json(path, data, tmp_dir):
+    # written next to the queue then renamed, a reader never sees a partial file
+    tmp = os.path.join(tmp_dir, f'{os.path.basename(path)}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp, 'w') as fp:
+        json.dump(data, fp, indent = 1, default = str)
+    os.replace(tmp, path)
+
+def _read_json(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+def _unit_id(path):
+    return os.path.basename(path).split('.', 1)[0]
+
+def unit_ids(queue_dir):
+    """    Returns state -> ids of the units in that state
+    """
+    return {state: sorted(_unit_id(f) for f in os.listdir(os.path.join(queue_dir, state)) if f.endswith('.json'))
+            for state in STATES}
+
+def _shared_outputs(job):
+    # True when a step of the job works on outputs of the whole job, not of one image: it has to run once, after all
+    # the images, in a single worker
+    if any(job.get(key) for key in ('time_series', 'attributes', 'cache', 'cache_dir', 'force')):
+        return True # one table / attributes file / cache manifest per job
+    vis = job.get('vis', [])
+    if any(vi in CHM_OPTIONS for vi in vis):
+        return True # ch / cv: boundary step or CHM engine over the whole chm_dir, their CSVs / shapefiles
+    vis = [vi for vi in vis if vi not in CHM_OPTIONS and not (job.get('cc_storage') and vi == 'cc')]
+    if job.get('shp_file') and vis and not job.get('zonal') and job.get('write_rasters', True) and not job.get('preview'):
+        return True # boundary step (get_boundary_for_vi) over the .dat files of the whole out_dir
+    return False
+
+def split_job(job):
+    """    Splits a job of a manifest (run_job keyword arguments) into units of one image each, the images are
+           independent so they can go to different workers. Jobs with outputs shared by their images stay whole: a
+           time series, an attributes file, a result cache, ch / cv (over the whole chm_dir) and the boundary step
+           (over the whole out_dir), so no two workers repeat those steps or read rasters another one is writing.
+    """
+    if _shared_outputs(job) or len(job.get('images', [])) <= 1:
+        return [job]
+    return [dict(job, images = [f]) for f in job['images']]
+
+def enqueue_manifest(manifest_file, queue_dir, split = True):
+    """    Adds the jobs of a manifest to a queue. A unit already in the queue (same arguments) is not added again,
+           so a manifest can be enqueued again after it was extended.
+
+           Args:
+            manifest_file (str)     : JSON manifest (see generate_canopy_attributes_cli)
+            queue_dir (str)         : Folder of the queue, on a filesystem shared by the workers
+            split (bool)            : One unit per image (see split_job) instead of one per job (default is True)
+
+           Returns:
+            added (list(str))       : Ids of the added units
+    """
+    init_queue(queue_dir)
+    known = set(i for ids in unit_ids(queue_dir).values() for i in ids)
+    added = []
+    for job in load_manifest(manifest_file):
+        check_job(**{k: v for k, v in job.items() if k in CHECKED_ARGS}) # fail before anything is queued
+        for unit in (split_job(job) if split else [job]):
+            unit_id = hashlib.sha256(json.dumps(unit, sort_keys = True, default = str).encode()).hexdigest()[:16]
+            if unit_id in known:
+                continue
+            known.add(unit_id)
+            _write_json(os.path.join(queue_dir, 'pending', unit_id + '.json'),
+                        {'id': unit_id, 'job': unit, 'attempts': 0, 'errors': [], 'enqueued': time.time()},
+                        os.path.join(queue_dir, 'tmp'))
+            added.append(unit_id)
+    return added
+
+def reap_expired(queue_dir, lease_timeout = DEFAULT_LEASE_TIMEOUT):
+    """    Puts the leases whose heartbeat is older than lease_timeout back in pending
+
+           Returns:
+            reaped (list(str))      : Ids of the units put back
+    """
+    leased_dir = os.path.join(queue_dir, 'leased')
+    reaped = []
+    now = time.time()
+    for f in os.listdir(leased_dir):
+        path = os.path.join(leased_dir, f)
+        try:
+            if now - os.path.getmtime(path) < lease_timeout:
+                continue
+            os.rename(path, os.path.join(queue_dir, 'pending', _unit_id(f) + '.json'))
+            reaped.append(_unit_id(f))
+        except FileNotFoundError: # finished, or reaped by another worker meanwhile
+            pass
+    return reaped
+
+def claim(queue_dir, worker_id):
+    """    Claims the first pending unit
+
+           Returns:
+            path (str)              : The leased file, owned by this worker, None when nothing is pending
+    """
+    pending_dir = os.path.join(queue_dir, 'pending')
+    for f in sorted(os.listdir(pending_dir)):
+        if not f.endswith('.json'):
+            continue
+        path = os.path.join(pending_dir, f)
+        leased = os.path.join(queue_dir, 'leased', f'{_unit_id(f)}.{worker_id}.json')
+        try:
+            os.utime(path) # the lease starts now, not when the unit was queued (rename keeps the mtime)
+            os.rename(path, leased)
+        except FileNotFoundError: # claimed by another worker first
+            continue
+        return leased
+    return None
+
+
+class _Heartbeat:
+    """    Touches a leased file every interval seconds while its unit runs, lost is set when the lease was taken back
+    """
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = 'lease-heartbeat', daemon = True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def run_unit(queue_dir, leased, worker_id, heartbeat = DEFAULT_HEARTBEAT, max_attempts = DEFAULT_MAX_ATTEMPTS,
+             metrics = None):
+    """    Runs a leased unit and moves it to done, back to pending (to be retried) or to failed
+
+           Returns:
+            state (str)             : done, pending, failed, or lost when the lease expired while the unit ran
+    """
+    unit = _read_json(leased)
+    if unit['attempts'] >= max_attempts: # every attempt so far lost its lease (e.g. the worker was killed)
+        unit['errors'].append({'worker': worker_id, 'error': f'Lease expired {unit["attempts"]} times'})
+        target = os.path.join(queue_dir, 'failed', unit['id'] + '.json')
+        os.rename(leased, target)
+        _write_json(target, unit, os.path.join(queue_dir, 'tmp'))
+        return 'failed'
+    unit['attempts'] += 1
+    unit['worker'] = worker_id
+    _write_json(leased, unit, os.path.join(queue_dir, 'tmp')) # counts the attempt even if this worker dies
+    start = time.perf_counter()
+    with _Heartbeat(leased, heartbeat) as beat:
+        try:
+            unit['messages'] = run_job(metrics = metrics, **unit['job'])
+            state = 'done'
+        except Exception as e:
+            unit['errors'].append({'worker': worker_id, 'error': f'{type(e).__name__}: {e}',
+                                   'traceback': traceback.format_exc()})
+            state = 'pending' if unit['attempts'] < max_attempts else 'failed'
+    unit['seconds'] = time.perf_counter() - start
+    if beat.lost:
+        return 'lost'
+
+    target = os.path.join(queue_dir, state, unit['id'] + '.json')
+    try:
+        os.rename(leased, target) # fails if the lease was taken back between the last heartbeat and now
+    except FileNotFoundError:
+        return 'lost'
+    _write_json(target, unit, os.path.join(queue_dir, 'tmp'))
+    return state
+
+def run_worker(queue_dir, worker_id = None, lease_timeout = DEFAULT_LEASE_TIMEOUT, heartbeat = DEFAULT_HEARTBEAT,
+               max_attempts = DEFAULT_MAX_ATTEMPTS, poll = 5.0, wait = False, metrics = None, log = None):
+    """    Claims and runs units until the queue is empty
+
+           Args:
+            queue_dir (str)         : Folder of the queue
+            worker_id (str)         : Name of the worker in the lease files (default is None, <host>-<pid>)
+            lease_timeout (float)   : Seconds without heartbeat before a lease is taken back (default is DEFAULT_LEASE_TIMEOUT)
+            heartbeat (float)       : Seconds between two heartbeats, well below lease_timeout (default is DEFAULT_HEARTBEAT)
+            max_attempts (int)      : Attempts of a unit before it is failed (default is DEFAULT_MAX_ATTEMPTS)
+            poll (float)            : Seconds between two looks at the queue when nothing can be claimed (default is 5.0)
+            wait (bool)             : Keep waiting for new units when the queue is empty (default is False, stop once
+                                      nothing is pending or leased)
+            metrics (Instrumentation): Receives the stage timers and progress of the units (default is None)
+            log (callable)          : Receives one line per unit (default is None)
+
+           Returns:
+            counts (dict)           : State -> units this worker left in that state (done, pending, failed, lost)
+    """
+    init_queue(queue_dir)
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'.replace('.', '_')
+    counts = {}
+    while True:
+        reap_expired(queue_dir, lease_timeout)
+        leased = claim(queue_dir, worker_id)
+        if leased is None:
+            ids = unit_ids(queue_dir)
+            if not wait and not ids['pending'] and not ids['leased']:
+                return counts
+            time.sleep(poll) # units leased by other workers may come back
+            continue
+        state = run_unit(queue_dir, leased, worker_id, heartbeat, max_attempts, metrics)
+        counts[state] = counts.get(state, 0) + 1
+        if log is not None:
+            log(f'{worker_id} {_unit_id(leased)}: {state}')
+
+def queue_status(queue_dir):
+    """    Returns state -> number of units
+    """
+    return {state: len(ids) for state, ids in unit_ids(queue_dir).items()}
+
+def retry_failed(queue_dir):
+    """    Puts the failed units back in pending with a fresh number of attempts
+
+           Returns:
+            ids (list(str))         : Ids of the units put back
+    """
+    ids = []
+    for unit_id in unit_ids(queue_dir)['failed']:
+        path = os.path.join(queue_dir, 'failed', unit_id + '.json')
+        unit = _read_json(path)
+        unit['attempts'] = 0
+        _write_json(path, unit, os.path.join(queue_dir, 'tmp'))
+        os.rename(path, os.path.join(queue_dir, 'pending', unit_id + '.json'))
+        ids.append(unit_id)
+    return ids
+
+def _worker_process(queue_dir, options):
+    run_worker(queue_dir, log = print, **options)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'File based work queue of canopy attribute jobs')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    enqueue = commands.add_parser('enqueue', help = 'Add the jobs of a manifest to a queue')
+    enqueue.add_argument('manifest')
+    enqueue.add_argument('queue')
+    enqueue.add_argument('--whole-jobs', dest = 'split', action = 'store_false', help = 'One unit per job, not per image')
+    work = commands.add_parser('work', help = 'Run workers until the queue is empty')
+    work.add_argument('queue')
+    work.add_argument('--processes', type = int, default = 1, help = 'Worker processes on this host')
+    work.add_argument('--lease-timeout', type = float, default = DEFAULT_LEASE_TIMEOUT)
+    work.add_argument('--heartbeat', type = float, default = DEFAULT_HEARTBEAT)
+    work.add_argument('--max-attempts', type = int, default = DEFAULT_MAX_ATTEMPTS)
+    work.add_argument('--wait', action = 'store_true', help = 'Keep waiting for new units when the queue is empty')
+    status = commands.add_parser('status', help = 'Number of units per state')
+    status.add_argument('queue')
+    retry = commands.add_parser('retry', help = 'Put the failed units back in pending')
+    retry.add_argument('queue')
+    args = parser.parse_args(argv)
+
+    if args.command == 'enqueue':
+        try:
+            added = enqueue_manifest(args.manifest, args.queue, args.split)
+        except ValueError as e:
+            print(f'Error: {e}', file = sys.stderr)
+            return 2
+        print(f'Added {len(added)} unit(s) to {args.queue}')
+    elif args.command == 'work':
+        options = {'lease_timeout': args.lease_timeout, 'heartbeat': args.heartbeat, 'max_attempts': args.max_attempts,
+                   'wait': args.wait}
+        if args.processes > 1:
+            workers = [multiprocessing.Process(target = _worker_process, args = (args.queue, options))
+                       for _ in range(args.processes)]
+            for p in workers:
+                p.start()
+            for p in workers:
+                p.join()
+        else:
+            _worker_process(args.queue, options)
+    elif args.command == 'retry':
+        print(f'Put {len(retry_failed(args.queue))} unit(s) back in pending')
+    status = queue_status(args.queue)
+    print('  '.join(f'{state}: {status[state]}' for state in STATES))
+    return 1 if status['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
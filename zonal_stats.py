@@ -0,0 +1,486 @@
+"""
+Zonal statistics of the Vegitation Indecies (VIs) per field plot
+The plot polygons are rasterized once into a label raster aligned to the orthomosaic (0 = no plot, k = k-th plot).
+The statistics are accumulated window by window while the VIs are computed, with bincount based reductions,
+so the .dat files don't have to be read back (or even written) to get the per plot values.
+The percentiles are exact by default: the plot pixels are kept (as float32 with their labels) until the end, the
+memory then grows with the plot pixels of an image. With exact_percentiles = False they come from per plot histograms
+(_PlotHistograms) whose memory depends on the number of plots and bins only. Every plot has its own grid, sized and
+coarsened from its own values, so a percentile is within a bin of that plot, about 1/128 of its value range (min to
+max) at most. An outlier pixel (e.g. gci / reci where the denominator is close to 0, a CHM spike) widens the bins of
+its plot accordingly, and a percentile falling between the two modes of a bimodal plot can land anywhere in the gap:
+the histograms are meant for bounded VIs on large images, not as a replacement of the exact percentiles.
+The label rasters are kept in a plot index on disk (by default .plot_index next to the shapefile), keyed by the
+shapefile content and the grid (size, geotransform, projection, EPSG), so every later VI, CHM or flight date on the
+same grid reads the labels instead of intersecting the polygons again.
+"""
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+import numpy as np
+from osgeo import gdal, ogr, osr
+from vi_expressions import output_nodata
+
+DEFAULT_PERCENTILES = (10, 50, 90)
+HISTOGRAM_BINS = 512 # bins of the per plot histograms of the percentiles
+INDEX_VERSION = 1
+INDEX_DIR_NAME = '.plot_index'
+
+
+class PlotLabels:
+    """    Label raster of the field plots on the grid of an orthomosaic
+
+           Attributes:
+            path (str)              : GeoTIFF holding the labels (0 = no plot, k = plot_ids[k-1])
+            plot_ids (list)         : Identifier of every plot (id_field value or feature id)
+            persistent (bool)       : The GeoTIFF belongs to the plot index and must not be removed
+    """
+    def __init__(self, path, plot_ids, persistent = False):
+        self.path = path
+        self.plot_ids = list(plot_ids)
+        self.persistent = persistent
+        self._ds = gdal.Open(path)
+
+    def __len__(self):
+        return len(self.plot_ids)
+
+    def read(self, window):
+        """    Returns the int32 labels of a (xoff, yoff, xsize, ysize) window
+        """
+        xoff, yoff, xs, ys = window
+        return self._ds.GetRasterBand(1).ReadAsArray(xoff, yoff, xs, ys).astype(np.int32, copy = False)
+
+    def close(self):
+        self._ds = None
+
+    def release(self):
+        """    Closes the labels and removes the GeoTIFF unless it belongs to the plot index
+        """
+        self.close()
+        if not self.persistent and os.path.exists(self.path):
+            gdal.GetDriverByName('GTiff').Delete(self.path)
+
+
+def rasterize_plots(shp_file, x, y, transform, proj, out_file = None, epsg = None, id_field = None):
+    """    Rasterizes the plot polygons of a shapefile on the grid of an orthomosaic
+
+           Args:
+            shp_file (str)          : Shapefile with the field plots
+            x (int)                 : x size of the orthomosaic
+            y (int)                 : y size of the orthomosaic
+            transform (tuple)       : Orthomosaic geotransform
+            proj (str)              : Orthomosaic projection
+            out_file (str)          : GeoTIFF to store the labels (default is None, a temporary file)
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            id_field (str)          : Attribute identifying the plots (default is None, the feature id)
+
+           Returns:
+            labels (PlotLabels)     : The label raster and the plot identifiers
+    """
+    src = ogr.Open(shp_file)
+    layer = src.GetLayer()
+    shp_srs = layer.GetSpatialRef()
+    if shp_srs is None and epsg is not None:
+        shp_srs = osr.SpatialReference()
+        shp_srs.ImportFromEPSG(int(epsg))
+    img_srs = osr.SpatialReference()
+    img_srs.ImportFromWkt(proj)
+    to_img = None
+    if shp_srs is not None and proj and not shp_srs.IsSame(img_srs):
+        shp_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        img_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        to_img = osr.CoordinateTransformation(shp_srs, img_srs)
+
+    # in-memory copy of the plots, in the projection of the image, with their label
+    mem = ogr.GetDriverByName('Memory').CreateDataSource('plots')
+    mem_layer = mem.CreateLayer('plots', img_srs, ogr.wkbMultiPolygon)
+    mem_layer.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+    plot_ids = []
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        geom = geom.Clone()
+        if to_img is not None:
+            geom.Transform(to_img)
+        plot_ids.append(feature.GetField(id_field) if id_field else feature.GetFID())
+        out_feature = ogr.Feature(mem_layer.GetLayerDefn())
+        out_feature.SetGeometry(geom)
+        out_feature.SetField('label', len(plot_ids))
+        mem_layer.CreateFeature(out_feature)
+    src = None
+
+    if out_file is None:
+        fd, out_file = tempfile.mkstemp(suffix = '_plot_labels.tif')
+        os.close(fd)
+    gdal_type = gdal.GDT_UInt16 if len(plot_ids) < 65535 else gdal.GDT_Int32
+    ds = gdal.GetDriverByName('GTiff').Create(out_file, x, y, 1, gdal_type,
+                                              ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER', 'SPARSE_OK=TRUE'])
+    ds.SetGeoTransform(transform)
+    ds.SetProjection(proj)
+    gdal.RasterizeLayer(ds, [1], mem_layer, options = ['ATTRIBUTE=label'])
+    ds = None
+    return PlotLabels(out_file, plot_ids)
+
+
+def default_index_dir(shp_file):
+    """    Returns the folder of the plot index of a shapefile: .plot_index next to it, or in the temporary folder
+           when the folder of the shapefile is not writable
+    """
+    shp_dir = os.path.dirname(os.path.abspath(shp_file))
+    if os.access(shp_dir, os.W_OK):
+        return os.path.join(shp_dir, INDEX_DIR_NAME)
+    return os.path.join(tempfile.gettempdir(), INDEX_DIR_NAME)
+
+def plot_index_key(shp_file, x, y, transform, proj, epsg = None, id_field = None):
+    """    Returns the key of a label raster: a sha256 of the shapefile files (.shp, .shx, .dbf, .prj, .cpg) and the grid
+    """
+    base = os.path.splitext(os.path.abspath(shp_file))[0]
+    files = {}
+    for ext in ('.shp', '.shx', '.dbf', '.prj', '.cpg'):
+        if os.path.exists(base + ext):
+            h = hashlib.sha256()
+            with open(base + ext, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 24), b''):
+                    h.update(chunk)
+            files[ext] = h.hexdigest()
+    description = {
+        'version'   : INDEX_VERSION,
+        'shapefile' : files,
+        'grid'      : [x, y, list(transform), proj],
+        'epsg'      : epsg,
+        'id_field'  : id_field,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys = True).encode()).hexdigest()
+
+def get_plot_labels(shp_file, x, y, transform, proj, epsg = None, id_field = None, index_dir = None):
+    """    Returns the label raster of the plots on a grid from the plot index, rasterizing it on the first use
+
+           Args:
+            shp_file (str)          : Shapefile with the field plots
+            x, y (int)              : Size of the grid
+            transform (tuple)       : Geotransform of the grid
+            proj (str)              : Projection of the grid
+            epsg (int)              : EPSG of the shapefile, used when it has no .prj (default is None)
+            id_field (str)          : Attribute identifying the plots (default is None, the feature id)
+            index_dir (str)         : Folder of the plot index (default is None, default_index_dir(shp_file)),
+                                      False for a temporary label raster removed after use
+
+           Returns:
+            labels (PlotLabels)
+    """
+    if index_dir is False:
+        return rasterize_plots(shp_file, x, y, transform, proj, epsg = epsg, id_field = id_field)
+    index_dir = index_dir or default_index_dir(shp_file)
+    key = plot_index_key(shp_file, x, y, transform, proj, epsg, id_field)
+    label_file = os.path.join(index_dir, key + '.tif')
+    ids_file = os.path.join(index_dir, key + '.json')
+    if os.path.exists(ids_file) and os.path.exists(label_file):
+        with open(ids_file) as fp:
+            return PlotLabels(label_file, json.load(fp)['plot_ids'], persistent = True)
+
+    # rasterized under a unique name and renamed, concurrent runs (workers, dates, hosts sharing the index) may build
+    # the same entry
+    os.makedirs(index_dir, exist_ok = True)
+    tmp = os.path.join(index_dir, f'{key}.{uuid.uuid4().hex}.tmp')
+    labels = rasterize_plots(shp_file, x, y, transform, proj, out_file = tmp + '.tif', epsg = epsg, id_field = id_field)
+    labels.close()
+    with open(tmp + '.json', 'w') as fp:
+        json.dump({'shapefile': os.path.abspath(shp_file), 'grid': [x, y, list(transform)], 'epsg': epsg,
+                   'plot_ids': labels.plot_ids}, fp, default = str)
+    os.replace(tmp + '.tif', label_file)
+    os.replace(tmp + '.json', ids_file) # written last, an entry is complete once its .json exists
+    return PlotLabels(label_file, labels.plot_ids, persistent = True)
+
+
+class _PlotHistograms:
+    """    Per plot histograms of one VI, every plot on its own grid of n_bins bins: bin g of plot p holds the values in
+           [g * width[p], (g + 1) * width[p]), width[p] being a power of 2 sized from the values of the plot. When the
+           values of a plot no longer fit in n_bins bins its width is doubled (pairs of bins merged), so the memory
+           stays (n_plots + 1) x n_bins and two histograms can always be merged. Outliers in a plot only coarsen the
+           bins of that plot.
+    """
+    def __init__(self, n_plots, n_bins = HISTOGRAM_BINS):
+        self.n_rows = n_plots + 1
+        self.n_bins = n_bins
+        self.width = np.zeros(self.n_rows)                                  # bin width per plot, 0 until its first values
+        self.start = np.zeros(self.n_rows, np.int64)                        # grid index of the first column per plot
+        self.first = np.full(self.n_rows, np.iinfo(np.int64).max, np.int64) # grid indices of the first and last bins
+        self.last = np.full(self.n_rows, np.iinfo(np.int64).min, np.int64)  # holding values per plot
+        self.counts = None                                                  # (plot label, column) uint32
+
+    def _fit(self, p, lo, hi, min_width = 0.0):
+        # makes room in the row of plot p for the values lo..hi in bins of at least min_width, coarsening it as needed
+        used = self.first[p] <= self.last[p]
+        width = self.width[p]
+        if width == 0:
+            span = hi - lo if hi > lo else max(abs(lo), 1.0) * 1e-3
+            width = 2.0 ** np.ceil(np.log2(span / (self.n_bins // 2))) # room to spread
+        width = max(width, min_width)
+        while True:
+            first, last = int(np.floor(lo / width)), int(np.floor(hi / width))
+            if used:
+                k = int(round(width / self.width[p]))
+                first, last = min(first, self.first[p] // k), max(last, self.last[p] // k)
+            if last - first < self.n_bins:
+                break
+            width *= 2
+        if width != self.width[p] or first < self.start[p] or last >= self.start[p] + self.n_bins:
+            self._regrid(p, width, first - (self.n_bins - (last - first + 1)) // 2) # centered, room on both sides
+
+    def _regrid(self, p, width, start):
+        old = self.counts[p].copy()
+        old_width, old_start, first, last = self.width[p], self.start[p], self.first[p], self.last[p]
+        self.counts[p] = 0
+        self.width[p], self.start[p] = width, start
+        if first <= last:
+            k = int(round(width / old_width))
+            np.add.at(self.counts[p], np.arange(first, last + 1) // k - start, old[first - old_start:last - old_start + 1])
+            self.first[p], self.last[p] = first // k, last // k
+
+    def add(self, labels, values):
+        """    Adds the values (float64) of the plot pixels with their labels
+        """
+        if not len(values):
+            return
+        if self.counts is None:
+            self.counts = np.zeros((self.n_rows, self.n_bins), np.uint32)
+        lo = np.full(self.n_rows, np.inf)
+        hi = np.full(self.n_rows, -np.inf)
+        np.minimum.at(lo, labels, values)
+        np.maximum.at(hi, labels, values)
+        plots = np.flatnonzero(lo <= hi)
+        # only the plots whose values don't fit in their row are regridded, one by one
+        width = np.where(self.width[plots] > 0, self.width[plots], 1.0)
+        first = np.floor(lo[plots] / width).astype(np.int64)
+        last = np.floor(hi[plots] / width).astype(np.int64)
+        refit = (self.width[plots] == 0) | (first < self.start[plots]) | (last >= self.start[plots] + self.n_bins)
+        for p in plots[refit]:
+            self._fit(p, lo[p], hi[p])
+
+        bins = np.floor(values / self.width[labels]).astype(np.int64)
+        flat = labels.astype(np.int64) * self.n_bins + (bins - self.start[labels])
+        base = flat.min()
+        counts = np.bincount(flat - base) # only spans the plots of the window
+        nz = np.flatnonzero(counts)
+        self.counts.reshape(-1)[base + nz] += counts[nz].astype(np.uint32)
+        width = self.width[plots]
+        self.first[plots] = np.minimum(self.first[plots], np.floor(lo[plots] / width).astype(np.int64))
+        self.last[plots] = np.maximum(self.last[plots], np.floor(hi[plots] / width).astype(np.int64))
+
+    def merge(self, other):
+        if other.counts is None:
+            return
+        if self.counts is None:
+            self.counts = np.zeros((self.n_rows, self.n_bins), np.uint32)
+        for p in np.flatnonzero(other.first <= other.last):
+            o_width, o_first, o_last = other.width[p], other.first[p], other.last[p]
+            self._fit(p, o_first * o_width, o_last * o_width, o_width)
+            k = int(round(self.width[p] / o_width))
+            np.add.at(self.counts[p], np.arange(o_first, o_last + 1) // k - self.start[p],
+                      other.counts[p, o_first - other.start[p]:o_last - other.start[p] + 1])
+            self.first[p] = min(self.first[p], o_first // k)
+            self.last[p] = max(self.last[p], o_last // k)
+
+    def percentiles(self, count, percentiles, vmin, vmax):
+        """    Returns p<q> -> array with one value per plot, the rank of np.percentile (linear) located in its bin,
+               the values of a bin taken as evenly spread, within the min / max of the plot (NaN for empty plots)
+        """
+        n = self.n_rows - 1
+        if self.counts is None:
+            return {f'p{q:g}': np.full(n, np.nan) for q in percentiles}
+        h = self.counts[1:]
+        cum = np.cumsum(h, axis = 1, dtype = np.int64)
+        rows = np.arange(n)
+        empty = count == 0
+        result = {}
+        for q in percentiles:
+            rank = (q / 100.0) * np.maximum(count - 1, 0)
+            col = np.minimum((cum <= rank[:, None]).sum(axis = 1), self.n_bins - 1)
+            c = h[rows, col].astype(np.float64)
+            before = cum[rows, col] - c
+            value = (self.start[1:] + col + (rank - before + 0.5) / np.maximum(c, 1)) * self.width[1:]
+            with np.errstate(invalid = 'ignore'):
+                result[f'p{q:g}'] = np.where(empty, np.nan, np.clip(value, vmin, vmax))
+        return result
+
+
+class ZonalAccumulator:
+    """    Accumulates per plot statistics of VIs window by window
+
+           Args:
+            n_plots (int)           : Number of plots (labels 1..n_plots)
+            vis (list(str))         : VIs to be accumulated
+            percentiles (tuple)     : Percentiles to be reported (default is DEFAULT_PERCENTILES), empty to only keep
+                                      count / mean / std / min / max
+            exact_percentiles (bool): Keep every plot pixel for exact percentiles, the memory then grows with the
+                                      plot pixels, False for the per plot histograms (default is True, see the module
+                                      docstring)
+            bins (int)              : Bins of the per plot histograms (default is HISTOGRAM_BINS)
+    """
+    def __init__(self, n_plots, vis, percentiles = DEFAULT_PERCENTILES, exact_percentiles = True, bins = HISTOGRAM_BINS):
+        self.n_plots = n_plots
+        self.vis = list(vis)
+        self.percentiles = tuple(percentiles)
+        self.exact_percentiles = exact_percentiles
+        self._count = {vi: np.zeros(n_plots + 1, np.int64) for vi in self.vis}
+        self._sum = {vi: np.zeros(n_plots + 1, np.float64) for vi in self.vis}
+        self._sumsq = {vi: np.zeros(n_plots + 1, np.float64) for vi in self.vis}
+        self._min = {vi: np.full(n_plots + 1, np.inf) for vi in self.vis}
+        self._max = {vi: np.full(n_plots + 1, -np.inf) for vi in self.vis}
+        self._values = {vi: [] for vi in self.vis} # (labels, values) chunks of the plot pixels, exact percentiles
+        self._histograms = {vi: _PlotHistograms(n_plots, bins) for vi in self.vis} if self.percentiles else {}
+
+    def add(self, labels, vi_rasters):
+        """    Adds one window
+
+               Args:
+                labels (numpy array)    : Plot labels of the window (0 = no plot)
+                vi_rasters (dict)       : VI name -> numpy array of the window, nodata and non finite values are ignored
+        """
+        in_plot = labels > 0
+        if not in_plot.any():
+            return
+        for vi in self.vis:
+            if vi not in vi_rasters:
+                continue
+            values = vi_rasters[vi]
+            valid = in_plot & (values != output_nodata(values))
+            if values.dtype.kind == 'f':
+                valid &= np.isfinite(values)
+            l = labels[valid]
+            v = values[valid].astype(np.float64)
+            n = self.n_plots + 1
+            self._count[vi] += np.bincount(l, minlength = n)
+            self._sum[vi] += np.bincount(l, weights = v, minlength = n)
+            self._sumsq[vi] += np.bincount(l, weights = v * v, minlength = n)
+            np.minimum.at(self._min[vi], l, v)
+            np.maximum.at(self._max[vi], l, v)
+            if self.percentiles and self.exact_percentiles:
+                self._values[vi].append((l, v.astype(np.float32)))
+            elif self.percentiles:
+                self._histograms[vi].add(l, v)
+
+    def merge(self, other):
+        """    Adds the pixels accumulated by another accumulator with the same plots (e.g. another window range)
+        """
+        for vi in other.vis:
+            if vi not in self._count:
+                continue
+            self._count[vi] += other._count[vi]
+            self._sum[vi] += other._sum[vi]
+            self._sumsq[vi] += other._sumsq[vi]
+            np.minimum(self._min[vi], other._min[vi], out = self._min[vi])
+            np.maximum(self._max[vi], other._max[vi], out = self._max[vi])
+            if self.percentiles and self.exact_percentiles:
+                self._values[vi].extend(other._values[vi])
+            elif self.percentiles:
+                self._histograms[vi].merge(other._histograms[vi])
+
+    def stat_names(self):
+        """    Returns the names of the statistics reported for every VI
+        """
+        return ['count', 'mean', 'std', 'min', 'max'] + [f'p{q:g}' for q in self.percentiles]
+
+    def finalize(self):
+        """    Computes the statistics
+
+               Returns:
+                stats (dict)        : VI name -> statistic name -> array with one value per plot (NaN for empty plots)
+        """
+        stats = {}
+        for vi in self.vis:
+            count = self._count[vi][1:]
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                mean = self._sum[vi][1:] / count
+                std = np.sqrt(np.maximum(self._sumsq[vi][1:] / count - mean * mean, 0))
+            empty = count == 0
+            vi_stats = {
+                'count' : count,
+                'mean'  : mean,
+                'std'   : std,
+                'min'   : np.where(empty, np.nan, self._min[vi][1:]),
+                'max'   : np.where(empty, np.nan, self._max[vi][1:]),
+            }
+            vi_stats.update(self._percentiles(vi, count, vi_stats['min'], vi_stats['max']))
+            stats[vi] = vi_stats
+        return stats
+
+    def _percentiles(self, vi, count, vmin, vmax):
+        if not self.percentiles:
+            return {}
+        if not self.exact_percentiles:
+            return self._histograms[vi].percentiles(count, self.percentiles, vmin, vmax)
+        if self._values[vi]:
+            l = np.concatenate([c[0] for c in self._values[vi]])
+            v = np.concatenate([c[1] for c in self._values[vi]])
+        else:
+            l = np.zeros(0, np.int32); v = np.zeros(0, np.float32)
+        order = np.lexsort((v, l)) # sorted by plot, then by value
+        v = v[order]
+        count = np.bincount(l, minlength = self.n_plots + 1)[1:]
+        start = np.concatenate(([0], np.cumsum(count)[:-1]))
+        empty = count == 0
+        result = {}
+        for q in self.percentiles:
+            # linear interpolation between the closest ranks, as np.percentile
+            pos = start + (q / 100.0) * np.maximum(count - 1, 0)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo + 1, start + np.maximum(count - 1, 0))
+            if len(v):
+                lo_v = v[np.minimum(lo, len(v) - 1)].astype(np.float64)
+                hi_v = v[np.minimum(hi, len(v) - 1)].astype(np.float64)
+                p = lo_v + (hi_v - lo_v) * (pos - lo)
+            else:
+                p = np.zeros(self.n_plots)
+            result[f'p{q:g}'] = np.where(empty, np.nan, p)
+        return result
+
+
+def open_plot_stats(shp_file, vis, x, y, transform, proj, epsg = None, id_field = None, percentiles = DEFAULT_PERCENTILES,
+                    index_dir = None, exact_percentiles = True):
+    """    Gets the label raster of the plots on the grid of an image (see get_plot_labels) and creates the accumulator
+           of its VIs
+
+           Returns:
+            labels (PlotLabels)         : The label raster of the plots
+            accumulator (ZonalAccumulator)
+    """
+    labels = get_plot_labels(shp_file, x, y, transform, proj, epsg, id_field, index_dir)
+    return labels, ZonalAccumulator(len(labels), vis, percentiles, exact_percentiles)
+
+def close_plot_stats(out_dir, filename, labels, accumulator):
+    """    Computes the statistics of an image, saves them to <out_dir>/zonal/<filename>_plots.csv and releases the labels
+
+           Returns:
+            result (dict)               : plot_ids, stats (VI name -> statistic name -> array) and csv
+    """
+    stats = accumulator.finalize()
+    out_file = os.path.join(out_dir, 'zonal', filename + '_plots.csv')
+    save_zonal_stats_csv(out_file, labels.plot_ids, stats)
+    labels.release()
+    return {'plot_ids': labels.plot_ids, 'stats': stats, 'csv': out_file}
+
+def save_zonal_stats_csv(out_file, plot_ids, stats):
+    """    Saves per plot statistics as a CSV file, one row per plot and one <vi>_<stat> column per statistic
+
+           Args:
+            out_file (str)          : CSV file to be written
+            plot_ids (list)         : Identifier of every plot
+            stats (dict)            : VI name -> statistic name -> array with one value per plot
+
+           Returns:
+            none
+    """
+    out_dir = os.path.dirname(out_file)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    columns = [(vi, stat) for vi in stats for stat in stats[vi]]
+    with open(out_file, 'w', newline = '') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['plot_id'] + [f'{vi}_{stat}' for vi, stat in columns])
+        for k in range(len(plot_ids)):
+            writer.writerow([plot_ids[k]] + [stats[vi][stat][k] for vi, stat in columns])